@@ -3,14 +3,25 @@ import pandas as pd
 import numpy as np
 import os 
 from glob import glob  
-from joblib import Parallel, delayed
 
 # Penn Mem
-from cmlreaders import CMLReader, get_data_index
-from ptsa.data.filters import ButterworthFilter
-from ptsa.data.filters import MorletWaveletFilter
-from ptsa.data.filters import ResampleFilter
-from ptsa.data.timeseries import TimeSeries
+from cmlreaders import CMLReader
+
+# Neuro
+from neuro.stim.eeg_filters import butterworth_filter, line_noise_filter, resample_timeseries
+from neuro.stim.table_cache import TableCache, cached_table, r1_source_files
+from neuro.stim.events import expand_events, load_task_events
+from neuro.stim.legacy_loc import legacy_loc
+from neuro.stim.r1_index import r1_index
+from neuro.stim.precision import get_policy
+from neuro.stim.read_planner import load_planned_eeg
+from neuro.stim.reref import monopolar_scheme, rereference
+from neuro.stim.roi import DETAILED_ROI_DICT, REGION_COLUMNS, RoiClassifier
+from neuro.stim.stimulation import build_stimulation_table
+from neuro.stim.epoch_store import cached_epochs, frame_fingerprint
+from neuro.stim.group import run_group
+from neuro.stim.group_tables import GroupTable
+from neuro.stim.profiling import profiled, span
 
 def load_subject_data(task, isubject):
     subjects = load_subject_ids(task)
@@ -23,12 +34,16 @@ def load_subject_data(task, isubject):
 class RAMSubjectData:
     """
     Class for loading RAM subject data to analyze PS3 theta burst stimulation
+
+    If a TableCache is given as cache, events, electrode and stimulation tables are read from / saved to it instead of
+    being reloaded from the protocol files every time.
     """
-    def __init__(self, task, subject, montage):
+    def __init__(self, task, subject, montage, cache=None):
         # Arguments
         self.task    = task
         self.subject = subject
         self.montage = montage
+        self.cache   = cache
 
         # Data
         self.events      = None
@@ -38,16 +53,23 @@ class RAMSubjectData:
 
         # Signal
         self.eeg = None
+        self.eeg_windows = None
     
     def load_metadata(self):
-        self.load_events_info(as_df=True, remove_no_eeg = True)
-        self.load_electrode_info(bipolar = False)
-        self.load_electrode_bipolar_info()
-        self.load_stimulation_info(on_off = 'OFF')
-
-    def load_events_info(self, as_df = True, remove_no_eeg = True):
+        with span('events') as s:
+            self.load_events_info(as_df=True, remove_no_eeg = True)
+            s.add_bytes(self.events.memory_usage(deep=True).sum())
+        with span('electrodes'):
+            self.load_electrode_info(bipolar = False)
+        with span('electrodes_bipolar'):
+            self.load_electrode_bipolar_info()
+        with span('stimulation'):
+            self.load_stimulation_info(on_off = 'OFF')
+
+    def load_events_info(self, as_df = True, remove_no_eeg = True, compact = False):
         print(f'Loading events for subject {self.subject}, task {self.task}, montage {self.montage}')
-        self.events = load_events_info(self.subject, self.task, self.montage, as_df, remove_no_eeg)
+        self.events = load_events_info(self.subject, self.task, self.montage, as_df, remove_no_eeg, cache=self.cache,
+                                       compact=compact)
         print ('Done')
 
     def stimulation_events(self):
@@ -55,45 +77,105 @@ class RAMSubjectData:
 
     def load_electrode_info(self, bipolar = False):
         print(f'Loading electrodes for subject {self.subject}, task {self.task}, montage {self.montage}')
-        self.electrodes = load_electrode_info(self.subject, self.montage, bipolar)
+        self.electrodes = self._cached_electrode_info(bipolar)
         print ('Done')
 
     def load_electrode_bipolar_info(self):
-        self.electrodes_bipolar = load_electrode_info(self.subject, self.montage, bipolar=True)
+        self.electrodes_bipolar = self._cached_electrode_info(bipolar=True)
+
+    def _cached_electrode_info(self, bipolar):
+        return cached_table(self.cache, 'electrodes',
+                            lambda: load_electrode_info(self.subject, self.montage, bipolar),
+                            None, self.subject, self.montage, options={'bipolar': bipolar},
+                            source_files=r1_source_files('pairs' if bipolar else 'contacts', self.subject, self.montage))
 
     def load_stimulation_info(self, on_off = 'OFF'):
         print(f'Loading stimulation info for subject {self.subject}, task {self.task}, montage {self.montage}')
-        self.stimulation = load_stimulation_info(self.events, self.electrodes_bipolar, on_off)
+        # keyed on the events' contents (and index, which becomes event_index), not just how many there are
+        source_files = r1_source_files('pairs', self.subject, self.montage) + \
+            r1_source_files('task_events', self.subject, self.montage, self.task.replace('RAM_', ''))
+        self.stimulation = cached_table(self.cache, 'stimulation',
+                                        lambda: load_stimulation_info(self.events, self.electrodes_bipolar, on_off),
+                                        self.task, self.subject, self.montage,
+                                        options={'on_off': on_off,
+                                                 'events': frame_fingerprint(self.events.reset_index())},
+                                        source_files=source_files)
         print('Done')
 
     def load_raw_eeg(self):
         self.eeg = load_raw_eeg (self.task,self.subject, 0, self.electrodes)
     
     def load_events_eeg(self, events = None, rel_start_ms = None, rel_stop_ms=None, buf_ms=0, elec_scheme=None, noise_freq=[58., 62.],
-             resample_freq=None, pass_band=None, use_mirror_buf=False, demean=False, do_average_ref=False):
-        
-        if events is None:
-            events = self.events
+             resample_freq=None, pass_band=None, use_mirror_buf=False, demean=False, do_average_ref=False, chan_chunk=None,
+             store_dir=None, coalesce_gap_ms=None, reference=None, precision=None):
+        """
+        Loads event-locked EEG into self.eeg. See load_events_eeg() for the parameters.
+
+        If store_dir is given, the preprocessed EEG is written to an epoch store there the first time and every later
+        call with the same events, channels and parameters opens it memory-mapped instead of reloading (see
+        epoch_store).
+        """
         if rel_start_ms is None:
             rel_start_ms = -500
         if rel_stop_ms is None:
             rel_stop_ms = 1500
+        self.eeg = self._events_eeg(events, rel_start_ms, rel_stop_ms, buf_ms, elec_scheme, noise_freq, resample_freq,
+                                    pass_band, use_mirror_buf, demean, do_average_ref, chan_chunk, store_dir,
+                                    coalesce_gap_ms, reference, precision)
+
+    def load_events_eeg_windows(self, events=None, windows=None, buf_ms=0, elec_scheme=None, noise_freq=[58., 62.],
+                                resample_freq=None, pass_band=None, do_average_ref=False, chan_chunk=None,
+                                max_gap_ms=0, store_dir=None, coalesce_gap_ms=None, reference=None, precision=None):
+        """
+        Loads event-locked EEG for several named windows into self.eeg_windows ({name: TimeSeries}), reading and
+        preprocessing each contiguous range of samples once. See load_events_eeg_windows() for the parameters.
+
+        If store_dir is given, each range read is kept in an epoch store, as with load_events_eeg.
+        """
+        if windows is None:
+            windows = {'pre': (-1000, 0), 'post': (0, 1000)}
+
+        def loader(rel_start_ms, rel_stop_ms):
+            return self._events_eeg(events, rel_start_ms, rel_stop_ms, buf_ms, elec_scheme, noise_freq, resample_freq,
+                                    pass_band, False, False, do_average_ref, chan_chunk, store_dir, coalesce_gap_ms,
+                                    reference, precision)
+        self.eeg_windows = load_events_eeg_windows(events, windows, buf_ms, max_gap_ms=max_gap_ms, loader=loader)
+
+    def _events_eeg(self, events, rel_start_ms, rel_stop_ms, buf_ms, elec_scheme, noise_freq, resample_freq, pass_band,
+                    use_mirror_buf, demean, do_average_ref, chan_chunk, store_dir, coalesce_gap_ms=None,
+                    reference=None, precision=None):
+        if events is None:
+            events = self.events
         if elec_scheme is None:
             elec_scheme = self.electrodes
 
-        self.eeg = load_events_eeg(events, rel_start_ms, rel_stop_ms, buf_ms, elec_scheme, noise_freq,
-             resample_freq, pass_band, use_mirror_buf, demean, do_average_ref)
-
-def load_ram_group_data(task):
+        params = {'task': self.task, 'subject': self.subject, 'montage': self.montage,
+                  'events': frame_fingerprint(events, ['eegfile', 'eegoffset']),
+                  'channels': frame_fingerprint(elec_scheme, ['label', 'contact', 'contact_1', 'contact_2']),
+                  'rel_start_ms': rel_start_ms, 'rel_stop_ms': rel_stop_ms, 'buf_ms': buf_ms, 'noise_freq': noise_freq,
+                  'resample_freq': resample_freq, 'pass_band': pass_band, 'use_mirror_buf': use_mirror_buf,
+                  'demean': demean, 'do_average_ref': do_average_ref}
+        # only when set, so stores made before there was a reference option still match
+        if reference is not None:
+            params['reference'] = reference
+        if precision is not None:
+            params['dtype'] = get_policy(precision).compute.name
+        return cached_epochs(store_dir, params,
+                             lambda: load_events_eeg(events, rel_start_ms, rel_stop_ms, buf_ms, elec_scheme, noise_freq,
+                                                     resample_freq, pass_band, use_mirror_buf, demean, do_average_ref,
+                                                     chan_chunk, coalesce_gap_ms, reference, precision))
+
+def load_ram_group_data(task, cache_dir=None):
     """
-    Create RAMGroupData object for task
+    Create RAMGroupData object for task. If cache_dir is given, subject tables are cached there (see TableCache)
     """
     subjects = load_subject_ids(task)
-    return RAMGroupData(task, subjects_and_montages=subjects)
+    return RAMGroupData(task, subjects_and_montages=subjects, cache_dir=cache_dir)
 
 
 class RAMGroupData:
-    def __init__(self, task, subject_ids = None, montage_ids = None, subjects_and_montages = None):
+    def __init__(self, task, subject_ids = None, montage_ids = None, subjects_and_montages = None, cache_dir = None,
+                 cache_max_bytes = int(5e9)):
         # Arguments
         self.task = task
         self.subject_ids = subject_ids
@@ -108,69 +190,97 @@ class RAMGroupData:
         self.electrodes = None
         self.stimulation = None
 
+        # Group tables, appended to as subjects are added
+        self.electrode_table = None
+        self.stimulation_table = None
+
         # Errors
         self.subject_errors = None
 
         # Options
+        self.cache = TableCache(cache_dir, cache_max_bytes) if cache_dir is not None else None
 
-    def load_subjects(self):
-        # Parallelize load
-        def load_subject(task, subject_id, montage_id):
-            try:
-                subject = RAMSubjectData(task, subject_id, montage_id)
-                subject.load_events_info()
-                subject.load_electrode_info()
-                subject.load_stimulation_info()
-            except Exception as e:
-                subject = f'Subject {subject_id}, Montage {montage_id} | Error: {e}'
-            return subject
-        
-        self.subjects = Parallel(n_jobs = 12, verbose = 5, backend='loky') \
-            (delayed(load_subject)(self.task, subject, montage) 
-            for subject, montage in zip(self.subject_ids, self.montage_ids))
-
-        errors = [] 
-        for subject in self.subjects:
-            if type (subject) == str:
-                errors.append(subject)
-        
-        print ('\n\nErrors occured loading these Subjects:')
-        for error in errors:
-            print('\t', error)
-            self.subjects.remove(error)
-        self.subject_errors = errors
-        
+    def iter_subjects(self, n_workers=None, retries=2, checkpoint_dir=None, progress=True, mp_context=None):
+        """
+        Generator that loads every subject's metadata in one process pool and yields a JobResult (see group.run_group)
+        as each subject finishes. result.value is the RAMSubjectData, or None with result.error set if it failed.
+        """
+        jobs = [((self.task, subject, montage), (self.task, subject, montage, self.cache))
+                for subject, montage in zip(self.subject_ids, self.montage_ids)]
+        return run_group(load_subject, jobs, n_workers=n_workers, retries=retries, checkpoint_dir=checkpoint_dir,
+                         progress=progress, mp_context=mp_context)
+
+    @profiled('load_subjects')
+    def load_subjects(self, n_workers=None, retries=2, checkpoint_dir=None, progress=True, mp_context=None):
+        """
+        Loads every subject's metadata. Subjects that failed are left out of self.subjects and their errors (JobError
+        records) are kept in self.subject_errors.
+
+        Parameters
+        ----------
+        n_workers: int
+            Number of worker processes for the whole group. Default is one per available core
+        retries: int
+            Number of times to retry a subject that fails with an I/O error
+        checkpoint_dir: str
+            If given, each loaded subject is saved here and subjects already saved are not loaded again, so an
+            interrupted load can be resumed
+        progress: bool
+            Show a progress bar
+        mp_context: multiprocessing context
+            Context the worker processes are started with (see group.run_group). Default: the platform's
+        """
+        results = sorted(self.iter_subjects(n_workers, retries, checkpoint_dir, progress, mp_context),
+                         key=lambda r: r.index)
+        self.subjects = [r.value for r in results if r.error is None]
+        self.subject_errors = [r.error for r in results if r.error is not None]
+
+        if self.subject_errors:
+            print('\n\nErrors occured loading these Subjects:')
+            for error in self.subject_errors:
+                print('\t', 'Subject {}, Montage {} | {}: {}'.format(error.key[1], error.key[2], error.error_type,
+                                                                       error.message))
 
     def group_electrode_info(self):
-        subject_elec_dfs = []
-        for s in self.subjects:
-            subject_id = s.subject
-            elec_info = s.electrodes.copy(deep=False)
-            elec_info['subject'] = subject_id
-            subject_elec_dfs.append(elec_info)
-        self.electrodes = pd.concat(subject_elec_dfs)
-    
+        """
+        Builds self.electrodes, one categorical table of every loaded subject's electrodes (see GroupTable). Only
+        subjects not already in the table are added, so this can be called again after loading more subjects.
+        """
+        if self.electrode_table is None:
+            self.electrode_table = GroupTable()
+        done = set(self.electrode_table.subjects)
+        self.electrode_table.extend([(s.subject, s.montage, s.electrodes) for s in self.subjects
+                                     if (str(s.subject), int(s.montage)) not in done])
+        self.electrodes = self.electrode_table.table
+
     def group_stimulation_info(self):
-        subject_stim_dfs = []
-        for s in self.subjects:
-            subject_id = s.subject
-            stim_info = s.stimulation.copy(deep=False)
-            stim_info['subject'] = subject_id
-            subject_stim_dfs.append(stim_info)
-        self.stimulation = pd.concat(subject_stim_dfs)
+        """
+        Builds self.stimulation, one categorical table of every loaded subject's stimulation events (see GroupTable).
+        Only subjects not already in the table are added.
+        """
+        if self.stimulation_table is None:
+            self.stimulation_table = GroupTable()
+        done = set(self.stimulation_table.subjects)
+        self.stimulation_table.extend([(s.subject, s.montage, s.stimulation) for s in self.subjects
+                                       if (str(s.subject), int(s.montage)) not in done])
+        self.stimulation = self.stimulation_table.table
 
     
             
 
+@profiled()
+def load_subject(task, subject_id, montage_id, cache=None):
+    """
+    Returns a RAMSubjectData with its metadata loaded. One group job (see RAMGroupData.load_subjects)
+    """
+    subject = RAMSubjectData(task, subject_id, montage_id, cache=cache)
+    subject.load_metadata()
+    return subject
+
+
 #---------------------
 # RAM Load Functions
 
-# Get the R1 index dataframe 
-try:
-    r1_data = get_data_index("r1")
-except KeyError:
-    print('r1 protocol file not found')
-
 def load_subject_ids(task):
     """Returns a DataFrame with columns 'subject' and 'montage' listing participants in a given experiment.
 
@@ -187,8 +297,8 @@ def load_subject_ids(task):
 
     # if this is RAM task, load the subject/montage directly from the r1 database
     task = task.replace('RAM_', '')
-    if task in r1_data.experiment.unique():
-        df = r1_data[r1_data['experiment'] == task][['subject', 'montage']].drop_duplicates().reset_index(drop=True)
+    if r1_index.has_experiment(task):
+        df = r1_index.subjects_and_montages(task)
 
     # otherwise, need to look for *events.mat files in '/data/events/task
     else:
@@ -210,7 +320,8 @@ def load_subject_ids(task):
     return df
 
 
-def load_events_info(subject, task, montage, as_df=True, remove_no_eeg=False):
+def load_events_info(subject, task, montage, as_df=True, remove_no_eeg=False, cache=None, columns=None,
+                     event_types=None, n_workers=None, compact=False):
     """
     Returns a DataFrame of a subjects Events (label, time, metadata, ...) 
     Event labels can include: 
@@ -232,33 +343,33 @@ def load_events_info(subject, task, montage, as_df=True, remove_no_eeg=False):
         If true, the events will returned as a pandas.DataFrame, otherwise a numpy.recarray
     remove_no_eeg: bool
         If true, an events with missing 'eegfile' info will be removed. Recommended when you are doing EEG analyses
+    cache: TableCache
+        If given, each session's events are read from / saved to this cache
+    columns: list
+        Columns to keep. Default: all
+    event_types: list
+        Keep only events of these types (ex: ['WORD'] or ['STIM_ON', 'STIM_OFF'])
+    n_workers: int
+        Number of sessions read at once (see neuro.stim.events.load_task_events)
+    compact: bool
+        If true, string columns are categorical, numbers are downcast and stim_params is flattened into
+        'stim_params.<key>' columns. neuro.stim.events.expand_events gives back the usual layout
 
     Returns
     -------
     pandas.DataFrame
         A DataFrame of of the events
     """
-    # Format
-    task = task.replace('RAM_', '')
-
-    # Get sessions
-    inds = (r1_data['subject'] == subject) & (r1_data['experiment'] == task) & (r1_data['montage'] == int(montage))
-    sessions = r1_data[inds]['session'].unique()
-
-    # Load Events
-    events = pd.concat([CMLReader(subject=subject, experiment=task, session=session).load('events')
-                        for session in sessions])
-
-    # Options
-    if remove_no_eeg:
-        events = events[events.eegfile.apply(len) > 0]
+    # Load every session at once, filtered and projected as they are read
+    events = load_task_events(subject, task, montage, columns=columns, event_types=event_types,
+                              remove_no_eeg=remove_no_eeg, n_workers=n_workers, cache=cache, compact=compact)
     if not as_df:
         events = events.to_records(index=False)
-    
+
     return events
 
 
-def load_stimulation_info(events_df, electrodes_df, on_off = 'OFF'):
+def load_stimulation_info(events_df, electrodes_df, on_off = 'OFF', pair_on_off = False):
     """
     Returns a DataFrame of sitmulation events and metadata (time, location, stim_params, ...)
     
@@ -271,64 +382,11 @@ def load_stimulation_info(events_df, electrodes_df, on_off = 'OFF'):
     on_off : str
         Choose whether to filter by 'STIM_ON' or 'STIM_OFF' 
         Options: ['OFF', 'ON', 'BOTH']
+    pair_on_off : bool
+        If True, each STIM_OFF row also gets the mstime / eegoffset of the STIM_ON that started it and the stim
+        duration. See neuro.stim.stimulation.pair_stim_on_off
     """
-    # ON or OFF
-    if on_off.upper() ==  'OFF':
-        stim_events = events_df[events_df['type'] == 'STIM_OFF']
-    elif on_off.upper() == 'ON':
-        stim_events = events_df[events_df['type'] == 'STIM_OFF']
-    else:
-        stim_events = events_df[events_df['type'].isin(['STIM_ON', 'STIM_OFF'])]
-
-    # Parralelized - Get stim data
-    def load_single_stim(ievent, event, electrodes_df):
-        # Get stim event data
-        stim_params = event['stim_params'][0]
-        eegoffset = event['eegoffset']
-        mstime = event['mstime']
-
-        # Get bipolar label
-        anode = stim_params['anode_label']
-        cathode = stim_params['cathode_label']
-        bilabel = anode+'-'+cathode    
-        
-        # Get electrode & location data 
-        electrode = electrodes_df[electrodes_df['label'] == bilabel]
-        locs = []
-        for colname in electrode.columns:
-            if 'region' in colname:
-                loc = electrode[colname].values[0]
-                if type(loc) == str:
-                    locs.append(loc)
-        locs = tuple(locs)
-
-        x, y, z = electrode['avg.x'].values[0], electrode['avg.y'].values[0], electrode['avg.z'].values[0]                   
-        hemi = 'left' if x<0 else 'right'
-
-        # Save
-        res = {
-            'electrode' : bilabel,
-            'location' : locs,
-            'hemi' : hemi,
-            'x' : x,
-            'y' : y,
-            'z' : z,
-            'event_index' : ievent,
-            'event_name' : 'STIM_OFF',
-            'mstime' : mstime,
-            'eegoffset' : eegoffset
-        }
-        res.update(stim_params)
-        return res
-
-    res = Parallel(n_jobs = 12, verbose = 5)(delayed(load_single_stim)(ievent, event, electrodes_df) 
-                                                     for ievent, event in stim_events.iterrows())
-
-    # Make DF and return
-    stim_df = pd.DataFrame()
-    for stim_dict in res:
-        stim_df = stim_df.append(stim_dict, ignore_index = True)
-    return stim_df
+    return build_stimulation_table(events_df, electrodes_df, on_off=on_off, pair_on_off=pair_on_off)
 
 
 
@@ -354,155 +412,13 @@ def load_electrode_info(subject, montage=0, bipolar=False):
 
     """
 
-    ############################################################
-    # custom loading functions for different types of old data #
-    # this code used to be so much nicer before this :(        #
-    ############################################################
-    def load_loc_from_subject_tal_file(tal_path):
-        """
-        Load a subject's talaraich matlab file.
-        """
-        elec_raw = loadmat(tal_path, squeeze_me=True)
-        elec_raw = elec_raw[np.setdiff1d(list(elec_raw.keys()), ['__header__', '__version__', '__globals__'])[0]]
-
-        # sume of the data is in subarrays, flatten it, and make dataframe. Eeessh
-        # also rename some of the fields/columns
-        # make average surface dataframe
-        surf_data = []
-        exclude = []
-        if 'avgSurf' in elec_raw.dtype.names:
-            avg_surf = pd.concat([pd.DataFrame(index=[i], data=e) for (i, e) in enumerate(elec_raw['avgSurf'])],
-                                 sort=False)
-            avg_surf = avg_surf.rename(columns={x: 'avg.{}'.format(x) for x in avg_surf.columns})
-            surf_data.append(avg_surf)
-            exclude.append('avgSurf')
-
-        # make indiv surface dataframe
-        if 'indivSurf' in elec_raw.dtype.names:
-            ind_surf = pd.concat([pd.DataFrame(index=[i], data=e) for (i, e) in enumerate(elec_raw['indivSurf'])],
-                                 sort=False)
-            ind_surf = ind_surf.rename(columns={x: 'ind.{}'.format(x) for x in ind_surf.columns})
-            surf_data.append(ind_surf)
-            exclude.append('indivSurf')
-
-        # concat them, excluding the original subarrays
-        elec_df = pd.DataFrame.from_records(elec_raw, exclude=exclude)
-        elec_df = pd.concat([elec_df] + surf_data, axis='columns')
-
-        # add new columns for contacts, named the same as the json version
-        if bipolar:
-            elec_df['contact_1'], elec_df['contact_2'] = np.stack(elec_df['channel'], -1)
-            elec_df.drop(columns='channel')
-        return elec_df
-
-    def load_loc_from_tal_GM_file(subj_mont):
-        """
-        Load master data file of older subject talairach info and return just this subject
-        """
-        tal_master_data = loadmat('/data/eeg/tal/allTalLocs_GM.mat', squeeze_me=True)['events']
-        subj_tal = tal_master_data[tal_master_data['subject'] == subj_mont]
-        return pd.DataFrame(subj_tal)
-
-    def add_jacksheet_label(subj_mont):
-        """
-        Load the subject jacksheet in order to get the electrode labels
-        """
-        jacksheet_df = []
-        f = os.path.join('/data/eeg', subj_mont, 'docs', 'jacksheet.txt')
-        if os.path.exists(f):
-            jacksheet_df = pd.read_table(f, header=None, names=['channel', 'label'], sep=' ')
-            jacksheet_df['channel'] = jacksheet_df['channel'].astype(object)
-        return jacksheet_df
-
-    def add_depth_info(subj_mont):
-        """
-        Load the 'depth_el_info.txt' file in order to get depth elec localizations
-        """
-        depth_df = []
-        f = os.path.join('/data/eeg', subj_mont, 'docs', 'depth_el_info.txt')
-        if os.path.exists(f):
-            contacts = []
-            locs = []
-
-            # can't just read it in with pandas bc they use spaces as a column sep as well as in values wtf
-            with open(f, 'r') as depth_info:
-                for line in depth_info:
-                    line_split = line.split()
-
-                    # formatting of these files is not very consistent
-                    if len(line_split) > 2:
-
-                        # this is a weak check, but make sure we can cast the first entry to an int
-                        try:
-                            contact = int(line_split[0])
-                            contacts.append(contact)
-                            locs.append(' '.join(line_split[2:]))
-                        except ValueError:
-                            pass
-            depth_df = pd.DataFrame(data=[contacts, locs]).T
-            depth_df.columns = ['channel', 'locs']
-        return depth_df
-
-    def add_neuroad_info(subj_mont):
-        return
-
-    #######################################
-    # electrode loading logic begins here #
-    #######################################
-
     # check if this subject/montage is in r1. If it is, use cmlreaders to load it. Easy.
-    if np.any((r1_data['subject'] == subject) & (r1_data['montage'] == montage)):
+    if r1_index.has_montage(subject, montage):
         elec_df = CMLReader(subject=subject, montage=montage).load('pairs' if bipolar else 'contacts')
 
-    # if not in r1 protocol, annoying, there are multiple possible locations for matlab data
+    # if not in r1 protocol, annoying, there are multiple possible locations for matlab data. See legacy_loc
     else:
-
-        # Option 1: the subject as a talLoc.mat file within their own 'tal' directory
-        subj_mont = subject
-        if int(montage) != 0:
-            subj_mont = subject + '_' + str(montage)
-        file_str = '_bipol' if bipolar else '_monopol'
-        tal_path = os.path.join('/data/eeg', subj_mont, 'tal', subj_mont + '_talLocs_database' + file_str + '.mat')
-
-        if os.path.exists(tal_path):
-            elec_df = load_loc_from_subject_tal_file(tal_path)
-
-        # Option 2: there is no subject specific file, look in the older aggregate file. Lot's of steps.
-        else:
-            if bipolar:
-                print('Bipolar not supported for {}.'.format(subject))
-                return
-
-            # load subject specific data from master file
-            elec_df = load_loc_from_tal_GM_file(subj_mont)
-
-            # add electrode type column
-            e_type = np.array(['S'] * elec_df.shape[0])
-            e_type[np.in1d(elec_df.montage, ['hipp', 'inf'])] = 'D'
-            elec_df['type'] = e_type
-
-            # add labels from jacksheet
-            jacksheet_df = add_jacksheet_label(subj_mont)
-            if isinstance(jacksheet_df, pd.DataFrame):
-                elec_df = pd.merge(elec_df, jacksheet_df, on='channel', how='inner', left_index=False,
-                                   right_index=False)
-
-            # add depth_el_info (depth electrode localization)
-            depth_el_info_df = add_depth_info(subj_mont)
-            if isinstance(depth_el_info_df, pd.DataFrame):
-                elec_df = pd.merge(elec_df, depth_el_info_df, on='channel', how='outer', left_index=False,
-                                   right_index=False)
-
-                # to do
-                # also attempt to load additional information from the "neurorad_localization.txt" file, if exists
-
-        # relabel some more columns to be consistent
-        elec_df = elec_df.rename(columns={'channel': 'contact',
-                                          'tagName': 'label',
-                                          'eType': 'type'})
-
-        if 'label' not in elec_df:
-            elec_df['label'] = elec_df['contact'].apply(lambda x: 'elec_' + str(x))
+        elec_df = legacy_loc.load(subject, montage, bipolar)
 
     return elec_df
 
@@ -517,8 +433,10 @@ def load_raw_eeg(task, subject, session, elec_scheme):
     return CMLReader (subject = subject, experiment = task, session = session).load_eeg(scheme = elec_scheme).to_ptsa()
 
 
+@profiled()
 def load_events_eeg(events, rel_start_ms, rel_stop_ms, buf_ms=0, elec_scheme=None, noise_freq=[58., 62.],
-             resample_freq=None, pass_band=None, use_mirror_buf=False, demean=False, do_average_ref=False):
+             resample_freq=None, pass_band=None, use_mirror_buf=False, demean=False, do_average_ref=False,
+             chan_chunk=None, coalesce_gap_ms=None, reference=None, precision=None):
     """
     Returns an EEG TimeSeries object.
 
@@ -553,6 +471,20 @@ def load_events_eeg(events, rel_start_ms, rel_stop_ms, buf_ms=0, elec_scheme=Non
         If True, will subject the mean voltage between rel_start_ms and rel_stop_ms from each channel
     do_average_ref: bool
         If True, will compute the average reference based on the mean voltage across channels
+    chan_chunk: int
+        If given, filtering and resampling are run on this many channels at a time instead of all at once. Only needed
+        to limit memory on very large loads
+    coalesce_gap_ms: float
+        If given, epochs are read with the read planner (see read_planner): epochs in the same eeg file that overlap
+        or are at most this many ms apart are read in one sequential read and sliced apart. Same result, far fewer
+        reads for dense events like stim sessions
+    reference: str
+        If given, each monopolar contact elec_scheme needs is read once and the channels are computed from them (see
+        reref): 'bipolar' (elec_scheme must be pairs; same channels as reading the pairs, for about half the channel
+        reads on depth leads), 'average' or 'laplacian' (channels are the contacts of elec_scheme)
+    precision: PrecisionPolicy
+        dtype the eeg is computed in (float32 by default) and where upcasts are recorded (see precision). Also sets
+        chan_chunk, if not given, to keep the filters' float64 working copy within the policy's work_bytes
 
     Returns
     -------
@@ -564,8 +496,14 @@ def load_events_eeg(events, rel_start_ms, rel_stop_ms, buf_ms=0, elec_scheme=Non
 
     """
 
+    # cmlreaders needs the usual events layout, not the compact one
+    events = expand_events(events)
+
+    # with a reference, the monopolar contacts are read and the channels computed from them
+    read_scheme = elec_scheme if reference is None else monopolar_scheme(elec_scheme)
+
     # check if monopolar is possible for this subject
-    if 'contact' in elec_scheme:
+    if 'contact' in read_scheme:
         eegfile = np.unique(events.eegfile)[0]
         if os.path.splitext(eegfile)[1] == '.h5':
             eegfile = f'/protocols/r1/subjects/{events.iloc[0].subject}/experiments/{events.iloc[0].experiment}/sessions/{events.iloc[0].session}/ephys/current_processed/noreref/{eegfile}'
@@ -583,58 +521,179 @@ def load_events_eeg(events, rel_start_ms, rel_stop_ms, buf_ms=0, elec_scheme=Non
         actual_stop = rel_stop_ms
 
     # load eeg
-    eeg = CMLReader(subject=events.iloc[0].subject).load_eeg(events, rel_start=actual_start, rel_stop=actual_stop,
-                                                             scheme=elec_scheme).to_ptsa()
-
-    # now auto cast to float32 to help with memory issues with high sample rate data
-    eeg.data = eeg.data.astype('float32')
+    policy = get_policy(precision)
+    with span('read', n_events=len(events), n_channels=None if read_scheme is None else len(read_scheme)) as s:
+        if coalesce_gap_ms is not None:
+            eeg = load_planned_eeg(events, actual_start, actual_stop, elec_scheme=read_scheme,
+                                   max_gap_ms=coalesce_gap_ms, dtype=policy.compute if reference is None else None)
+        else:
+            eeg = CMLReader(subject=events.iloc[0].subject).load_eeg(events, rel_start=actual_start,
+                                                                     rel_stop=actual_stop, scheme=read_scheme).to_ptsa()
+        s.array(eeg)
+
+    # bipolar / average / laplacian channels from the monopolar contacts, all at once. Done on the data as read, so
+    # bipolar channels are the same as reading the pairs
+    if reference is not None:
+        with span('reref', reference=reference) as s:
+            eeg = s.array(rereference(eeg, elec_scheme, reference))
+
+    # now convert to the compute dtype (float32) to help with memory issues with high sample rate data. After each
+    # step below, anything that came back wider is cast back and recorded by the policy
+    with span('astype') as s:
+        eeg = s.array(policy.convert(eeg))
+    chan_chunk = policy.chan_chunk(eeg, chan_chunk)
 
     # baseline correct subracting the mean within the baseline time range
     if demean:
-        eeg = eeg.baseline_corrected([rel_start_ms, rel_stop_ms])
+        with span('demean'):
+            eeg = policy.cast(eeg.baseline_corrected([rel_start_ms, rel_stop_ms]), 'demean')
 
     # compute average reference by subracting the mean across channels
     if do_average_ref:
-        eeg = eeg - eeg.mean(dim='channel')
+        with span('average_ref'):
+            eeg = policy.cast(eeg - eeg.mean(dim='channel'), 'average_ref')
 
     # add mirror buffer if using. PTSA is expecting this to be in seconds.
     if use_mirror_buf:
-        eeg = eeg.add_mirror_buffer(buf_ms / 1000.)
+        with span('mirror_buffer'):
+            eeg = policy.cast(eeg.add_mirror_buffer(buf_ms / 1000.), 'mirror_buffer')
 
     # filter line noise
     if noise_freq is not None:
         #if isinstance(noise_freq[0], float):
         #    noise_freq = [noise_freq]
 
-        b_filter = ButterworthFilter(freq_range = noise_freq, filt_type ='stop', order = 4)
-        for this_chan in range(eeg.shape[1]):
-            this_eeg = eeg[:, this_chan:this_chan+1]
-            filtered_eeg = b_filter.filter(timeseries = this_eeg)
-            eeg[:, this_chan:this_chan+1] = filtered_eeg
-                
+        # all channels and events at once, in place
+        with span('line_noise'):
+            eeg = policy.cast(line_noise_filter(eeg, noise_freq, order=4, chan_chunk=chan_chunk), 'line_noise')
 
-    # resample if desired. Note: can be a bit slow especially if have a lot of eeg data
+    # resample if desired, all channels in one pass
     if resample_freq is not None:
-        eeg_resamp = []
-        for this_chan in range(eeg.shape[1]):
-            r_filter = ResampleFilter(eeg[:, this_chan:this_chan + 1], resample_freq)
-            eeg_resamp.append(r_filter.filter())
-        coords = {x: eeg[x] for x in eeg.coords.keys()}
-        coords['time'] = eeg_resamp[0]['time']
-        coords['samplerate'] = resample_freq
-        dims = eeg.dims
-        eeg = TimeSeries.create(np.concatenate(eeg_resamp, axis=1), resample_freq, coords=coords,
-                                dims=dims)
+        with span('resample', resample_freq=resample_freq) as s:
+            eeg = s.array(policy.cast(resample_timeseries(eeg, resample_freq, chan_chunk=chan_chunk), 'resample'))
 
     # do band pass if desired.
     if pass_band is not None:
-        eeg = band_pass_eeg(eeg, pass_band)
+        with span('band_pass'):
+            eeg = butterworth_filter(eeg, pass_band, filt_type='pass', order=4, chan_chunk=chan_chunk, inplace=True)
+            eeg = policy.cast(eeg, 'band_pass')
 
     # reorder dims to make events first
     eeg = make_events_first_dim(eeg)
     return eeg
 
 
+def window_groups(windows, buf_ms=0, max_gap_ms=0):
+    """
+    Groups named windows into the ranges of samples to read. Windows whose buffered ranges overlap, or are at most
+    max_gap_ms apart, share one range.
+
+    Parameters
+    ----------
+    windows: dict
+        {name: (rel_start_ms, rel_stop_ms)}
+    buf_ms: int
+        Buffer added to both ends of every window
+    max_gap_ms: int
+        Windows this close are read as one range, gap included. Reading a short gap is cheaper than a second read
+
+    Returns
+    -------
+    list
+        (rel_start_ms, rel_stop_ms, names) per range, in time order
+    """
+    buf_ms = buf_ms or 0
+    groups = []
+    for name in sorted(windows, key=lambda name: windows[name][0]):
+        rel_start_ms, rel_stop_ms = windows[name]
+        if rel_start_ms >= rel_stop_ms:
+            raise ValueError('Window {} starts at {} ms, after it stops at {} ms'.format(name, rel_start_ms,
+                                                                                      rel_stop_ms))
+        if groups and (rel_start_ms - buf_ms) - (groups[-1][1] + buf_ms) <= max_gap_ms:
+            groups[-1][1] = max(groups[-1][1], rel_stop_ms)
+            groups[-1][2].append(name)
+        else:
+            groups.append([rel_start_ms, rel_stop_ms, [name]])
+    return [tuple(group) for group in groups]
+
+
+def split_windows(eeg, windows, buf_ms=0):
+    """
+    Returns {name: TimeSeries} with each window's samples of eeg (buffer included, as load_events_eeg returns them).
+    The windows are views of eeg's data, not copies. Window edges snap to the nearest sample of eeg, so after
+    resampling a window can start up to half a sample away from where a load of that window alone would.
+
+    Parameters
+    ----------
+    eeg: TimeSeries
+        EEG covering every window, with time in ms
+    windows: dict
+        {name: (rel_start_ms, rel_stop_ms)}
+    buf_ms: int
+        Buffer kept on both ends of every window
+    """
+    buf_ms = buf_ms or 0
+    time = eeg['time'].values
+    half_sample_ms = 500. / float(eeg['samplerate'])
+    out = {}
+    for name, (rel_start_ms, rel_stop_ms) in windows.items():
+        first = np.searchsorted(time, rel_start_ms - buf_ms - half_sample_ms)
+        stop = np.searchsorted(time, rel_stop_ms + buf_ms - half_sample_ms)
+        out[name] = eeg.isel(time=slice(first, stop))
+    return out
+
+
+@profiled()
+def load_events_eeg_windows(events, windows, buf_ms=0, elec_scheme=None, noise_freq=[58., 62.], resample_freq=None,
+                            pass_band=None, do_average_ref=False, chan_chunk=None, max_gap_ms=0, coalesce_gap_ms=None,
+                            reference=None, precision=None, loader=None):
+    """
+    Returns event-locked EEG for several named windows (ex: pre-stim, post-stim and a sham baseline) as
+    {name: TimeSeries}, reading each contiguous range of samples once.
+
+    Windows whose buffered ranges overlap (see window_groups) are loaded with one load_events_eeg call over their
+    union, so they are read, filtered and resampled once, and each window is a view of that range. Calling
+    load_events_eeg once per window reads the shared samples once per window. Filtering the union gives a window's
+    edges real data instead of filter edge effects from its own bounds, so values near a window's edges differ
+    slightly from a single-window load; the buffer is there to absorb those edges either way.
+
+    Parameters
+    ----------
+    events: pandas.DataFrame
+        An events dataframe that contains eegoffset and eegfile fields
+    windows: dict
+        {name: (rel_start_ms, rel_stop_ms)}, times relative to the onset of each event
+    max_gap_ms: int
+        Windows whose buffered ranges are at most this far apart are read as one range. Default: only overlapping ones
+    loader: callable
+        If given, loader(rel_start_ms, rel_stop_ms) loads each range in place of load_events_eeg with the parameters
+        here (ex: RAMSubjectData.load_events_eeg_windows goes through its epoch store)
+
+    See load_events_eeg() for the other parameters. demean and use_mirror_buf are per window, so aren't available;
+    baseline_corrected() on a window does the former.
+
+    Returns
+    -------
+    dict
+        {name: TimeSeries}, in the order of windows, each events x channels x time with its buffer included. None if
+        the EEG couldn't be loaded
+    """
+    if loader is None:
+        def loader(rel_start_ms, rel_stop_ms):
+            return load_events_eeg(events, rel_start_ms, rel_stop_ms, buf_ms, elec_scheme, noise_freq, resample_freq,
+                                   pass_band, False, False, do_average_ref, chan_chunk, coalesce_gap_ms, reference,
+                                   precision)
+
+    out = {}
+    for rel_start_ms, rel_stop_ms, names in window_groups(windows, buf_ms, max_gap_ms):
+        with span('window_group', windows=names):
+            eeg = loader(rel_start_ms, rel_stop_ms)
+        if eeg is None:
+            return None
+        out.update(split_windows(eeg, {name: windows[name] for name in names}, buf_ms))
+    return {name: out[name] for name in windows}
+
+
 def make_events_first_dim(ts, event_dim_str='event'):
     """
     Transposes a TimeSeries object to have the events dimension first. Returns transposed object.
@@ -681,83 +740,22 @@ def clean_electrodes(elec_info, elec_column1='stein.region', elec_column2='ind.r
             Column specifying the x-coordinate of each electrode. Used to determine left vs right hemisphere.
             Positive values are right hemisphere.
         roi_dict: dict
-            A mapping of elec_column1/elec_column2 values to broader ROIs. If not given, the default will be used:
-
-            {'Hipp': ['Left CA1', 'Left CA2', 'Left CA3', 'Left DG', 'Left Sub', 'Right CA1', 'Right CA2',
-                                 'Right CA3', 'Right DG', 'Right Sub'],
-             'MTL': ['Left PRC', 'Right PRC', 'Right EC', 'Right PHC', 'Left EC', 'Left PHC'],
-             'Frontal': ['parsopercularis', 'parsorbitalis', 'parstriangularis', 'caudalmiddlefrontal',
-                                    'rostralmiddlefrontal', 'superiorfrontal'],
-            'Temporal': ['superiortemporal', 'middletemporal', 'inferiortemporal'],
-            'Parietal': ['inferiorparietal', 'supramarginal', 'superiorparietal', 'precuneus'],
-            'Occipital' ['lateraloccipital', 'lingual', 'cuneus', 'pericalcarine']}
+            A mapping of elec_column1/elec_column2 values to broader ROIs. If not given, roi.DETAILED_ROI_DICT is used
+            (hippocampal subfields, EC, MTL, frontal gyri and lobes). If a label is in more than one ROI, the last
+            one wins
 
 
         Returns
         -------
-        A pandas.DataFrame with columns 'region' and 'hemi'.
+        A pandas.DataFrame with columns 'label', 'region' and 'hemi' (categorical), and 'roi_mask' (see roi.py).
 
         """
 
-        # Region Labels
-        rls = [
-            'stein.region',
-            'ind.region',
-            'avg.region',
-            'mni.region',
-            'tal.region',
-            'vox.region',
-            'wb.region',
-            'das.region'
-        ]
-        
-        # smoosh the columns together, with the first column taking precedence
-        regions = elec_info[rls[0]].fillna(
-            elec_info[rls[1]]).fillna(
-            elec_info[rls[2]]).fillna(
-            elec_info[rls[3]]).fillna(
-            elec_info[rls[4]]).fillna(
-            elec_info[rls[5]]).fillna(
-            elec_info[rls[6]]).fillna(
-            elec_info[rls[7]]).fillna(
-            value='')
-
-        # if no dictionary is providing, use this
+        # every localization column, the first one with a label taking precedence, and the detailed ROIs
         if roi_dict is None:
-            roi_dict = {'Hipp': ['Left CA1', 'Left CA2', 'Left CA3', 'Right CA1', 'Right CA2',
-                                 'Right CA3'],
-                        'DG': ['Left DG', 'Right DG'],
-                        'Sub': ['Left Sub', 'Right Sub'],
-                        'EC': ['Right EC', 'Left EC'],
-                        'HippFormation': ['Left CA1', 'Left CA2', 'Left CA3', 'Right CA1', 'Right CA2',
-                                          'Right CA3', 'Left DG', 'Right DG', 'Left Sub', 'Right Sub'],
-                        'MTL': ['Left PRC', 'Right PRC', 'Right EC', 'Right PHC', 'Left EC', 'Left PHC'],
-                        'IFG': ['parsopercularis', 'parsorbitalis', 'parstriangularis'],  # This may contain Broca's Area
-                        'MFG': ['caudalmiddlefrontal', 'rostralmiddlefrontal'],  # This may contrain DLPFC
-                        'SFG': ['superiorfrontal'],
-                        'Frontal': ['parsopercularis', 'parsorbitalis', 'parstriangularis', 'caudalmiddlefrontal',
-                                    'rostralmiddlefrontal', 'superiorfrontal'],
-                        'Temporal': ['superiortemporal', 'middletemporal', 'inferiortemporal'],
-                        'Parietal': ['inferiorparietal', 'supramarginal', 'superiorparietal', 'precuneus'],
-                        'Occipital': ['lateraloccipital', 'lingual', 'cuneus', 'pericalcarine']}
-
-        # get ROI for each electrode. THIS GETS THE FIRST, IF IT IS IN MULTIPLE SOMEHOW
-        elec_region_list = [''] * len(regions)
-        for e, elec_region in enumerate(regions):
-            for roi in roi_dict.keys():
-                if elec_region in roi_dict[roi]:
-                    elec_region_list[e] = roi
-                    continue
-
-        # get hemisphere
-        elec_hemi_list = np.array(['right'] * len(regions))
-        elec_hemi_list[elec_info[x_coord_column] < 0] = 'left'
-
-        # make new DF
-        region_df = elec_info[['label']].copy()
-        region_df['region'] = elec_region_list
-        region_df['hemi'] = elec_hemi_list
-
+            roi_dict = DETAILED_ROI_DICT
+        region_df = RoiClassifier(roi_dict).classify(elec_info, REGION_COLUMNS, x_coord_column=x_coord_column,
+                                                     keep_columns=[])
         return region_df
 
 
@@ -779,53 +777,17 @@ def bin_electrodes_by_region(elec_info, elec_column1='stein.region', elec_column
             Column specifying the x-coordinate of each electrode. Used to determine left vs right hemisphere.
             Positive values are right hemisphere.
         roi_dict: dict
-            A mapping of elec_column1/elec_column2 values to broader ROIs. If not given, the default will be used:
-
-            {'Hipp': ['Left CA1', 'Left CA2', 'Left CA3', 'Left DG', 'Left Sub', 'Right CA1', 'Right CA2',
-                                 'Right CA3', 'Right DG', 'Right Sub'],
-             'MTL': ['Left PRC', 'Right PRC', 'Right EC', 'Right PHC', 'Left EC', 'Left PHC'],
-             'Frontal': ['parsopercularis', 'parsorbitalis', 'parstriangularis', 'caudalmiddlefrontal',
-                                    'rostralmiddlefrontal', 'superiorfrontal'],
-            'Temporal': ['superiortemporal', 'middletemporal', 'inferiortemporal'],
-            'Parietal': ['inferiorparietal', 'supramarginal', 'superiorparietal', 'precuneus'],
-            'Occipital' ['lateraloccipital', 'lingual', 'cuneus', 'pericalcarine']}
+            A mapping of elec_column1/elec_column2 values to broader ROIs. If not given, roi.DEFAULT_ROI_DICT is used
+            (Hipp, MTL and the four lobes). If a label is in more than one ROI, the last one wins
 
 
         Returns
         -------
-        A pandas.DataFrame with columns 'region' and 'hemi'.
+        A pandas.DataFrame with columns 'label', 'region' and 'hemi' (categorical), and 'roi_mask' (see roi.py).
 
         """
 
-        # smoosh the columns together, with the first column taking precedence
-        regions = elec_info[elec_column1].fillna(elec_info[elec_column2]).fillna(value='')
-
-        # if no dictionary is providing, use this
-        if roi_dict is None:
-            roi_dict = {'Hipp': ['Left CA1', 'Left CA2', 'Left CA3', 'Left DG', 'Left Sub', 'Right CA1', 'Right CA2',
-                                 'Right CA3', 'Right DG', 'Right Sub'],
-                        'MTL': ['Left PRC', 'Right PRC', 'Right EC', 'Right PHC', 'Left EC', 'Left PHC'],
-                        'Frontal': ['parsopercularis', 'parsorbitalis', 'parstriangularis', 'caudalmiddlefrontal',
-                                    'rostralmiddlefrontal', 'superiorfrontal'],
-                        'Temporal': ['superiortemporal', 'middletemporal', 'inferiortemporal'],
-                        'Parietal': ['inferiorparietal', 'supramarginal', 'superiorparietal', 'precuneus'],
-                        'Occipital': ['lateraloccipital', 'lingual', 'cuneus', 'pericalcarine']}
-
-        # get ROI for each electrode. THIS GETS THE FIRST, IF IT IS IN MULTIPLE SOMEHOW
-        elec_region_list = [''] * len(regions)
-        for e, elec_region in enumerate(regions):
-            for roi in roi_dict.keys():
-                if elec_region in roi_dict[roi]:
-                    elec_region_list[e] = roi
-                    continue
-
-        # get hemisphere
-        elec_hemi_list = np.array(['right'] * len(regions))
-        elec_hemi_list[elec_info[x_coord_column] < 0] = 'left'
-
-        # make new DF
-        region_df = elec_info[['label']].copy()
-        region_df['region'] = elec_region_list
-        region_df['hemi'] = elec_hemi_list
-
+        # elec_column1, falling back on elec_column2
+        region_df = RoiClassifier(roi_dict).classify(elec_info, [elec_column1, elec_column2],
+                                                     x_coord_column=x_coord_column, keep_columns=[])
         return region_df
\ No newline at end of file
@@ -1,9 +1,21 @@
-from cmlreaders import CMLReader, get_data_index
+from cmlreaders import CMLReader
 import pandas as pd
 import numpy as np
 import os 
 from glob import glob 
-from joblib import Parallel, delayed
+
+import dask
+import dask.array as da
+import xarray as xr
+
+from neuro.stim.events import load_task_events
+from neuro.stim.group import run_group
+from neuro.stim.group_tables import GroupTable
+from neuro.stim.legacy_loc import legacy_loc
+from neuro.stim.loaders import compute_power, load_eeg
+from neuro.stim.normalize import SessionStats
+from neuro.stim.r1_index import r1_index
+from neuro.stim.stimulation import build_stimulation_table
 
 
 
@@ -47,8 +59,19 @@ class RAMSubjectData:
         
         
     
-    def load_events_eeg(self):
-        pass
+    def load_events_eeg(self, events=None, rel_start_ms=-500, rel_stop_ms=1500, buf_ms=0, elec_scheme=None,
+                        noise_freq=[58., 62.], resample_freq=None, pass_band=None, chan_chunk=None):
+        """
+        Loads event-locked EEG into self.eeg (see loaders.load_eeg). Defaults to all events and self.electrodes.
+        For lazy, chunked EEG over a whole group see RAMGroupData.lazy_events_eeg.
+        """
+        if events is None:
+            events = self.events
+        if elec_scheme is None:
+            elec_scheme = self.electrodes
+        self.eeg = load_eeg(events, rel_start_ms, rel_stop_ms, buf_ms=buf_ms, elec_scheme=elec_scheme,
+                            noise_freq=noise_freq, resample_freq=resample_freq, pass_band=pass_band,
+                            chan_chunk=chan_chunk)
 
 class RAMGroupData:
     def __init__(self, task, subject_ids = None, montage_ids = None, subjects_and_montages = None):
@@ -66,68 +89,325 @@ class RAMGroupData:
         self.electrodes = None
         self.stimulation = None
 
+        # Group tables, appended to as subjects are added
+        self.electrode_table = None
+        self.stimulation_table = None
+
         # Errors
         self.subject_errors = None
 
         # Options
         
-    def load_subjects(self):
-        # Parallelize load
-        def load_subject(task, subject_id, montage_id):
-            try:
-                subject = RAMSubjectData(task, subject_id, montage_id)
-                subject.load_events_info()
-                subject.load_electrode_info()
-                subject.load_stimulation_info()
-            except Exception as e:
-                subject = f'Subject {subject_id}, Montage {montage_id} | Error: {e}'
-            return subject
-        
-        self.subjects = Parallel(n_jobs = 12, verbose = 5, backend='loky') \
-            (delayed(load_subject)(self.task, subject, montage) 
-            for subject, montage in zip(self.subject_ids, self.montage_ids))
-
-        errors = [] 
-        for subject in self.subjects:
-            if type (subject) == str:
-                errors.append(subject)
-        
-        print ('\n\nErrors occured loading these Subjects:')
-        for error in errors:
-            print('\t', error)
-            self.subjects.remove(error)
-        self.subject_errors = errors
-        
+    def load_subjects(self, n_workers=None, retries=2, checkpoint_dir=None, progress=True):
+        """
+        Loads every subject's events, electrodes and stimulation info in one process pool (see group.run_group).
+        Subjects that failed are left out of self.subjects and their JobError records are kept in self.subject_errors.
+        """
+        jobs = [((self.task, subject, montage), (self.task, subject, montage))
+                for subject, montage in zip(self.subject_ids, self.montage_ids)]
+        results = sorted(run_group(load_subject, jobs, n_workers=n_workers, retries=retries,
+                                   checkpoint_dir=checkpoint_dir, progress=progress), key=lambda r: r.index)
+        self.subjects = [r.value for r in results if r.error is None]
+        self.subject_errors = [r.error for r in results if r.error is not None]
+
+        if self.subject_errors:
+            print('\n\nErrors occured loading these Subjects:')
+            for error in self.subject_errors:
+                print('\t', 'Subject {}, Montage {} | {}: {}'.format(error.key[1], error.key[2], error.error_type,
+                                                                       error.message))
+
+    def _lazy_arrays(self, make_array, event_types, chan_block, region_column):
+        arrays = {}
+        for s in self.subjects:
+            events = s.events[s.events['eegfile'].str.len() > 0]
+            if event_types is not None:
+                events = events[events['type'].isin(list(event_types))]
+            if len(events) == 0:
+                continue
+            key = s.subject if int(s.montage) == 0 else '{}_{}'.format(s.subject, s.montage)
+            arrays[key] = make_array(events, s.electrodes, chan_block, region_column)
+        return arrays
+
+    def lazy_events_eeg(self, rel_start_ms, rel_stop_ms, resample_freq, event_types=None, buf_ms=0,
+                        noise_freq=[58., 62.], pass_band=None, chan_block=16, region_column=None):
+        """
+        Returns event-locked EEG for every loaded subject as lazy (dask backed) xarray DataArrays. Nothing is read until
+        the arrays (or something computed from them) are computed.
+
+        Parameters
+        ----------
+        rel_start_ms: int
+            Initial time (in ms), relative to the onset of each event
+        rel_stop_ms: int
+            End time (in ms), relative to the onset of each event
+        resample_freq: float
+            Sampling rate every subject is resampled to, so all arrays share one time axis
+        event_types: list
+            Event types to keep (ex: ['STIM_OFF']). Default is every event with eeg
+        buf_ms: float
+            Buffer (in ms) read and filtered on both sides of each event, then removed
+        noise_freq: list
+            Stop filter will be applied to the given range. Default=(58. 62)
+        pass_band: list
+            If given, the eeg will be band pass filtered in the given range
+        chan_block: int
+            Number of channels per chunk. Each chunk is one load from disk
+        region_column: str
+            Electrode column to add as a 'region' coordinate on the channel dim (ex: 'stein.region')
+
+        Returns
+        -------
+        dict
+            subject (or subject_montage) -> DataArray of events x channels x time, chunked by channel block
+        """
+        def make_array(events, electrodes, chan_block, region_column):
+            return lazy_subject_eeg(events, electrodes, rel_start_ms, rel_stop_ms, resample_freq, buf_ms=buf_ms,
+                                    noise_freq=noise_freq, pass_band=pass_band, chan_block=chan_block,
+                                    region_column=region_column)
+        return self._lazy_arrays(make_array, event_types, chan_block, region_column)
+
+    def lazy_power(self, freqs, wave_num, rel_start_ms, rel_stop_ms, event_types=None, buf_ms=1000,
+                   noise_freq=[58., 62.], resample_freq=None, time_bins=None, chan_block=16, region_column=None):
+        """
+        Returns log10 morlet wavelet power for every loaded subject as lazy (dask backed) xarray DataArrays, averaged
+        over time (or within time_bins). Each chunk is loaded and transformed with the batched FFT engine of
+        compute_power when computed.
+
+        Parameters are as for lazy_events_eeg() and compute_power().
+
+        Returns
+        -------
+        dict
+            subject (or subject_montage) -> DataArray of frequency x events x channels (x time, if time_bins),
+            chunked by channel block
+        """
+        def make_array(events, electrodes, chan_block, region_column):
+            return lazy_subject_power(events, electrodes, freqs, wave_num, rel_start_ms, rel_stop_ms, buf_ms=buf_ms,
+                                      noise_freq=noise_freq, resample_freq=resample_freq, time_bins=time_bins,
+                                      chan_block=chan_block, region_column=region_column)
+        return self._lazy_arrays(make_array, event_types, chan_block, region_column)
 
     def group_electrode_info(self):
-        subject_elec_dfs = []
-        for s in self.subjects:
-            subject_id = s.subject
-            elec_info = s.electrodes.copy(deep=False)
-            elec_info['subject'] = subject_id
-            subject_elec_dfs.append(elec_info)
-        self.electrodes = pd.concat(subject_elec_dfs)
-    
+        """
+        Builds self.electrodes, one categorical table of every loaded subject's electrodes (see GroupTable). Only
+        subjects not already in the table are added, so this can be called again after loading more subjects.
+        """
+        if self.electrode_table is None:
+            self.electrode_table = GroupTable()
+        done = set(self.electrode_table.subjects)
+        self.electrode_table.extend([(s.subject, s.montage, s.electrodes) for s in self.subjects
+                                     if (str(s.subject), int(s.montage)) not in done])
+        self.electrodes = self.electrode_table.table
+
     def group_stimulation_info(self):
-        subject_stim_dfs = []
-        for s in self.subjects:
-            subject_id = s.subject
-            stim_info = s.electrodes.copy(deep=False)
-            stim_info['subject'] = subject_id
-            subject_stim_dfs.append(stim_info)
-        self.electrodes = pd.concat(subject_stim_dfs)
+        """
+        Builds self.stimulation, one categorical table of every loaded subject's stimulation events (see GroupTable).
+        Only subjects not already in the table are added.
+        """
+        if self.stimulation_table is None:
+            self.stimulation_table = GroupTable()
+        done = set(self.stimulation_table.subjects)
+        self.stimulation_table.extend([(s.subject, s.montage, s.stimulation) for s in self.subjects
+                                       if (str(s.subject), int(s.montage)) not in done])
+        self.stimulation = self.stimulation_table.table
 
     
             
 
+def load_subject(task, subject_id, montage_id):
+    """
+    Returns a RAMSubjectData with events, electrodes and stimulation info loaded. One group job
+    """
+    subject = RAMSubjectData(task, subject_id, montage_id)
+    subject.load_events_info()
+    subject.load_electrode_info()
+    subject.load_stimulation_info()
+    return subject
+
+
 #---------------------
-# RAM Load Functions
+# Lazy group arrays
+#
+# Each subject's EEG or power is a dask array chunked by channel block. A chunk is one load_eeg (and, for power, one
+# batched FFT power computation) of every selected event of that subject for a block of channels, so nothing is read
+# until it is computed and only the chunks being worked on are in memory. Compute with the dask scheduler of your
+# choice, ex: dask.compute(..., scheduler='processes') to use every core of a node, or after starting a
+# distributed.Client(LocalCluster()).
+
+EVENT_COORDS = ['session', 'type', 'mstime', 'eegoffset']
+
+
+def _channel_slices(n_channels, chan_block):
+    return [slice(start, min(start + chan_block, n_channels)) for start in range(0, n_channels, chan_block)]
+
+
+def _fit_length(data, n_time):
+    """
+    Trims or NaN pads the last axis of data to n_time samples.
+    """
+    if data.shape[-1] >= n_time:
+        return data[..., :n_time]
+    pad = np.full(data.shape[:-1] + (n_time - data.shape[-1],), np.nan, dtype=data.dtype)
+    return np.concatenate([data, pad], axis=-1)
+
+
+def _eeg_block(events, elec_scheme, rel_start_ms, rel_stop_ms, resample_freq, buf_ms, noise_freq, pass_band, n_time):
+    """
+    Loads one subject x channel block of event EEG. Returns float32 events x channels x time, buffer removed.
+    """
+    eeg = load_eeg(events, rel_start_ms, rel_stop_ms, buf_ms=buf_ms, elec_scheme=elec_scheme, noise_freq=noise_freq,
+                   resample_freq=resample_freq, pass_band=pass_band)
+    eeg = eeg.transpose('event', 'channel', 'time')
+    buf = int(round(buf_ms * resample_freq / 1000.))
+    return _fit_length(np.asarray(eeg.data[..., buf:], dtype=np.float32), n_time)
+
 
-# get the r1 dataframe on import so we don't have to keep doing it
-try:
-    r1_data = get_data_index("r1")
-except KeyError:
-    print('r1 protocol file not found')
+def _power_block(events, elec_scheme, freqs, wave_num, rel_start_ms, rel_stop_ms, buf_ms, noise_freq, resample_freq,
+                 time_bins):
+    """
+    Computes power for one subject x channel block. Returns float32 frequency x events x channels (x bins).
+    """
+    wave_pow = compute_power(events, freqs, wave_num, rel_start_ms, rel_stop_ms, buf_ms=buf_ms,
+                             elec_scheme=elec_scheme, noise_freq=noise_freq, resample_freq=resample_freq,
+                             mean_over_time=time_bins is None, time_bins=time_bins, engine='fft')
+    dims = ['frequency', 'event', 'channel'] + (['time'] if time_bins is not None else [])
+    return np.asarray(wave_pow.transpose(*dims).data, dtype=np.float32)
+
+
+def _lazy_blocks(block_func, events, electrodes, chan_block, block_shape, chan_axis, *args):
+    """
+    Builds a dask array by concatenating one delayed block_func call per channel block along chan_axis.
+    """
+    events = dask.delayed(events, pure=True)
+    blocks = []
+    for chans in _channel_slices(len(electrodes), chan_block):
+        block = dask.delayed(block_func, pure=True)(events, electrodes.iloc[chans], *args)
+        blocks.append(da.from_delayed(block, shape=block_shape(chans.stop - chans.start), dtype=np.float32))
+    return da.concatenate(blocks, axis=chan_axis)
+
+
+def _event_channel_coords(events, electrodes, region_column):
+    coords = {'event': np.arange(len(events))}
+    for col in EVENT_COORDS:
+        if col in events:
+            coords[col] = ('event', events[col].to_numpy())
+    labels = electrodes['label'].to_numpy() if 'label' in electrodes else np.arange(len(electrodes))
+    coords['channel'] = labels
+    if region_column is not None:
+        coords['region'] = ('channel', electrodes[region_column].to_numpy())
+    return coords
+
+
+def lazy_subject_eeg(events, electrodes, rel_start_ms, rel_stop_ms, resample_freq, buf_ms=0, noise_freq=[58., 62.],
+                     pass_band=None, chan_block=16, region_column=None):
+    """
+    Returns one subject's event EEG as a lazy events x channels x time DataArray, chunked by channel block. Every
+    chunk has the same number of samples, (rel_stop_ms - rel_start_ms) at resample_freq.
+    """
+    n_time = int(round((rel_stop_ms - rel_start_ms) * resample_freq / 1000.))
+    data = _lazy_blocks(_eeg_block, events, electrodes, chan_block, lambda n: (len(events), n, n_time), 1,
+                        rel_start_ms, rel_stop_ms, resample_freq, buf_ms, noise_freq, pass_band, n_time)
+    coords = _event_channel_coords(events, electrodes, region_column)
+    coords['time'] = rel_start_ms + np.arange(n_time) * 1000. / resample_freq
+    return xr.DataArray(data, coords=coords, dims=('event', 'channel', 'time'),
+                        attrs={'subject': str(events['subject'].iloc[0]), 'samplerate': float(resample_freq)})
+
+
+def lazy_subject_power(events, electrodes, freqs, wave_num, rel_start_ms, rel_stop_ms, buf_ms=1000,
+                       noise_freq=[58., 62.], resample_freq=None, time_bins=None, chan_block=16, region_column=None):
+    """
+    Returns one subject's log10 power as a lazy frequency x events x channels (x time bins) DataArray, chunked by
+    channel block.
+    """
+    freqs = np.atleast_1d(np.asarray(freqs, dtype=float))
+    if time_bins is not None:
+        time_bins = np.asarray(time_bins, dtype=float).reshape(-1, 2)
+        block_shape = lambda n: (len(freqs), len(events), n, len(time_bins))
+    else:
+        block_shape = lambda n: (len(freqs), len(events), n)
+    data = _lazy_blocks(_power_block, events, electrodes, chan_block, block_shape, 2, freqs, wave_num,
+                        rel_start_ms, rel_stop_ms, buf_ms, noise_freq, resample_freq, time_bins)
+    coords = _event_channel_coords(events, electrodes, region_column)
+    coords['frequency'] = freqs
+    dims = ('frequency', 'event', 'channel')
+    if time_bins is not None:
+        coords['time'] = time_bins.mean(axis=1)
+        dims = dims + ('time',)
+    return xr.DataArray(data, coords=coords, dims=dims, attrs={'subject': str(events['subject'].iloc[0])})
+
+
+def mean_by_region(arrays, region_coord='region', dims=('event',)):
+    """
+    Lazily averages every subject's array over dims and over the channels in each region.
+
+    Parameters
+    ----------
+    arrays: dict
+        subject -> DataArray, from lazy_events_eeg() or lazy_power() (with a region coordinate)
+    region_coord: str
+        Coordinate on the channel dim holding each channel's region
+    dims: tuple
+        Dimensions to average over first (default: events)
+
+    Returns
+    -------
+    xarray.DataArray
+        subject x region x the remaining dims. NaN where a subject has no channels in a region
+    """
+    means = []
+    for subject, arr in arrays.items():
+        arr = arr.mean(dim=list(dims)) if dims else arr
+        means.append(arr.groupby(region_coord).mean('channel').expand_dims(subject=[subject]))
+    return xr.concat(means, dim='subject', join='outer')
+
+
+def stim_sham_contrast(arrays, is_stim, dim='event'):
+    """
+    Lazily computes mean(stim events) - mean(sham events) for every channel of every subject.
+
+    Parameters
+    ----------
+    arrays: dict
+        subject -> DataArray, from lazy_events_eeg() or lazy_power()
+    is_stim: str or dict
+        Name of a boolean event coordinate, or subject -> boolean array over events. True for stim, False for sham
+    dim: str
+        The event dimension
+
+    Returns
+    -------
+    xarray.DataArray
+        The contrast with every subject's channels concatenated along 'channel', with a 'subject' coordinate
+    """
+    contrasts = []
+    for subject, arr in arrays.items():
+        mask = np.asarray(arr[is_stim].values if isinstance(is_stim, str) else is_stim[subject], dtype=bool)
+        diff = arr.isel({dim: mask}).mean(dim) - arr.isel({dim: ~mask}).mean(dim)
+        contrasts.append(diff.assign_coords(subject=('channel', np.repeat(subject, arr.sizes['channel']))))
+    return xr.concat(contrasts, dim='channel')
+
+
+def _zscore_block(block, sessions, axis):
+    return SessionStats().fit_transform(block, sessions, axis=axis)
+
+
+def zscore_by_session(arr, session_coord='session', dim='event'):
+    """
+    Lazily z-scores a subject's array within each session, over events. Chunks stay per channel block; each holds all
+    of the subject's events, so every chunk is z-scored independently.
+
+    Returns
+    -------
+    xarray.DataArray
+    """
+    axis = arr.get_axis_num(dim)
+    sessions = np.asarray(arr[session_coord].values)
+    data = arr.data.rechunk({axis: -1})
+    return arr.copy(data=data.map_blocks(_zscore_block, sessions, axis, dtype=np.float32))
+
+
+#---------------------
+# RAM Load Functions
 
 def load_subject_ids(task):
     """Returns a DataFrame with columns 'subject' and 'montage' listing participants in a given experiment.
@@ -145,8 +425,8 @@ def load_subject_ids(task):
 
     # if this is RAM task, load the subject/montage directly from the r1 database
     task = task.replace('RAM_', '')
-    if task in r1_data.experiment.unique():
-        df = r1_data[r1_data['experiment'] == task][['subject', 'montage']].drop_duplicates().reset_index(drop=True)
+    if r1_index.has_experiment(task):
+        df = r1_index.subjects_and_montages(task)
 
     # otherwise, need to look for *events.mat files in '/data/events/task
     else:
@@ -168,7 +448,8 @@ def load_subject_ids(task):
     return df
 
 
-def load_events_info(subject, task, montage, as_df=True, remove_no_eeg=False):
+def load_events_info(subject, task, montage, as_df=True, remove_no_eeg=False, columns=None, event_types=None,
+                     n_workers=None):
     """
     Returns a DataFrame of a subjects Events (label, time, metadata, ...) 
     Event labels can include: 
@@ -190,33 +471,28 @@ def load_events_info(subject, task, montage, as_df=True, remove_no_eeg=False):
         If true, the events will returned as a pandas.DataFrame, otherwise a numpy.recarray
     remove_no_eeg: bool
         If true, an events with missing 'eegfile' info will be removed. Recommended when you are doing EEG analyses
+    columns: list
+        Columns to keep. Default: all
+    event_types: list
+        Keep only events of these types (ex: ['WORD'] or ['STIM_ON', 'STIM_OFF'])
+    n_workers: int
+        Number of sessions read at once (see neuro.stim.events.load_task_events)
 
     Returns
     -------
     pandas.DataFrame
         A DataFrame of of the events
     """
-    # Format
-    task = task.replace('RAM_', '')
-
-    # Get sessions
-    inds = (r1_data['subject'] == subject) & (r1_data['experiment'] == task) & (r1_data['montage'] == int(montage))
-    sessions = r1_data[inds]['session'].unique()
-
-    # Load Events
-    events = pd.concat([CMLReader(subject=subject, experiment=task, session=session).load('events')
-                        for session in sessions])
-
-    # Options
-    if remove_no_eeg:
-        events = events[events.eegfile.apply(len) > 0]
+    # Load every session at once, filtered and projected as they are read
+    events = load_task_events(subject, task, montage, columns=columns, event_types=event_types,
+                              remove_no_eeg=remove_no_eeg, n_workers=n_workers)
     if not as_df:
         events = events.to_records(index=False)
-    
+
     return events
 
 
-def load_stimulation_info(events_df, electrodes_df, on_off = 'OFF'):
+def load_stimulation_info(events_df, electrodes_df, on_off = 'OFF', pair_on_off = False):
     """
     Returns a DataFrame of sitmulation events and metadata (time, location, stim_params, ...)
     
@@ -229,62 +505,11 @@ def load_stimulation_info(events_df, electrodes_df, on_off = 'OFF'):
     on_off : str
         Choose whether to filter by 'STIM_ON' or 'STIM_OFF' 
         Options: ['OFF', 'ON', 'BOTH']
+    pair_on_off : bool
+        If True, each STIM_OFF row also gets the mstime / eegoffset of the STIM_ON that started it and the stim
+        duration. See neuro.stim.stimulation.pair_stim_on_off
     """
-    # ON or OFF
-    if on_off.upper() ==  'OFF':
-        stim_events = events_df[events_df['type'] == 'STIM_OFF']
-    elif on_off.upper() == 'ON':
-        stim_events = events_df[events_df['type'] == 'STIM_OFF']
-    else:
-        stim_events = events_df[events_df['type'].isin(['STIM_ON', 'STIM_OFF'])]
-
-    # Parralelized - Get stim data
-    def load_single_stim(ievent, event, electrodes_df):
-        # Get stim event data
-        stim_params = event['stim_params'][0]
-        eegoffset = event['eegoffset']
-        mstime = event['mstime']
-
-        # Get bipolar label
-        anode = stim_params['anode_label']
-        cathode = stim_params['cathode_label']
-        bilabel = anode+'-'+cathode    
-        
-        # Get electrode & location data 
-        electrode = electrodes_df[electrodes_df['label'] == bilabel]
-        locs = []
-        for colname in electrode.columns:
-            if 'region' in colname:
-                loc = electrode[colname].values[0]
-                if type(loc) == str:
-                    locs.append(loc)
-        x, y, z = electrode['avg.x'].values[0], electrode['avg.y'].values[0], electrode['avg.z'].values[0]                   
-        hemi = 'left' if x<0 else 'right'
-
-        # Save
-        res = {
-            'electrode' : bilabel,
-            'location' : locs,
-            'hemi' : hemi,
-            'x' : x,
-            'y' : y,
-            'z' : z,
-            'event_index' : ievent,
-            'event_name' : 'STIM_OFF',
-            'mstime' : mstime,
-            'eegoffset' : eegoffset
-        }
-        res.update(stim_params)
-        return res
-
-    res = Parallel(n_jobs = 12, verbose = 5)(delayed(load_single_stim)(ievent, event, electrodes_df) 
-                                                     for ievent, event in stim_events.iterrows())
-
-    # Make DF and return
-    stim_df = pd.DataFrame()
-    for stim_dict in res:
-        stim_df = stim_df.append(stim_dict, ignore_index = True)
-    return stim_df
+    return build_stimulation_table(events_df, electrodes_df, on_off=on_off, pair_on_off=pair_on_off)
 
 
 
@@ -310,154 +535,12 @@ def load_electrode_info(subject, montage=0, bipolar=True):
 
     """
 
-    ############################################################
-    # custom loading functions for different types of old data #
-    # this code used to be so much nicer before this :(        #
-    ############################################################
-    def load_loc_from_subject_tal_file(tal_path):
-        """
-        Load a subject's talaraich matlab file.
-        """
-        elec_raw = loadmat(tal_path, squeeze_me=True)
-        elec_raw = elec_raw[np.setdiff1d(list(elec_raw.keys()), ['__header__', '__version__', '__globals__'])[0]]
-
-        # sume of the data is in subarrays, flatten it, and make dataframe. Eeessh
-        # also rename some of the fields/columns
-        # make average surface dataframe
-        surf_data = []
-        exclude = []
-        if 'avgSurf' in elec_raw.dtype.names:
-            avg_surf = pd.concat([pd.DataFrame(index=[i], data=e) for (i, e) in enumerate(elec_raw['avgSurf'])],
-                                 sort=False)
-            avg_surf = avg_surf.rename(columns={x: 'avg.{}'.format(x) for x in avg_surf.columns})
-            surf_data.append(avg_surf)
-            exclude.append('avgSurf')
-
-        # make indiv surface dataframe
-        if 'indivSurf' in elec_raw.dtype.names:
-            ind_surf = pd.concat([pd.DataFrame(index=[i], data=e) for (i, e) in enumerate(elec_raw['indivSurf'])],
-                                 sort=False)
-            ind_surf = ind_surf.rename(columns={x: 'ind.{}'.format(x) for x in ind_surf.columns})
-            surf_data.append(ind_surf)
-            exclude.append('indivSurf')
-
-        # concat them, excluding the original subarrays
-        elec_df = pd.DataFrame.from_records(elec_raw, exclude=exclude)
-        elec_df = pd.concat([elec_df] + surf_data, axis='columns')
-
-        # add new columns for contacts, named the same as the json version
-        if bipolar:
-            elec_df['contact_1'], elec_df['contact_2'] = np.stack(elec_df['channel'], -1)
-            elec_df.drop(columns='channel')
-        return elec_df
-
-    def load_loc_from_tal_GM_file(subj_mont):
-        """
-        Load master data file of older subject talairach info and return just this subject
-        """
-        tal_master_data = loadmat('/data/eeg/tal/allTalLocs_GM.mat', squeeze_me=True)['events']
-        subj_tal = tal_master_data[tal_master_data['subject'] == subj_mont]
-        return pd.DataFrame(subj_tal)
-
-    def add_jacksheet_label(subj_mont):
-        """
-        Load the subject jacksheet in order to get the electrode labels
-        """
-        jacksheet_df = []
-        f = os.path.join('/data/eeg', subj_mont, 'docs', 'jacksheet.txt')
-        if os.path.exists(f):
-            jacksheet_df = pd.read_table(f, header=None, names=['channel', 'label'], sep=' ')
-            jacksheet_df['channel'] = jacksheet_df['channel'].astype(object)
-        return jacksheet_df
-
-    def add_depth_info(subj_mont):
-        """
-        Load the 'depth_el_info.txt' file in order to get depth elec localizations
-        """
-        depth_df = []
-        f = os.path.join('/data/eeg', subj_mont, 'docs', 'depth_el_info.txt')
-        if os.path.exists(f):
-            contacts = []
-            locs = []
-
-            # can't just read it in with pandas bc they use spaces as a column sep as well as in values wtf
-            with open(f, 'r') as depth_info:
-                for line in depth_info:
-                    line_split = line.split()
-
-                    # formatting of these files is not very consistent
-                    if len(line_split) > 2:
-
-                        # this is a weak check, but make sure we can cast the first entry to an int
-                        try:
-                            contact = int(line_split[0])
-                            contacts.append(contact)
-                            locs.append(' '.join(line_split[2:]))
-                        except ValueError:
-                            pass
-            depth_df = pd.DataFrame(data=[contacts, locs]).T
-            depth_df.columns = ['channel', 'locs']
-        return depth_df
-
-    def add_neuroad_info(subj_mont):
-        return
-
-    #######################################
-    # electrode loading logic begins here #
-    #######################################
-
     # check if this subject/montage is in r1. If it is, use cmlreaders to load it. Easy.
-    if np.any((r1_data['subject'] == subject) & (r1_data['montage'] == montage)):
+    if r1_index.has_montage(subject, montage):
         elec_df = CMLReader(subject=subject, montage=montage).load('pairs' if bipolar else 'contacts')
 
-    # if not in r1 protocol, annoying, there are multiple possible locations for matlab data
+    # if not in r1 protocol, annoying, there are multiple possible locations for matlab data. See legacy_loc
     else:
-
-        # Option 1: the subject as a talLoc.mat file within their own 'tal' directory
-        subj_mont = subject
-        if int(montage) != 0:
-            subj_mont = subject + '_' + str(montage)
-        file_str = '_bipol' if bipolar else '_monopol'
-        tal_path = os.path.join('/data/eeg', subj_mont, 'tal', subj_mont + '_talLocs_database' + file_str + '.mat')
-
-        if os.path.exists(tal_path):
-            elec_df = load_loc_from_subject_tal_file(tal_path)
-
-        # Option 2: there is no subject specific file, look in the older aggregate file. Lot's of steps.
-        else:
-            if bipolar:
-                print('Bipolar not supported for {}.'.format(subject))
-                return
-
-            # load subject specific data from master file
-            elec_df = load_loc_from_tal_GM_file(subj_mont)
-
-            # add electrode type column
-            e_type = np.array(['S'] * elec_df.shape[0])
-            e_type[np.in1d(elec_df.montage, ['hipp', 'inf'])] = 'D'
-            elec_df['type'] = e_type
-
-            # add labels from jacksheet
-            jacksheet_df = add_jacksheet_label(subj_mont)
-            if isinstance(jacksheet_df, pd.DataFrame):
-                elec_df = pd.merge(elec_df, jacksheet_df, on='channel', how='inner', left_index=False,
-                                   right_index=False)
-
-            # add depth_el_info (depth electrode localization)
-            depth_el_info_df = add_depth_info(subj_mont)
-            if isinstance(depth_el_info_df, pd.DataFrame):
-                elec_df = pd.merge(elec_df, depth_el_info_df, on='channel', how='outer', left_index=False,
-                                   right_index=False)
-
-                # to do
-                # also attempt to load additional information from the "neurorad_localization.txt" file, if exists
-
-        # relabel some more columns to be consistent
-        elec_df = elec_df.rename(columns={'channel': 'contact',
-                                          'tagName': 'label',
-                                          'eType': 'type'})
-
-        if 'label' not in elec_df:
-            elec_df['label'] = elec_df['contact'].apply(lambda x: 'elec_' + str(x))
+        elec_df = legacy_loc.load(subject, montage, bipolar)
 
     return elec_df
\ No newline at end of file
@@ -0,0 +1,8 @@
+"""
+Benchmarks of the stim EEG pipeline on a synthetic r1 protocol (see synthetic and run).
+
+    python -m neuro.stim.benchmarks --size small --out bench.json
+"""
+
+from neuro.stim.benchmarks.run import STAGES, compare, measure_stage, run_benchmarks
+from neuro.stim.benchmarks.synthetic import SIZES, SyntheticProtocol, make_spec
@@ -0,0 +1,3 @@
+from neuro.stim.benchmarks.run import main
+
+main()
@@ -0,0 +1,317 @@
+"""
+Times the stages of the stim EEG pipeline on a synthetic protocol, each in its own forked process, and saves wall
+time, CPU time and peak RSS as JSON. --compare shows the difference between two saved runs.
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from neuro.stim.benchmarks.synthetic import SIZES, SyntheticProtocol, make_spec
+
+# Power settings used by the power stages
+FREQS = np.logspace(np.log10(3), np.log10(180), 8)
+WAVE_NUM = 5
+
+
+# -- Stages --
+#
+# A stage is a function of the protocol returning (run, info): run() is what gets timed, and info is a dict describing
+# the work (sizes, shapes) saved with the timings. Anything done before returning is setup and isn't timed.
+
+def _first_subject(protocol):
+    from neuro.stim.RAMData import RAMSubjectData
+    subject, montage = protocol.subjects[0]
+    return RAMSubjectData(protocol.task, subject, montage)
+
+
+def _loaded_subject(protocol):
+    subject = _first_subject(protocol)
+    subject.load_events_info(as_df=True, remove_no_eeg=True)
+    subject.load_electrode_info(bipolar=False)
+    subject.load_electrode_bipolar_info()
+    return subject
+
+
+def stage_load_events_info(protocol):
+    from neuro.stim.RAMData import load_events_info
+    subject, montage = protocol.subjects[0]
+
+    def run():
+        return load_events_info(subject, protocol.task, montage, remove_no_eeg=True)
+    return run, {'n_sessions': protocol.spec['n_sessions']}
+
+
+def stage_load_events_info_compact(protocol):
+    from neuro.stim.RAMData import load_events_info
+    subject, montage = protocol.subjects[0]
+
+    def run():
+        return load_events_info(subject, protocol.task, montage, remove_no_eeg=True, compact=True)
+    return run, {'n_sessions': protocol.spec['n_sessions']}
+
+
+def stage_load_electrode_info(protocol):
+    from neuro.stim.RAMData import load_electrode_info
+    subject, montage = protocol.subjects[0]
+
+    def run():
+        return load_electrode_info(subject, montage, bipolar=False), load_electrode_info(subject, montage, bipolar=True)
+    return run, {'n_contacts': protocol.spec['n_contacts']}
+
+
+def stage_load_stimulation_info(protocol):
+    from neuro.stim.RAMData import load_stimulation_info
+    subject = _loaded_subject(protocol)
+
+    def run():
+        return load_stimulation_info(subject.events, subject.electrodes_bipolar, on_off='OFF')
+    return run, {'n_events': len(subject.events)}
+
+
+def _word_events(subject):
+    return subject.events[subject.events['type'] == 'WORD']
+
+
+def stage_load_events_eeg(protocol):
+    subject = _loaded_subject(protocol)
+    events = _word_events(subject)
+
+    def run():
+        subject.load_events_eeg(events, rel_start_ms=-500, rel_stop_ms=1500, buf_ms=1000,
+                                elec_scheme=subject.electrodes_bipolar, resample_freq=250.)
+        return subject.eeg
+    return run, {'n_events': len(events), 'n_channels': len(subject.electrodes_bipolar)}
+
+
+def _compute_power(protocol, engine):
+    from neuro.stim.loaders import compute_power
+    subject = _loaded_subject(protocol)
+    events = _word_events(subject)
+
+    def run():
+        return compute_power(events, FREQS, WAVE_NUM, rel_start_ms=0, rel_stop_ms=1500, buf_ms=1000,
+                             elec_scheme=subject.electrodes_bipolar, resample_freq=500., engine=engine)
+    return run, {'n_events': len(events), 'n_channels': len(subject.electrodes_bipolar), 'n_freqs': len(FREQS)}
+
+
+def stage_compute_power_fft(protocol):
+    return _compute_power(protocol, 'fft')
+
+
+def stage_compute_power_ptsa(protocol):
+    return _compute_power(protocol, 'ptsa')
+
+
+def stage_load_subjects(protocol):
+    from neuro.stim.RAMData import RAMGroupData
+    subjects = [s for s, _ in protocol.subjects]
+    montages = [m for _, m in protocol.subjects]
+    n_workers = min(len(subjects), os.cpu_count() or 1)
+
+    def run():
+        # forked, so the workers see the synthetic CMLReader (spawn / forkserver workers would import the real one)
+        group = RAMGroupData(protocol.task, subject_ids=subjects, montage_ids=montages)
+        group.load_subjects(n_workers=n_workers, progress=False, mp_context=multiprocessing.get_context('fork'))
+        if group.subject_errors:
+            raise RuntimeError('{} subjects failed: {}'.format(len(group.subject_errors), group.subject_errors[0]))
+        return group.subjects
+    return run, {'n_subjects': len(subjects), 'n_workers': n_workers}
+
+
+STAGES = {
+    'load_events_info': stage_load_events_info,
+    'load_events_info_compact': stage_load_events_info_compact,
+    'load_electrode_info': stage_load_electrode_info,
+    'load_stimulation_info': stage_load_stimulation_info,
+    'load_events_eeg': stage_load_events_eeg,
+    'compute_power_fft': stage_compute_power_fft,
+    'compute_power_ptsa': stage_compute_power_ptsa,
+    'load_subjects': stage_load_subjects,
+}
+
+# compute_power_ptsa is slow, ask for it by name
+DEFAULT_STAGES = [name for name in STAGES if name != 'compute_power_ptsa']
+
+
+# -- Measuring --
+
+def peak_rss_mb(who=resource.RUSAGE_SELF):
+    """
+    Peak resident set size of this process (or of its finished children) so far, in MB.
+    """
+    peak = resource.getrusage(who).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / (1024. ** 2 if sys.platform == 'darwin' else 1024.)
+
+
+def _cpu_s():
+    self_usage = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return self_usage.ru_utime + self_usage.ru_stime + children.ru_utime + children.ru_stime
+
+
+def _describe(value):
+    """
+    Shape, dtype and bytes of a stage's output, where it has them.
+    """
+    if isinstance(value, (list, tuple)):
+        return [_describe(v) for v in value]
+    out = {'type': type(value).__name__}
+    for attr in ['shape', 'dtype', 'nbytes']:
+        if hasattr(value, attr):
+            v = getattr(value, attr)
+            out[attr] = list(v) if attr == 'shape' else (str(v) if attr == 'dtype' else int(v))
+    if hasattr(value, 'memory_usage') and hasattr(value, 'columns'):
+        out['nbytes'] = int(value.memory_usage(deep=True).sum())
+    return out
+
+
+def measure_stage(name, spec, repeat=1):
+    """
+    Runs one stage repeat times on a fresh synthetic protocol. Returns a dict of timings, or of the error.
+    """
+    protocol = SyntheticProtocol(spec)
+    with protocol.installed():
+        try:
+            rss_before = peak_rss_mb()
+            run, info = STAGES[name](protocol)
+            runs = []
+            for _ in range(repeat):
+                cpu_start, wall_start = _cpu_s(), time.perf_counter()
+                output = run()
+                runs.append({'wall_s': time.perf_counter() - wall_start, 'cpu_s': _cpu_s() - cpu_start})
+            best = min(runs, key=lambda r: r['wall_s'])
+            return {'name': name, 'wall_s': best['wall_s'], 'cpu_s': best['cpu_s'], 'runs': runs,
+                    'peak_rss_mb': peak_rss_mb(), 'setup_peak_rss_mb': rss_before,
+                    'children_peak_rss_mb': peak_rss_mb(resource.RUSAGE_CHILDREN), 'info': info,
+                    'output': _describe(output)}
+        except Exception as e:
+            return {'name': name, 'error': '{}: {}'.format(type(e).__name__, e), 'traceback': traceback.format_exc()}
+
+
+def _git_commit():
+    try:
+        root = os.path.dirname(os.path.abspath(__file__))
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=root, stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(size='small', stages=None, repeat=1, isolate=True, out=None, **spec_overrides):
+    """
+    Runs benchmark stages on a synthetic protocol.
+
+    Parameters
+    ----------
+    size: str or dict
+        One of SIZES, or a spec dict
+    stages: list
+        Names of the stages to run (see STAGES). Default: DEFAULT_STAGES
+    repeat: int
+        Times to run each stage. The fastest run is reported
+    isolate: bool
+        Run each stage in its own forked process so its peak RSS is its own
+    out: str
+        If given, the results are written here as JSON
+    spec_overrides:
+        Changes to the size's settings (ex: n_contacts=200, latency_s=0.05)
+
+    Returns
+    -------
+    dict
+        Environment, spec and one entry per stage
+    """
+    spec = make_spec(size, **spec_overrides)
+    stages = DEFAULT_STAGES if stages is None else stages
+    unknown = [name for name in stages if name not in STAGES]
+    if unknown:
+        raise ValueError('Unknown stages {}. Choose from {}'.format(unknown, list(STAGES)))
+
+    results = []
+    for name in stages:
+        if isolate:
+            context = multiprocessing.get_context('fork')
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+                result = pool.submit(measure_stage, name, spec, repeat).result()
+        else:
+            result = measure_stage(name, spec, repeat)
+        results.append(result)
+        print(format_result(result))
+
+    report = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'git_commit': _git_commit(),
+        'host': platform.node(),
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'cpu_count': os.cpu_count(),
+        'size': size if isinstance(size, str) else None,
+        'spec': spec,
+        'repeat': repeat,
+        'isolate': isolate,
+        'stages': results,
+    }
+    if out is not None:
+        with open(out, 'w') as f:
+            json.dump(report, f, indent=2, default=str)
+    return report
+
+
+def format_result(result):
+    if 'error' in result:
+        return '{:<28} ERROR {}'.format(result['name'], result['error'])
+    return '{:<28} {:>9.3f} s wall {:>9.3f} s cpu {:>9.1f} MB peak'.format(result['name'], result['wall_s'],
+                                                                        result['cpu_s'], result['peak_rss_mb'])
+
+
+def compare(old, new):
+    """
+    Returns a table (list of strings) of the change in wall time and peak RSS of each stage between two results (dicts
+    or JSON paths).
+    """
+    old, new = [json.load(open(r)) if isinstance(r, str) else r for r in (old, new)]
+    old_stages = {s['name']: s for s in old['stages'] if 'error' not in s}
+    lines = ['{:<28} {:>10} {:>10} {:>8} {:>10} {:>10}'.format('stage', 'old s', 'new s', 'ratio', 'old MB', 'new MB')]
+    for stage in new['stages']:
+        name = stage['name']
+        if ('error' in stage) or (name not in old_stages):
+            continue
+        before = old_stages[name]
+        lines.append('{:<28} {:>10.3f} {:>10.3f} {:>8.2f} {:>10.1f} {:>10.1f}'.format(
+            name, before['wall_s'], stage['wall_s'], stage['wall_s'] / max(before['wall_s'], 1e-9),
+            before['peak_rss_mb'], stage['peak_rss_mb']))
+    return lines
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the stim EEG pipeline on synthetic data.')
+    parser.add_argument('--size', default='small', choices=list(SIZES))
+    parser.add_argument('--stages', nargs='+', default=None, help='Stages to run: {}'.format(', '.join(STAGES)))
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--no-isolate', action='store_true', help='Run every stage in this process')
+    parser.add_argument('--latency', type=float, default=0., help='Seconds added to every table read')
+    parser.add_argument('--out', default=None, help='JSON file to write the results to')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='Compare two result files and exit')
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        print('\n'.join(compare(*args.compare)))
+        return
+    run_benchmarks(args.size, stages=args.stages, repeat=args.repeat, isolate=not args.no_isolate, out=args.out,
+                   latency_s=args.latency)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,313 @@
+"""
+A seeded synthetic r1 protocol (index, events, electrode tables and EEG) served by a CMLReader stand-in, so the
+loading pipeline can run without the protocols filesystem.
+"""
+
+import importlib
+import time
+import zlib
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+
+from ptsa.data.timeseries import TimeSeries
+
+from neuro.stim.r1_index import r1_index
+from neuro.stim.roi import SUBJECT_FILTER_ROI_DICT
+
+# Sizes of the synthetic protocol. Channel counts, sample rates and session lengths are in the range of the r1 data
+SIZES = {
+    'small': {'n_subjects': 2, 'n_sessions': 2, 'n_word_events': 150, 'n_stim_events': 50, 'n_contacts': 64,
+              'samplerate': 500., 'session_minutes': 30., 'n_stim_sites': 2},
+    'medium': {'n_subjects': 4, 'n_sessions': 4, 'n_word_events': 300, 'n_stim_events': 100, 'n_contacts': 128,
+               'samplerate': 1000., 'session_minutes': 45., 'n_stim_sites': 3},
+    'large': {'n_subjects': 8, 'n_sessions': 8, 'n_word_events': 300, 'n_stim_events': 150, 'n_contacts': 160,
+              'samplerate': 1000., 'session_minutes': 60., 'n_stim_sites': 4},
+}
+
+# Defaults for the settings not in a size
+DEFAULT_SPEC = {'task': 'PS3', 'contacts_per_lead': 8, 'latency_s': 0., 'seed': 0}
+
+# modules that import CMLReader by name, and so need it replaced in their namespace
+CMLREADER_MODULES = ['neuro.stim.loaders', 'neuro.stim.events', 'neuro.stim.eeg_stream', 'neuro.stim.RAMData',
+                     'neuro.stim.RAMData_dask_PP', 'neuro.stim.ram_loaders', 'neuro.stim.read_planner']
+
+REGION_LABELS = sorted(set(label for labels in SUBJECT_FILTER_ROI_DICT.values() for label in labels))
+
+
+def make_spec(size='small', **overrides):
+    """
+    Returns the settings of a synthetic protocol: one of SIZES, with DEFAULT_SPEC and any overrides.
+    """
+    spec = dict(DEFAULT_SPEC)
+    spec.update(SIZES[size] if isinstance(size, str) else size)
+    spec.update(overrides)
+    return spec
+
+
+class SyntheticProtocol:
+    """
+    Generates and serves the data of a synthetic r1 protocol.
+
+    Parameters
+    ----------
+    spec: dict
+        Settings, from make_spec()
+    """
+    def __init__(self, spec):
+        self.spec = make_spec(spec) if isinstance(spec, str) else dict(spec)
+        self.task = self.spec['task']
+        self.subjects = [('R1{:03d}S'.format(i + 1), 0) for i in range(self.spec['n_subjects'])]
+
+        # generated on first use
+        self._tables = {}
+
+        # contacts read by eeg(), one per contact per read (a bipolar read counts each contact of its pairs once)
+        self.contact_reads = 0
+
+    @property
+    def n_samples(self):
+        return int(self.spec['session_minutes'] * 60 * self.spec['samplerate'])
+
+    def _rng(self, *key):
+        # crc32 rather than hash(), which changes between processes for strings
+        return np.random.default_rng([self.spec['seed']] + [zlib.crc32(str(k).encode()) for k in key])
+
+    def _table(self, key, builder):
+        if key not in self._tables:
+            self._tables[key] = builder()
+        return self._tables[key].copy()
+
+    # -- Tables --
+
+    def index(self):
+        """
+        The r1 index: one row per subject / session.
+        """
+        rows = [{'subject': subject, 'experiment': self.task, 'session': session, 'montage': montage,
+                 'localization': 0, 'original_session': session}
+                for subject, montage in self.subjects for session in range(self.spec['n_sessions'])]
+        return pd.DataFrame(rows)
+
+    def contacts(self, subject):
+        """
+        Monopolar contacts: leads of contacts_per_lead contacts, with regions and coordinates.
+        """
+        def build():
+            rng = self._rng('contacts', subject)
+            n, per_lead = self.spec['n_contacts'], self.spec['contacts_per_lead']
+            lead = np.arange(n) // per_lead
+            left = lead % 2 == 0
+            names = np.array(['{}{}'.format('L' if lf else 'R', chr(ord('A') + (ld // 2) % 26))
+                              for ld, lf in zip(lead, left)])
+            regions = rng.choice(REGION_LABELS, n)
+            x = np.where(left, -1., 1.) * rng.uniform(5, 60, n)
+            df = pd.DataFrame({
+                'contact': np.arange(1, n + 1),
+                'label': [name + str(i % per_lead + 1) for i, name in enumerate(names)],
+                'type': 'D',
+                'stein.region': np.where(rng.random(n) < 0.3, regions, None),
+                'ind.region': regions,
+                'avg.region': regions,
+            })
+            for prefix in ['ind', 'avg']:
+                df[prefix + '.x'] = x
+                df[prefix + '.y'] = rng.normal(0, 20, n)
+                df[prefix + '.z'] = rng.normal(0, 20, n)
+            return df
+        return self._table(('contacts', subject), build)
+
+    def pairs(self, subject):
+        """
+        Bipolar pairs of neighbouring contacts on each lead.
+        """
+        def build():
+            contacts = self.contacts(subject)
+            per_lead = self.spec['contacts_per_lead']
+            first = contacts.iloc[[i for i in range(len(contacts) - 1) if (i + 1) % per_lead != 0]]
+            second = contacts.iloc[first.index + 1]
+            df = pd.DataFrame({
+                'contact_1': first['contact'].to_numpy(),
+                'contact_2': second['contact'].to_numpy(),
+                'label': first['label'].to_numpy() + '-' + second['label'].to_numpy(),
+                'type': 'D',
+            })
+            for col in ['stein.region', 'ind.region', 'avg.region']:
+                df[col] = first[col].to_numpy()
+            for col in ['ind.x', 'ind.y', 'ind.z', 'avg.x', 'avg.y', 'avg.z']:
+                df[col] = (first[col].to_numpy() + second[col].to_numpy()) / 2.
+            return df
+        return self._table(('pairs', subject), build)
+
+    def stim_sites(self, subject):
+        pairs = self.pairs(subject)
+        rng = self._rng('sites', subject)
+        rows = rng.choice(len(pairs), self.spec['n_stim_sites'], replace=False)
+        return pairs.iloc[np.sort(rows)]
+
+    def events(self, subject, session):
+        """
+        One session's events: word presentations and stim on / off pairs spread over the session.
+        """
+        def build():
+            rng = self._rng('events', subject, session)
+            spec = self.spec
+            n_word, n_stim = spec['n_word_events'], spec['n_stim_events']
+            samplerate = spec['samplerate']
+
+            # event onsets, leaving room for 5 s windows at both ends
+            margin = int(5 * samplerate)
+            onsets = np.sort(rng.choice(np.arange(margin, self.n_samples - margin, int(samplerate // 4)),
+                                        n_word + n_stim, replace=False))
+            is_stim = np.zeros(len(onsets), dtype=bool)
+            is_stim[rng.choice(len(onsets), n_stim, replace=False)] = True
+
+            sites = self.stim_sites(subject)
+            rows = []
+            for onset, stim in zip(onsets, is_stim):
+                if stim:
+                    site = sites.iloc[rng.integers(len(sites))]
+                    anode, cathode = site['label'].split('-')
+                    params = [{'anode_label': anode, 'cathode_label': cathode,
+                               'amplitude': float(rng.choice([.5, 1., 1.5])), 'pulse_freq': 200,
+                               'stim_duration': 500, 'burst_freq': 8, 'n_bursts': 4,
+                               'anode_number': int(site['contact_1']), 'cathode_number': int(site['contact_2']),
+                               'pulse_width': 300, 'stim_on': True}]
+                    rows.append(('STIM_ON', onset, params))
+                    rows.append(('STIM_OFF', onset + int(.5 * samplerate), params))
+                else:
+                    rows.append(('WORD', onset, []))
+            types, offsets, params = zip(*rows)
+            offsets = np.array(offsets)
+            n = len(rows)
+            return pd.DataFrame({
+                'subject': subject,
+                'experiment': self.task,
+                'session': session,
+                'montage': 0,
+                'protocol': 'r1',
+                'type': np.array(types, dtype=object),
+                'eegoffset': offsets,
+                'mstime': 1.5e12 + session * 1e8 + offsets * 1000. / samplerate,
+                'eegfile': '{}_{}_{}_synthetic'.format(subject, self.task, session),
+                'list': np.minimum(np.arange(n) * 26 // n, 25),
+                'serialpos': np.arange(n) % 12,
+                'item_name': np.where(np.array(types) == 'WORD', rng.choice(['APPLE', 'BOAT', 'CHAIR', 'DOG'], n),
+                                      'X'),
+                'recalled': rng.random(n) < .3,
+                'stim_params': list(params),
+            })
+        return self._table(('events', subject, session), build)
+
+    def sources(self):
+        return {'sample_rate': self.spec['samplerate'], 'n_samples': self.n_samples, 'data_format': 'float32',
+                'n_channels': self.spec['n_contacts']}
+
+    # -- EEG --
+
+    def eeg(self, events, rel_start, rel_stop, scheme=None, subject=None):
+        """
+        Returns a TimeSeries (event x channel x time) of noise plus a theta rhythm for the events and channels. Bipolar
+        channels are the difference of their two contacts, as a reader would compute them.
+        """
+        samplerate = self.spec['samplerate']
+        start = int(np.round(rel_start * samplerate / 1000.))
+        n_time = int(np.round((rel_stop - rel_start) * samplerate / 1000.))
+        if scheme is None:
+            scheme = self.contacts(subject or events.iloc[0]['subject'])
+        labels = scheme['label'].to_numpy()
+
+        sample = np.asarray(events['eegoffset'])[:, None] + start + np.arange(n_time)
+        if 'contact_1' in scheme:
+            first, second = scheme['contact_1'].to_numpy(), scheme['contact_2'].to_numpy()
+            data = self._signal(sample, first) - self._signal(sample, second)
+            self.contact_reads += len(np.union1d(first, second))
+        else:
+            data = self._signal(sample, scheme['contact'].to_numpy())
+            self.contact_reads += len(scheme)
+
+        time_ms = (start + np.arange(n_time)) * 1000. / samplerate
+        coords = {'event': events.to_records(index=False), 'channel': labels, 'time': time_ms}
+        return TimeSeries.create(data, samplerate, coords=coords, dims=('event', 'channel', 'time'))
+
+    def _signal(self, sample, contacts):
+        """
+        Returns event x contact x time float32 samples, a function of the absolute sample and contact number only, so
+        overlapping reads return the same values.
+        """
+        contact = np.asarray(contacts, dtype=np.float64)[:, None]
+        data = np.empty((len(sample), len(contact), sample.shape[1]), dtype=np.float32)
+        for i, s in enumerate(sample):
+            noise = np.sin(s * 12.9898 + contact * 78.233) * 43758.5453
+            data[i] = 20. * (noise - np.floor(noise) - .5 +
+                             2 * np.sin(2 * np.pi * 6 * s / self.spec['samplerate'] + contact))
+        return data
+
+    # -- Serving --
+
+    def reader(self):
+        """
+        Returns a CMLReader stand-in class that serves this protocol.
+        """
+        protocol = self
+
+        class SyntheticCMLReader:
+            def __init__(self, subject=None, experiment=None, session=None, localization=0, montage=0, **kwargs):
+                self.subject = subject
+                self.experiment = experiment
+                self.session = session
+                self.montage = montage
+
+            def load(self, data_type):
+                if protocol.spec['latency_s']:
+                    time.sleep(protocol.spec['latency_s'])
+                if data_type == 'events':
+                    return protocol.events(self.subject, self.session)
+                if data_type == 'contacts':
+                    return protocol.contacts(self.subject)
+                if data_type == 'pairs':
+                    return protocol.pairs(self.subject)
+                if data_type == 'sources':
+                    return protocol.sources()
+                raise ValueError('SyntheticCMLReader has no {}'.format(data_type))
+
+            def load_eeg(self, events=None, rel_start=None, rel_stop=None, scheme=None, **kwargs):
+                ts = protocol.eeg(events, rel_start, rel_stop, scheme, subject=self.subject)
+                return _Container(ts)
+
+        return SyntheticCMLReader
+
+    @contextmanager
+    def installed(self):
+        """
+        Context manager that makes the neuro.stim loaders read this protocol: the shared r1_index gets the synthetic
+        index and every module's CMLReader is replaced. Everything is put back on exit.
+        """
+        reader = self.reader()
+        replaced = {}
+        for name in CMLREADER_MODULES:
+            module = importlib.import_module(name)
+            if hasattr(module, 'CMLReader'):
+                replaced[module] = module.CMLReader
+                module.CMLReader = reader
+        saved_index = r1_index.__dict__.copy()
+        r1_index._set_data(self.index())
+        try:
+            yield self
+        finally:
+            for module, original in replaced.items():
+                module.CMLReader = original
+            r1_index.__dict__.clear()
+            r1_index.__dict__.update(saved_index)
+
+
+class _Container:
+    """
+    What CMLReader.load_eeg returns: something with a to_ptsa().
+    """
+    def __init__(self, ts):
+        self.ts = ts
+
+    def to_ptsa(self):
+        return self.ts
@@ -0,0 +1,176 @@
+"""
+Process-wide, size capped cache of filter designs and wavelet kernels (design_cache), optionally kept on disk.
+"""
+
+import hashlib
+import os
+import threading
+import uuid
+from collections import OrderedDict
+
+import numpy as np
+
+
+class DesignCache:
+    """
+    Size capped least-recently-used cache of numpy arrays, with an optional directory to persist them in.
+
+    Parameters
+    ----------
+    max_bytes: int
+        Once the arrays held in memory take more than this, the least recently used are dropped
+    cache_dir: str
+        If given, designs are also saved here and read back on a miss
+    """
+    def __init__(self, max_bytes=int(256e6), cache_dir=None):
+        self.max_bytes = max_bytes
+        self.cache_dir = None if cache_dir is None else os.path.expanduser(cache_dir)
+        if self.cache_dir is not None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+        self._items = OrderedDict()
+        self._nbytes = 0
+        self._lock = threading.Lock()
+
+        # Stats, for this process. kind -> [memory hits, disk hits, misses]
+        self._counts = {}
+
+    def __getstate__(self):
+        # only ship the settings to worker processes
+        return {'max_bytes': self.max_bytes, 'cache_dir': self.cache_dir}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def configure(self, max_bytes=None, cache_dir=None):
+        """
+        Changes the memory cap and/or the disk directory. Pass cache_dir=False to stop using the disk.
+        """
+        with self._lock:
+            if max_bytes is not None:
+                self.max_bytes = max_bytes
+            if cache_dir is False:
+                self.cache_dir = None
+            elif cache_dir is not None:
+                self.cache_dir = os.path.expanduser(cache_dir)
+                os.makedirs(self.cache_dir, exist_ok=True)
+            self._shrink()
+
+    # -- Lookups --
+
+    def get(self, kind, key, builder):
+        """
+        Returns the design for (kind, key), calling builder() to make it if it isn't cached. The returned array is read
+        only, since it is shared.
+
+        Parameters
+        ----------
+        kind: str
+            Type of design (ex: 'butter_sos', 'polyphase_fir', 'morlet_fft')
+        key: tuple
+            Everything that defines the design. Must be hashable and have a stable repr (numbers and strings)
+        builder: callable
+            Function with no arguments that returns the design as a numpy array
+
+        Returns
+        -------
+        numpy.ndarray
+        """
+        full_key = (kind, key)
+        with self._lock:
+            value = self._items.get(full_key)
+            if value is not None:
+                self._items.move_to_end(full_key)
+                self._count(kind, 0)
+                return value
+
+        value = self._read(kind, key)
+        if value is not None:
+            source = 1
+        else:
+            value = np.asarray(builder())
+            self._write(kind, key, value)
+            source = 2
+        value.setflags(write=False)
+
+        with self._lock:
+            self._count(kind, source)
+            if full_key not in self._items:
+                self._items[full_key] = value
+                self._nbytes += value.nbytes
+                self._shrink()
+        return value
+
+    def _count(self, kind, i):
+        self._counts.setdefault(kind, [0, 0, 0])[i] += 1
+
+    def _shrink(self):
+        while self._items and (self._nbytes > self.max_bytes):
+            _, value = self._items.popitem(last=False)
+            self._nbytes -= value.nbytes
+
+    # -- Disk --
+
+    def _path(self, kind, key):
+        return os.path.join(self.cache_dir, kind + '_' + hashlib.sha1(repr(key).encode()).hexdigest() + '.npy')
+
+    def _read(self, kind, key):
+        if self.cache_dir is None:
+            return None
+        try:
+            return np.load(self._path(kind, key))
+        except (OSError, ValueError):
+            return None
+
+    def _write(self, kind, key, value):
+        if self.cache_dir is None:
+            return
+        path = self._path(kind, key)
+        tmp = path + '.' + uuid.uuid4().hex + '.tmp'
+        try:
+            with open(tmp, 'wb') as f:
+                np.save(f, value)
+            os.replace(tmp, path)
+        except OSError:
+            pass
+
+    # -- Maintenance --
+
+    def clear(self, disk=False):
+        """
+        Empties the in-memory cache and resets the counters. If disk is True, the saved designs are removed too.
+        """
+        with self._lock:
+            self._items.clear()
+            self._nbytes = 0
+            self._counts = {}
+        if disk and (self.cache_dir is not None):
+            for f in os.listdir(self.cache_dir):
+                if f.endswith('.npy'):
+                    try:
+                        os.remove(os.path.join(self.cache_dir, f))
+                    except OSError:
+                        pass
+
+    def stats(self):
+        """
+        Returns a dict of hit/miss counts (overall and per kind) for this process and the cache's current size.
+        """
+        with self._lock:
+            counts = {kind: list(c) for kind, c in self._counts.items()}
+            n_items, nbytes = len(self._items), self._nbytes
+
+        def summary(c):
+            lookups = sum(c)
+            return {'hits': c[0], 'disk_hits': c[1], 'misses': c[2],
+                    'hit_rate': (c[0] + c[1]) / lookups if lookups else 0.}
+
+        total = [sum(c[i] for c in counts.values()) for i in range(3)]
+        out = summary(total)
+        out['by_kind'] = {kind: summary(c) for kind, c in counts.items()}
+        out.update({'n_items': n_items, 'nbytes': nbytes, 'max_bytes': self.max_bytes, 'cache_dir': self.cache_dir})
+        return out
+
+
+# one shared instance for every module
+design_cache = DesignCache()
@@ -0,0 +1,191 @@
+"""
+Streaming a session's continuous EEG in fixed-length, overlap-discard filtered blocks, under a memory budget.
+"""
+
+import numpy as np
+
+from cmlreaders import CMLReader
+
+from neuro.stim.eeg_filters import butterworth_filter, line_noise_filter, resample_ratio, resample_timeseries
+
+# float64 working memory of a zero-phase filter per channel and sample: scipy's sosfiltfilt holds the padded signal and
+# the forward and backward passes (resampling needs less)
+FILTER_WORK_BYTES = 24
+
+
+def session_eeg_info(task, subject, session):
+    """
+    Returns the information needed to stream a session: a template event pointing at the session's eeg file, the
+    sample rate and the number of samples.
+
+    Parameters
+    ----------
+    task: str
+        The experiment name
+    subject: str
+        The subject code
+    session: int
+        The session number
+
+    Returns
+    -------
+    dict
+        With keys 'event' (single row DataFrame), 'samplerate' and 'n_samples'
+    """
+    reader = CMLReader(subject=subject, experiment=task.replace('RAM_', ''), session=session)
+    events = reader.load('events')
+    events = events[events['eegfile'].str.len() > 0]
+    sources = reader.load('sources')
+    return {
+        'event': events.iloc[[0]].copy(),
+        'samplerate': float(sources['sample_rate']),
+        'n_samples': int(sources['n_samples']),
+    }
+
+
+def block_length(n_channels, samplerate, block_s=None, pad_s=2., max_bytes=None, align=1, out_ratio=1.):
+    """
+    Returns the number of core samples per block.
+
+    Parameters
+    ----------
+    n_channels: int
+        Number of channels that will be read
+    samplerate: float
+        Sampling rate of the raw data
+    block_s: float
+        Requested block length in seconds
+    pad_s: float
+        Padding read on each side of a block, in seconds
+    max_bytes: int
+        Memory budget for one padded block and its filtering. Half of it goes to the block: float64 raw data plus its
+        resampled copy. The other half is for the filters' working memory (see block_chan_chunk)
+    align: int
+        Block length is rounded down to a multiple of this (the resampling down factor)
+    out_ratio: float
+        Resampled over raw sample rate (1 if not resampling)
+
+    Returns
+    -------
+    int
+    """
+    pad = int(np.ceil(pad_s * samplerate))
+    n = np.inf if block_s is None else int(block_s * samplerate)
+    if max_bytes is not None:
+        n = min(n, int(max_bytes / 2 // (n_channels * 8 * (1 + out_ratio))) - 2 * pad)
+    if not np.isfinite(n):
+        raise ValueError('Either block_s or max_bytes must be given')
+    n = int(n) // align * align
+    if n <= 0:
+        raise ValueError('max_bytes is too small for {} channels with {} s of padding'.format(n_channels, pad_s))
+    return n
+
+
+def block_chan_chunk(n_channels, n_padded, max_bytes=None, out_ratio=1.):
+    """
+    Returns the number of channels to filter and resample at a time so their working memory fits in the half of
+    max_bytes block_length leaves for it (None to do all channels at once, or if there's no budget).
+
+    Parameters
+    ----------
+    n_channels: int
+        Number of channels in the block
+    n_padded: int
+        Samples in the padded block, as read
+    max_bytes: int
+        The budget given to block_length
+    out_ratio: float
+        Resampled over raw sample rate (1 if not resampling)
+    """
+    if max_bytes is None:
+        return None
+    # the filters run before and after resampling, so on up to the longer of the two
+    per_channel = FILTER_WORK_BYTES * n_padded * max(1., out_ratio)
+    chan_chunk = max(1, int(max_bytes / 2 // per_channel))
+    return None if chan_chunk >= n_channels else chan_chunk
+
+
+def iter_session_eeg_blocks(task, subject, session, elec_scheme=None, block_s=60., pad_s=2., max_bytes=None,
+                            noise_freq=[58., 62.], resample_freq=None, pass_band=None, start_s=0., stop_s=None):
+    """
+    Generator that yields a session's continuous EEG as consecutive, non-overlapping TimeSeries blocks.
+
+    Parameters
+    ----------
+    task: str
+        The experiment name
+    subject: str
+        The subject number
+    session: int
+        The session number for this subject and task
+    elec_scheme: pandas.DataFrame
+        Electrode information, as for load_eeg(). Pass a subset of rows to only stream those channels
+    block_s: float
+        Length of each yielded block in seconds (the last one may be shorter)
+    pad_s: float
+        Extra data read (and discarded) on each side of every block so filtering is seamless across blocks
+    max_bytes: int
+        If given, blocks are made shorter and filtered a few channels at a time if needed, so one padded block and
+        its filtering never take more than this much memory (see block_length). Without an elec_scheme the channel
+        count isn't known up front and 256 channels are assumed
+    noise_freq: list
+        Stop filter will be applied to the given range. Default=(58. 62)
+    resample_freq: float
+        Sampling rate to resample to
+    pass_band: list
+        If given, the eeg will be band pass filtered in the given range
+    start_s: float
+        Where in the session to start, in seconds
+    stop_s: float
+        Where in the session to stop, in seconds. Default is the end of the session
+
+    Yields
+    ------
+    TimeSeries
+        channels x time blocks. The time coordinate is ms from the start of the eeg file
+    """
+    info = session_eeg_info(task, subject, session)
+    samplerate = info['samplerate']
+    reader = CMLReader(subject=subject, experiment=task.replace('RAM_', ''), session=session)
+
+    # keep block boundaries on whole output samples when resampling
+    ratio = resample_ratio(samplerate, resample_freq) if resample_freq is not None else None
+    align = ratio[1] if ratio is not None else 1
+    resample_method = 'poly' if ratio is not None else 'fft'
+
+    out_ratio = 1. if resample_freq is None else float(resample_freq) / samplerate
+    n_channels = len(elec_scheme) if elec_scheme is not None else 256
+    n_block = block_length(n_channels, samplerate, block_s=block_s, pad_s=pad_s, max_bytes=max_bytes, align=align,
+                           out_ratio=out_ratio)
+    pad = int(np.ceil(pad_s * samplerate / align)) * align
+    chan_chunk = block_chan_chunk(n_channels, n_block + 2 * pad, max_bytes, out_ratio)
+
+    first = int(start_s * samplerate) // align * align
+    last = info['n_samples'] if stop_s is None else min(info['n_samples'], int(stop_s * samplerate))
+
+    for start in range(first, last, n_block):
+        stop = min(start + n_block, last)
+        read_start = max(0, start - pad)
+        read_stop = min(info['n_samples'], stop + pad)
+
+        # one padded read for this block
+        event = info['event'].copy()
+        event['eegoffset'] = read_start
+        eeg = reader.load_eeg(event, rel_start=0, rel_stop=(read_stop - read_start) * 1000. / samplerate,
+                              scheme=elec_scheme).to_ptsa()
+        eeg = eeg.isel(event=0)
+
+        if noise_freq is not None:
+            eeg = line_noise_filter(eeg, noise_freq, order=4, chan_chunk=chan_chunk)
+        if resample_freq is not None:
+            eeg = resample_timeseries(eeg, resample_freq, chan_chunk=chan_chunk, method=resample_method)
+        if pass_band is not None:
+            eeg = butterworth_filter(eeg, pass_band, filt_type='pass', order=4, chan_chunk=chan_chunk, inplace=True)
+
+        # trim back to the core of the block
+        out_rate = float(eeg['samplerate'])
+        core_start = int(round((start - read_start) * out_rate / samplerate))
+        core_stop = core_start + int(round((stop - start) * out_rate / samplerate))
+        eeg = eeg.isel(time=slice(core_start, core_stop))
+        eeg = eeg.assign_coords(time=(start * 1000. / samplerate) + np.arange(eeg.sizes['time']) * 1000. / out_rate)
+        yield eeg
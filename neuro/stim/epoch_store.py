@@ -0,0 +1,222 @@
+"""
+Memory-mapped on-disk store for preprocessed, event-locked EEG.
+"""
+
+import hashlib
+import json
+import os
+import pickle
+import uuid
+
+import numpy as np
+import pandas as pd
+from numpy.lib.format import open_memmap
+
+from ptsa.data.timeseries import TimeSeries
+
+from neuro.stim.EEG import EEGContainer
+
+STORE_VERSION = 1
+DIMS = ('event', 'channel', 'time')
+
+
+def epoch_store_key(params):
+    """
+    Returns the hex digest naming the store for a set of preprocessing parameters.
+    """
+    params = {k: str(v) for k, v in params.items()}
+    return hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest()
+
+
+def frame_fingerprint(df, columns=None):
+    """
+    Returns a short string identifying the contents of some columns of a DataFrame (ex: the eegfile and eegoffset of
+    a set of events), for use in store parameters.
+    """
+    if columns is not None:
+        df = df[[col for col in columns if col in df]]
+    hashed = pd.util.hash_pandas_object(df.astype(str), index=False).to_numpy()
+    return '{}:{}'.format(len(df), hashlib.sha1(hashed.tobytes()).hexdigest())
+
+
+def _events_to_frame(event_coord):
+    """
+    Returns the event coordinate of a TimeSeries as a DataFrame, and the format it was in.
+    """
+    values = event_coord.to_index() if hasattr(event_coord, 'to_index') else event_coord
+    if isinstance(values, pd.MultiIndex):
+        return values.to_frame(index=False), 'multiindex'
+    values = np.asarray(event_coord)
+    if values.dtype.names is not None:
+        return pd.DataFrame.from_records(values), 'records'
+    return pd.DataFrame({'event': values}), 'values'
+
+
+def _frame_to_events(events, event_format):
+    if event_format == 'multiindex':
+        return pd.MultiIndex.from_frame(events)
+    if event_format == 'records':
+        return events.to_records(index=False)
+    return events['event'].to_numpy()
+
+
+def write_epoch_store(path, eeg, params=None, event_chunk=256):
+    """
+    Writes a preprocessed TimeSeries to an epoch store, a directory holding:
+
+        data.npy      events x channels x time, float32 (opened memory-mapped by open_epoch_store)
+        events.pkl    the events DataFrame
+        coords.pkl    the channel and time coordinates (and any other non-event coordinates)
+        meta.json     dims, shape, sample rate and the preprocessing parameters the data was made with
+
+    meta.json is written last, so a store without one is incomplete and is ignored.
+
+    Parameters
+    ----------
+    path: str
+        Directory to write the store in. Created if it doesn't exist, and any store already there is replaced
+    eeg: TimeSeries
+        Event-locked EEG with 'event', 'channel' and 'time' dimensions, in any order
+    params: dict
+        The preprocessing parameters the data was made with. Kept in meta.json and checked by open_epoch_store
+    event_chunk: int
+        Number of events copied into the file at a time
+
+    Returns
+    -------
+    str
+        path
+    """
+    eeg = eeg.transpose(*DIMS)
+    os.makedirs(path, exist_ok=True)
+    tmp = '.' + uuid.uuid4().hex + '.tmp'
+    meta_path = os.path.join(path, 'meta.json')
+    if os.path.exists(meta_path):
+        os.remove(meta_path)
+
+    # data, copied in blocks of events so a lazily loaded eeg is never fully in memory twice
+    data = open_memmap(os.path.join(path, 'data.npy') + tmp, mode='w+', dtype='float32', shape=eeg.shape)
+    for start in range(0, eeg.shape[0], event_chunk):
+        data[start:start + event_chunk] = eeg.data[start:start + event_chunk]
+    data.flush()
+    del data
+
+    events, event_format = _events_to_frame(eeg['event'])
+    events.to_pickle(os.path.join(path, 'events.pkl') + tmp)
+
+    # coordinates along the event dim (ex: the levels of an events MultiIndex) are rebuilt from events.pkl
+    coords = {name: (eeg[name].dims, eeg[name].values) for name in eeg.coords
+              if (name != 'samplerate') and ('event' not in eeg[name].dims)}
+    with open(os.path.join(path, 'coords.pkl') + tmp, 'wb') as f:
+        pickle.dump(coords, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    for name in ['data.npy', 'events.pkl', 'coords.pkl']:
+        os.replace(os.path.join(path, name) + tmp, os.path.join(path, name))
+
+    meta = {
+        'version': STORE_VERSION,
+        'dims': list(DIMS),
+        'shape': list(eeg.shape),
+        'dtype': 'float32',
+        'samplerate': float(eeg['samplerate']),
+        'event_format': event_format,
+        'params': {} if params is None else {k: str(v) for k, v in params.items()},
+    }
+    with open(meta_path + tmp, 'w') as f:
+        json.dump(meta, f)
+    os.replace(meta_path + tmp, meta_path)
+    return path
+
+
+def read_epoch_store_meta(path):
+    """
+    Returns the meta.json contents of a store, or None if there is no complete store at path.
+    """
+    try:
+        with open(os.path.join(path, 'meta.json'), 'r') as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if meta.get('version') != STORE_VERSION:
+        return None
+    return meta
+
+
+def open_epoch_store(path, events=None, params=None, mmap_mode='r', as_container=False):
+    """
+    Opens an epoch store without reading its data into memory.
+
+    Parameters
+    ----------
+    path: str
+        The store directory
+    events: slice, list or numpy.ndarray
+        If given, only these events (positions or a boolean mask) are returned. A slice keeps the result a view of the
+        file; a list or array of positions reads just those events
+    params: dict
+        If given, the store's preprocessing parameters must match these, otherwise a ValueError is raised
+    mmap_mode: str
+        Passed to np.load. 'r' (default) is read only, 'c' allows in-place changes that are never written back
+    as_container: bool
+        If True, return an EEGContainer instead of a TimeSeries
+
+    Returns
+    -------
+    TimeSeries or EEGContainer
+        events x channels x time, backed by the memory-mapped file
+    """
+    meta = read_epoch_store_meta(path)
+    if meta is None:
+        raise FileNotFoundError('No epoch store at {}'.format(path))
+    if (params is not None) and (meta['params'] != {k: str(v) for k, v in params.items()}):
+        raise ValueError('Epoch store at {} was made with different parameters'.format(path))
+
+    data = np.load(os.path.join(path, 'data.npy'), mmap_mode=mmap_mode)
+    events_df = pd.read_pickle(os.path.join(path, 'events.pkl'))
+    with open(os.path.join(path, 'coords.pkl'), 'rb') as f:
+        coords = pickle.load(f)
+
+    if events is not None:
+        data = data[events]
+        events_df = events_df.iloc[events].reset_index(drop=True)
+
+    if as_container:
+        return EEGContainer(data, meta['samplerate'], tstart=coords['time'][1][0], events=events_df,
+                            channels=np.asarray(coords['channel'][1]).tolist(), attrs={'params': meta['params']})
+
+    coords['event'] = _frame_to_events(events_df, meta['event_format'])
+    return TimeSeries.create(data, meta['samplerate'], coords=coords, dims=tuple(meta['dims']))
+
+
+def cached_epochs(store_dir, params, loader, mmap_mode='c'):
+    """
+    Returns the epoch store for params under store_dir, creating it with loader() first if it doesn't exist. Lets the
+    loading functions take an optional store without branching everywhere.
+
+    Parameters
+    ----------
+    store_dir: str
+        Directory holding epoch stores. If None, loader() is returned directly
+    params: dict
+        Everything that identifies the data (subject, events, channels, preprocessing). Names the store
+    loader: callable
+        Function with no arguments that returns the preprocessed TimeSeries (or None)
+    mmap_mode: str
+        Passed to open_epoch_store. Default 'c' (copy-on-write): the result can be changed in place like a fresh
+        load, without changing the store
+
+    Returns
+    -------
+    TimeSeries
+    """
+    if store_dir is None:
+        return loader()
+
+    path = os.path.join(store_dir, epoch_store_key(params))
+    if read_epoch_store_meta(path) is None:
+        eeg = loader()
+        if eeg is None:
+            return None
+        write_epoch_store(path, eeg, params=params)
+        del eeg
+    return open_epoch_store(path, params=params, mmap_mode=mmap_mode)
@@ -0,0 +1,322 @@
+"""
+Loading a subject's events for every session of a task concurrently, and a compact layout for events tables.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from cmlreaders import CMLReader
+
+from neuro.stim.r1_index import r1_index
+from neuro.stim.table_cache import cached_table, r1_source_files
+
+# sessions read at once, by default. More than this mostly queues on the filesystem
+DEFAULT_N_WORKERS = 8
+
+
+def has_eeg(events, eegfile_column='eegfile'):
+    """
+    Returns a boolean array, True for events with a (non empty) eeg file.
+    """
+    if eegfile_column not in events:
+        return np.ones(len(events), dtype=bool)
+    return (events[eegfile_column].astype(object).str.len() > 0).to_numpy()
+
+
+def filter_events(events, columns=None, event_types=None, predicate=None, remove_no_eeg=False):
+    """
+    Filters and projects one events DataFrame.
+
+    Parameters
+    ----------
+    events: pandas.DataFrame
+        Events, from CMLReader(...).load('events')
+    columns: list
+        Columns to keep. Columns a session doesn't have are skipped. Default: all
+    event_types: list
+        Keep only events whose 'type' is one of these (ex: ['WORD'] or ['STIM_ON', 'STIM_OFF'])
+    predicate: callable
+        Function of the events DataFrame returning a boolean mask of the events to keep. Applied before the column
+        projection, so it can use any column
+    remove_no_eeg: bool
+        If true, events with missing 'eegfile' info are removed
+
+    Returns
+    -------
+    pandas.DataFrame
+    """
+    mask = np.ones(len(events), dtype=bool)
+    if event_types is not None:
+        event_types = [event_types] if isinstance(event_types, str) else list(event_types)
+        mask &= events['type'].isin(event_types).to_numpy()
+    if remove_no_eeg:
+        mask &= has_eeg(events)
+    if predicate is not None:
+        mask &= np.asarray(predicate(events), dtype=bool)
+    if not mask.all():
+        events = events[mask]
+    if columns is not None:
+        events = events[[col for col in columns if col in events]]
+    return events
+
+
+def load_session_events(subject, task, session, montage=0, cache=None):
+    """
+    Reads all the events of one session, through cache if one is given (see TableCache).
+    """
+    task = task.replace('RAM_', '')
+    return cached_table(cache, 'events',
+                        lambda: CMLReader(subject=subject, experiment=task, session=session).load('events'),
+                        task, subject, montage, session=session,
+                        source_files=r1_source_files('task_events', subject, montage, task, session))
+
+
+def load_task_events(subject, task, montage=0, sessions=None, columns=None, event_types=None, predicate=None,
+                     remove_no_eeg=False, n_workers=None, cache=None, compact=False):
+    """
+    Returns the events of every session of a task, read concurrently and filtered session by session.
+
+    Parameters
+    ----------
+    subject: str
+        The subject code
+    task: str
+        The experiment name (ex: RAM_FR1, FR1, ...)
+    montage: int
+        The montage number for the subject
+    sessions: list
+        Sessions to load. Default: every session in the r1 index
+    columns: list
+        Columns to keep. Default: all
+    event_types: list
+        Keep only events of these types
+    predicate: callable
+        Function of a session's events DataFrame returning a boolean mask of the events to keep
+    remove_no_eeg: bool
+        If true, events with missing 'eegfile' info are removed
+    n_workers: int
+        Number of sessions read at once. Default: the number of sessions, up to DEFAULT_N_WORKERS
+    cache: TableCache
+        If given, each session's full events table is read from / saved to this cache (the filters are applied
+        after, so one cache entry serves every projection)
+    compact: bool
+        If true, the events are returned in the compact layout (see compact_events)
+
+    Returns
+    -------
+    pandas.DataFrame
+        Sessions in order. Each session keeps its own index, as the old pd.concat did
+    """
+    task = task.replace('RAM_', '')
+    if sessions is None:
+        sessions = r1_index.sessions(subject, task, montage)
+    sessions = list(sessions)
+
+    def load(session):
+        return filter_events(load_session_events(subject, task, session, montage, cache), columns=columns,
+                             event_types=event_types, predicate=predicate, remove_no_eeg=remove_no_eeg)
+
+    n_workers = min(len(sessions), DEFAULT_N_WORKERS) if n_workers is None else n_workers
+    if (n_workers <= 1) or (len(sessions) <= 1):
+        frames = [load(session) for session in sessions]
+    else:
+        with ThreadPoolExecutor(max_workers=n_workers) as pool:
+            frames = list(pool.map(load, sessions))
+    if not frames:
+        return pd.DataFrame(columns=columns)
+    events = pd.concat(frames)
+    return compact_events(events) if compact else events
+
+
+# -- Compact schema --
+#
+# compact_events stores an events table with:
+#   - string columns with few distinct values (type, eegfile, subject, experiment, ...) as categoricals
+#   - integer columns downcast, and float columns as float32 where that is exact
+#   - stim_params (a list of dicts per event) flattened into one typed column per key of the first dict
+#     ('stim_params.anode_label', 'stim_params.amplitude', ...) plus 'stim_params.n', the length of the list. Events
+#     whose stim_params aren't a list of at most one dict with the usual keys keep their original value in
+#     'stim_params.rest', so nothing is lost
+# The original columns and dtypes are kept in attrs['events_schema'] and expand_events rebuilds the original table.
+# attrs don't survive every pandas operation (pandas < 2 drops them in concat and merge), so a table is recognised as
+# compact by its 'stim_params.n' column, with attrs only needed for tables compacted without a stim_params column.
+# Without the schema, expand_events still rebuilds stim_params and turns categoricals back into objects, but
+# downcast numbers keep their compact dtype.
+
+STIM_PREFIX = 'stim_params.'
+SCHEMA_ATTR = 'events_schema'
+
+
+def is_compact(events):
+    """
+    True if events came from compact_events().
+    """
+    return (STIM_PREFIX + 'n' in getattr(events, 'columns', ())) or (SCHEMA_ATTR in getattr(events, 'attrs', {}))
+
+
+def _is_str_values(values):
+    return all(isinstance(v, str) for v in values if not (v is None or (isinstance(v, float) and np.isnan(v))))
+
+
+def _compact_column(col, max_category_fraction):
+    """
+    Returns the compact version of one column, or the column itself if there isn't one.
+    """
+    dtype = col.dtype
+    if pd.api.types.is_bool_dtype(dtype):
+        return col
+    if pd.api.types.is_integer_dtype(dtype):
+        return pd.to_numeric(col, downcast='integer')
+    if pd.api.types.is_float_dtype(dtype):
+        as_32 = col.astype(np.float32)
+        exact = np.array_equal(as_32.to_numpy(dtype=np.float64), col.to_numpy(dtype=np.float64), equal_nan=True)
+        return as_32 if exact else col
+    if (dtype == object) or pd.api.types.is_string_dtype(dtype):
+        values = col.to_numpy(dtype=object)
+        if len(values) and _is_str_values(values) and \
+                (pd.unique(values).size <= max(1, max_category_fraction * len(values))):
+            return col.astype('category')
+    return col
+
+
+def _typed_param_column(values, present):
+    """
+    Returns a typed column from the stim_params values of one key. Entries where present is False are missing.
+    """
+    kinds = set(type(v) for v, p in zip(values, present) if p)
+    if not kinds:
+        return pd.array(values, dtype=object)
+    if all(issubclass(k, (bool, np.bool_)) for k in kinds):
+        return pd.array(values, dtype='boolean')
+    if all(issubclass(k, (int, np.integer)) and not issubclass(k, bool) for k in kinds):
+        return pd.to_numeric(pd.Series(values, dtype='Int64'), downcast='integer').array
+    if all(issubclass(k, (float, np.floating)) for k in kinds):
+        return _compact_column(pd.Series(values, dtype=np.float64), 1.).array
+    if kinds == {str}:
+        return pd.Categorical(values)
+    return pd.array(values, dtype=object)
+
+
+def flatten_stim_params(stim_params, index=None):
+    """
+    Flattens a stim_params column (lists of dicts) into typed columns, losslessly.
+
+    Parameters
+    ----------
+    stim_params: pandas.Series or list
+        The 'stim_params' column of an events DataFrame
+    index: pandas.Index
+        Index for the returned DataFrame. Defaults to the index of stim_params
+
+    Returns
+    -------
+    pandas.DataFrame
+        'stim_params.n' (number of dicts, -1 if the entry isn't a list), one 'stim_params.<key>' column per key of the
+        first dicts, and 'stim_params.rest' holding the original entry wherever the other columns can't represent it
+    """
+    if index is None:
+        index = getattr(stim_params, 'index', None)
+    entries = list(stim_params)
+    n = np.array([len(p) if isinstance(p, list) else -1 for p in entries], dtype=np.int16)
+    first = [p[0] if (k == 1) and isinstance(p[0], dict) else {} for p, k in zip(entries, n)]
+    keys = list(dict.fromkeys(key for d in first for key in d))
+
+    # an entry is fully described by the columns if it's an empty list, or a list of one dict with every key
+    has_all_keys = np.array([(len(d) == len(keys)) and all(key in d for key in keys) for d in first], dtype=bool)
+    has_dict = np.array([(k == 1) and isinstance(p[0], dict) for p, k in zip(entries, n)], dtype=bool)
+    present = has_dict & has_all_keys
+    regular = (n == 0) | present
+
+    out = {STIM_PREFIX + 'n': n}
+    for key in keys:
+        values = [d.get(key) if p else None for d, p in zip(first, present)]
+        out[STIM_PREFIX + key] = _typed_param_column(values, present)
+    out[STIM_PREFIX + 'rest'] = pd.array([None if r else p for p, r in zip(entries, regular)], dtype=object)
+    return pd.DataFrame(out, index=index)
+
+
+def _param_value(value):
+    if value is pd.NA or value is None:
+        return None
+    if isinstance(value, float) and np.isnan(value):
+        return value
+    return value.item() if isinstance(value, np.generic) else value
+
+
+def unflatten_stim_params(params):
+    """
+    Rebuilds the stim_params column (lists of dicts) from the output of flatten_stim_params().
+    """
+    keys = [col[len(STIM_PREFIX):] for col in params.columns
+            if col not in (STIM_PREFIX + 'n', STIM_PREFIX + 'rest')]
+    n = params[STIM_PREFIX + 'n'].to_numpy()
+    rest = params[STIM_PREFIX + 'rest'].to_numpy(dtype=object)
+    columns = [params[STIM_PREFIX + key].astype(object).tolist() for key in keys]
+    out = []
+    for i in range(len(params)):
+        if (n[i] < 0) or (rest[i] is not None):
+            out.append(rest[i])
+        elif n[i] == 0:
+            out.append([])
+        else:
+            out.append([{key: _param_value(column[i]) for key, column in zip(keys, columns)}])
+    return pd.Series(out, index=params.index, dtype=object, name='stim_params')
+
+
+def compact_events(events, max_category_fraction=0.5):
+    """
+    Returns a compact copy of an events DataFrame (see the notes above). expand_events() reverses it.
+
+    Parameters
+    ----------
+    events: pandas.DataFrame
+        Events, from load_events_info() / load_task_events()
+    max_category_fraction: float
+        String columns with at most this many distinct values per event become categoricals
+
+    Returns
+    -------
+    pandas.DataFrame
+    """
+    if is_compact(events):
+        return events
+    columns = {}
+    for col in events.columns:
+        if col == 'stim_params':
+            for name, values in flatten_stim_params(events[col]).items():
+                columns[name] = values
+        else:
+            columns[col] = _compact_column(events[col], max_category_fraction)
+    compact = pd.DataFrame(columns, index=events.index)
+    compact.attrs[SCHEMA_ATTR] = {'columns': list(events.columns), 'dtypes': dict(events.dtypes)}
+    return compact
+
+
+def expand_events(events):
+    """
+    Returns the original layout of events compacted with compact_events(): same columns, order and dtypes, with
+    stim_params as lists of dicts. Events that aren't compact are returned as they are. Columns added since compacting
+    are kept, and if attrs lost the schema, columns are restored as far as the compact table allows (see the notes
+    above).
+    """
+    if not is_compact(events):
+        return events
+    dtypes = events.attrs.get(SCHEMA_ATTR, {}).get('dtypes', {})
+    columns = {}
+    for col in events.columns:
+        if col.startswith(STIM_PREFIX):
+            if 'stim_params' not in columns:
+                columns['stim_params'] = unflatten_stim_params(
+                    events[[c for c in events.columns if c.startswith(STIM_PREFIX)]])
+        elif col in dtypes:
+            columns[col] = events[col].astype(dtypes[col])
+        elif isinstance(events[col].dtype, pd.CategoricalDtype):
+            columns[col] = events[col].astype(object)
+        else:
+            columns[col] = events[col]
+    expanded = pd.DataFrame(columns, index=events.index)
+    expanded.attrs = {k: v for k, v in events.attrs.items() if k != SCHEMA_ATTR}
+    return expanded
+
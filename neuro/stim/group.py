@@ -0,0 +1,222 @@
+"""
+Running one job per subject over a group in one process pool, with retries, checkpoints and a single thread budget.
+"""
+
+import os
+import pickle
+import re
+import time
+import traceback
+import uuid
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import contextmanager
+
+from threadpoolctl import threadpool_limits
+from tqdm import tqdm
+
+from neuro.stim import profiling
+
+# Errors worth trying again. Missing files and permissions won't fix themselves
+RETRY_EXCEPTIONS = (OSError, TimeoutError, ConnectionError)
+NO_RETRY_EXCEPTIONS = (FileNotFoundError, PermissionError, IsADirectoryError, NotADirectoryError)
+
+THREAD_ENV_VARS = ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS', 'NUMEXPR_NUM_THREADS',
+                   'VECLIB_MAXIMUM_THREADS']
+
+JobResult = namedtuple('JobResult', ['index', 'key', 'value', 'error', 'attempts', 'elapsed_s', 'from_checkpoint'])
+JobError = namedtuple('JobError', ['key', 'error_type', 'message', 'traceback', 'attempts'])
+
+
+def default_n_workers():
+    """
+    Number of workers to use when none is given: one per available core.
+    """
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def _should_retry(error, retry_on):
+    return isinstance(error, retry_on) and not isinstance(error, NO_RETRY_EXCEPTIONS)
+
+
+@contextmanager
+def _thread_env(threads_per_worker):
+    """
+    Sets the thread count variables of numerical libraries inside the block, for the workers started there. Libraries
+    only read them when they load, so they limit spawned workers and libraries a forked worker loads later.
+    """
+    saved = {var: os.environ.get(var) for var in THREAD_ENV_VARS}
+    os.environ.update({var: str(threads_per_worker) for var in THREAD_ENV_VARS})
+    try:
+        yield
+    finally:
+        for var, value in saved.items():
+            if value is None:
+                os.environ.pop(var, None)
+            else:
+                os.environ[var] = value
+
+
+def _limit_threads(threads_per_worker):
+    """
+    Worker initializer. Limits the thread pools of numerical libraries already loaded, which a forked worker inherits
+    from this process.
+    """
+    threadpool_limits(threads_per_worker)
+
+
+def _run_job(func, args, retries, backoff_s, retry_on):
+    """
+    Runs func(*args), retrying retryable errors. Returns (value, error, attempts, elapsed_s). Never raises.
+    """
+    start = time.time()
+    attempt = 0
+    while True:
+        attempt += 1
+        try:
+            return func(*args), None, attempt, time.time() - start
+        except Exception as e:
+            if (attempt <= retries) and _should_retry(e, retry_on):
+                time.sleep(backoff_s * 2 ** (attempt - 1))
+                continue
+            error = (type(e).__name__, str(e), traceback.format_exc())
+            return None, error, attempt, time.time() - start
+
+
+def checkpoint_path(checkpoint_dir, key):
+    """
+    Returns the checkpoint file for a job key (ex: ('FR1', 'R1001P', 0) -> <checkpoint_dir>/FR1_R1001P_0.pkl).
+    """
+    name = '_'.join(str(k) for k in (key if isinstance(key, tuple) else (key,)))
+    return os.path.join(checkpoint_dir, re.sub(r'[^\w.-]', '-', name) + '.pkl')
+
+
+def _read_checkpoint(checkpoint_dir, key):
+    try:
+        with open(checkpoint_path(checkpoint_dir, key), 'rb') as f:
+            return True, pickle.load(f)
+    except Exception:
+        return False, None
+
+
+def _write_checkpoint(checkpoint_dir, key, value):
+    path = checkpoint_path(checkpoint_dir, key)
+    tmp = path + '.' + uuid.uuid4().hex + '.tmp'
+    try:
+        with open(tmp, 'wb') as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+    except Exception:
+        # a result that can't be checkpointed is still a result
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+
+
+def run_group(func, jobs, n_workers=None, threads_per_worker=1, retries=2, backoff_s=2., retry_on=RETRY_EXCEPTIONS,
+              checkpoint_dir=None, progress=True, mp_context=None):
+    """
+    Generator that runs func over a list of jobs in one process pool and yields a JobResult as each finishes.
+
+    Parameters
+    ----------
+    func: callable
+        A module level (picklable) function. Called as func(*args) for each job
+    jobs: list
+        List of (key, args) pairs. key identifies the job in results, errors and checkpoints (ex: (task, subject,
+        montage))
+    n_workers: int
+        Number of worker processes. Default is one per available core. With 1, jobs run in this process
+    threads_per_worker: int
+        Limit on the BLAS / OpenMP / numexpr threads of each worker
+    retries: int
+        Number of times to retry a job that fails with one of retry_on
+    backoff_s: float
+        Wait before the first retry. Doubles with each retry
+    retry_on: tuple
+        Exception types that are retried
+    checkpoint_dir: str
+        If given, successful results are pickled here and jobs with a checkpoint are not run again
+    progress: bool
+        Show a progress bar
+    mp_context: multiprocessing context
+        Passed to ProcessPoolExecutor (ex: multiprocessing.get_context('spawn'))
+
+    Yields
+    ------
+    JobResult
+        index (position in jobs), key, value (None on error), error (a JobError, or None), attempts, elapsed_s and
+        from_checkpoint
+    """
+    jobs = list(jobs)
+    n_workers = default_n_workers() if n_workers is None else n_workers
+    if checkpoint_dir is not None:
+        os.makedirs(checkpoint_dir, exist_ok=True)
+
+    bar = tqdm(total=len(jobs), disable=not progress)
+
+    def finish(index, key, value, error, attempts, elapsed_s):
+        if error is not None:
+            error = JobError(key, error[0], error[1], error[2], attempts)
+        elif checkpoint_dir is not None:
+            _write_checkpoint(checkpoint_dir, key, value)
+        bar.update(1)
+        return JobResult(index, key, value, error, attempts, elapsed_s, False)
+
+    # anything already done
+    todo = []
+    for index, (key, args) in enumerate(jobs):
+        found, value = _read_checkpoint(checkpoint_dir, key) if checkpoint_dir is not None else (False, None)
+        if found:
+            bar.update(1)
+            yield JobResult(index, key, value, None, 0, 0., True)
+        else:
+            todo.append((index, key, args))
+
+    try:
+        if (n_workers <= 1) or (len(todo) <= 1):
+            for index, key, args in todo:
+                yield finish(index, key, *_run_job(func, args, retries, backoff_s, retry_on))
+            return
+
+        collect = profiling.enabled()
+        with ProcessPoolExecutor(max_workers=min(n_workers, len(todo)), mp_context=mp_context,
+                                 initializer=_limit_threads, initargs=(threads_per_worker,)) as pool:
+            # workers start as jobs are submitted, and there are no more workers than jobs
+            with _thread_env(threads_per_worker):
+                if collect:
+                    # workers send their span records back with the result
+                    futures = {pool.submit(profiling.call_collecting, _run_job, func, args, retries, backoff_s,
+                                           retry_on): (index, key) for index, key, args in todo}
+                else:
+                    futures = {pool.submit(_run_job, func, args, retries, backoff_s, retry_on): (index, key)
+                               for index, key, args in todo}
+            for future in as_completed(futures):
+                index, key = futures[future]
+                try:
+                    result = future.result()
+                    if collect:
+                        result, records = result
+                        profiling.merge(records, job=key)
+                    yield finish(index, key, *result)
+                except Exception as e:
+                    # the worker died or the result couldn't be sent back
+                    yield finish(index, key, None, (type(e).__name__, str(e), traceback.format_exc()), 1, 0.)
+    finally:
+        bar.close()
+
+
+def clear_checkpoints(checkpoint_dir):
+    """
+    Removes every checkpoint in checkpoint_dir. Returns the number removed.
+    """
+    n = 0
+    for f in os.listdir(checkpoint_dir):
+        if f.endswith('.pkl'):
+            os.remove(os.path.join(checkpoint_dir, f))
+            n += 1
+    return n
@@ -0,0 +1,220 @@
+"""
+Group-level tables (electrodes, stimulation) with categorical string columns, appended one subject at a time.
+"""
+
+import numpy as np
+import pandas as pd
+from pandas.api.types import CategoricalDtype
+
+
+def _is_str_column(col):
+    values = col.dropna()
+    return len(values) == 0 or all(isinstance(v, str) for v in values)
+
+
+def compact_frame(df, category_columns=None):
+    """
+    Returns a copy of df with its string columns as categoricals and integer columns downcast.
+
+    Parameters
+    ----------
+    df: pandas.DataFrame
+        Table to convert
+    category_columns: list
+        Columns to make categorical. Default is every object column that only holds strings (and missing values)
+
+    Returns
+    -------
+    pandas.DataFrame
+    """
+    out = {}
+    for col in df.columns:
+        values = df[col]
+        if category_columns is not None:
+            is_category = col in category_columns
+        else:
+            is_category = (values.dtype == object or pd.api.types.is_string_dtype(values.dtype)) and \
+                _is_str_column(values)
+        if is_category:
+            out[col] = values.astype('category')
+        elif pd.api.types.is_integer_dtype(values.dtype) and not pd.api.types.is_bool_dtype(values.dtype):
+            out[col] = pd.to_numeric(values, downcast='integer')
+        else:
+            out[col] = values
+    return pd.DataFrame(out, index=pd.RangeIndex(len(df)))
+
+
+def concat_categorical(frames):
+    """
+    Concatenates DataFrames, keeping categorical columns categorical by giving each the union of the categories.
+    Columns missing from some frames are filled with missing values.
+
+    Returns
+    -------
+    pandas.DataFrame
+    """
+    frames = [f for f in frames if f is not None]
+    if not frames:
+        return pd.DataFrame()
+    columns = list(dict.fromkeys(col for f in frames for col in f.columns))
+
+    # union of the categories of each categorical column
+    categories = {}
+    for f in frames:
+        for col in f.columns:
+            if isinstance(f[col].dtype, CategoricalDtype):
+                categories.setdefault(col, {}).update(dict.fromkeys(f[col].cat.categories))
+
+    # a column that is categorical somewhere and has other values elsewhere can't stay categorical
+    for col in list(categories):
+        for f in frames:
+            if (col in f) and not isinstance(f[col].dtype, CategoricalDtype) and \
+                    not f[col].dropna().isin(list(categories[col])).all():
+                del categories[col]
+                break
+
+    aligned = []
+    for f in frames:
+        f = f.copy(deep=False)
+        for col in columns:
+            if col in categories:
+                dtype = CategoricalDtype(list(categories[col]))
+                if col in f:
+                    f[col] = f[col].astype(object).astype(dtype) if not isinstance(f[col].dtype, CategoricalDtype) \
+                        else f[col].cat.set_categories(dtype.categories)
+                else:
+                    f[col] = pd.Categorical([np.nan] * len(f), dtype=dtype)
+            elif (col in f) and isinstance(f[col].dtype, CategoricalDtype):
+                f[col] = f[col].astype(object)
+        aligned.append(f)
+    return pd.concat(aligned, ignore_index=True)[columns]
+
+
+class GroupTable:
+    """
+    A group-level table (ex: electrodes or stimulation for every subject of a task), appended one subject at a time.
+
+    Parameters
+    ----------
+    coord_prefix: str
+        Coordinates used to add a 'hemi' column when a subject's table doesn't have one (ex: 'avg' for 'avg.x')
+    """
+    def __init__(self, coord_prefix='avg'):
+        self.coord_prefix = coord_prefix
+        self._table = None
+
+    @property
+    def table(self):
+        """
+        The combined table as a DataFrame.
+        """
+        return pd.DataFrame() if self._table is None else self._table
+
+    def __len__(self):
+        return 0 if self._table is None else len(self._table)
+
+    @property
+    def subjects(self):
+        if self._table is None:
+            return []
+        return list(self._table[['subject', 'montage']].drop_duplicates().itertuples(index=False, name=None))
+
+    def has_subject(self, subject, montage=0):
+        return (str(subject), int(montage)) in set(self.subjects)
+
+    def _prepare(self, subject, montage, df):
+        df = df.reset_index(drop=True)
+        x_col = self.coord_prefix + '.x'
+        if ('hemi' not in df) and (x_col in df):
+            x = pd.to_numeric(df[x_col], errors='coerce').to_numpy()
+            df = df.assign(hemi=np.where(np.isnan(x), None, np.where(x < 0, 'left', 'right')))
+        # legacy (non-r1) electrode tables carry their own 'subject' and, in 'montage', the electrode montage name
+        # (ex: 'hipp'). The latter is kept as 'elec_montage'
+        if 'montage' in df:
+            df = df.rename(columns={'montage': 'elec_montage'})
+        df = compact_frame(df.drop(columns=['subject'], errors='ignore'))
+        df.insert(0, 'montage', np.full(len(df), int(montage), dtype=np.int16))
+        df.insert(0, 'subject', pd.Categorical([str(subject)] * len(df)))
+        return df
+
+    def append(self, subject, montage, df):
+        """
+        Adds one subject's table. If the subject / montage is already in the table, its rows are replaced.
+
+        Parameters
+        ----------
+        subject: str
+            The subject code
+        montage: int
+            The montage number
+        df: pandas.DataFrame
+            The subject's table (ex: from load_electrode_info() or load_stimulation_info())
+
+        Returns
+        -------
+        GroupTable
+            self
+        """
+        return self.extend([(subject, montage, df)])
+
+    def extend(self, tables):
+        """
+        Adds several subjects' tables at once, given as (subject, montage, df) tuples.
+        """
+        tables = [(str(subject), int(montage), df) for subject, montage, df in tables if df is not None]
+        if not tables:
+            return self
+        if self._table is not None:
+            replaced = set((subject, montage) for subject, montage, _ in tables)
+            keys = list(zip(self._table['subject'].astype(str), self._table['montage'].astype(int)))
+            keep = np.array([key not in replaced for key in keys], dtype=bool)
+            base = self._table if keep.all() else self._table[keep]
+        else:
+            base = None
+        new = [self._prepare(subject, montage, df) for subject, montage, df in tables]
+        self._table = concat_categorical([base] + new)
+        self._table['subject'] = self._table['subject'].cat.remove_unused_categories()
+        return self
+
+    @property
+    def region_columns(self):
+        return [col for col in self.table.columns if 'region' in col]
+
+    def filter(self, region=None, hemisphere=None, subjects=None, region_columns=None):
+        """
+        Returns the rows matching every given condition.
+
+        Parameters
+        ----------
+        region: str or list
+            Keep rows whose value in any of region_columns is one of these
+        hemisphere: str
+            'left' or 'right'
+        subjects: list
+            Keep only these subjects
+        region_columns: list
+            Columns to look for region in. Default is every column with 'region' in its name
+
+        Returns
+        -------
+        pandas.DataFrame
+        """
+        table = self.table
+        mask = np.ones(len(table), dtype=bool)
+        if region is not None:
+            regions = [region] if isinstance(region, str) else list(region)
+            in_region = np.zeros(len(table), dtype=bool)
+            for col in (self.region_columns if region_columns is None else region_columns):
+                in_region |= table[col].isin(regions).to_numpy()
+            mask &= in_region
+        if hemisphere is not None:
+            mask &= (table['hemi'] == hemisphere).to_numpy()
+        if subjects is not None:
+            mask &= table['subject'].isin([str(s) for s in subjects]).to_numpy()
+        return table[mask]
+
+    def memory_usage(self):
+        """
+        Returns the memory used by the combined table, in bytes.
+        """
+        return int(self.table.memory_usage(deep=True).sum())
@@ -0,0 +1,369 @@
+"""
+Persisted subject x ROI x hemisphere counts of contacts and stimulated sites, for picking cohorts without loading
+electrode files.
+"""
+
+import hashlib
+import json
+import os
+import pickle
+import uuid
+
+import numpy as np
+import pandas as pd
+
+from neuro.stim.group import run_group
+from neuro.stim.loaders import get_subjs_and_montages, load_elec_info, load_subj_events
+from neuro.stim.roi import SUBJECT_FILTER_ROI_DICT, RoiClassifier, coalesce_regions, hemisphere
+from neuro.stim.stimulation import STIM_TYPES, expand_stim_params
+from neuro.stim.table_cache import r1_source_files
+
+DEFAULT_INVENTORY_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'neuro', 'inventory')
+
+KINDS = ['contacts', 'stim']
+HEMISPHERES = ['left', 'right']
+
+
+def _fingerprint(paths):
+    """
+    (path, mtime, size) of each file that exists. Changes when a file is edited or re-processed.
+    """
+    out = []
+    for path in paths:
+        try:
+            st = os.stat(path)
+            out.append((path, st.st_mtime_ns, st.st_size))
+        except OSError:
+            pass
+    return out
+
+
+def _roi_counts(classifier, roi_mask, hemi):
+    """
+    Returns an (n_rois, 2) array of the number of rows in each ROI, for left and right.
+    """
+    bits = (np.asarray(roi_mask, dtype=np.int64)[:, None] >> np.arange(len(classifier.rois))) & 1
+    is_left = np.asarray(hemi) == 'left'
+    return np.stack([bits[is_left].sum(axis=0), bits[~is_left].sum(axis=0)], axis=-1)
+
+
+def subject_inventory(task, subject, montage, roi_dict=None, region_columns=None, x_coord_column='ind.x'):
+    """
+    Counts one subject's contacts and stimulated sites in every ROI and hemisphere.
+
+    Parameters
+    ----------
+    task: str
+        The experiment name. Stim sites are taken from its events
+    subject: str
+        The subject code
+    montage: int
+        The montage number
+    roi_dict: dict
+        Mapping of ROI names to region labels. Default: roi.SUBJECT_FILTER_ROI_DICT
+    region_columns: list
+        Localization columns, most trusted first. Default: 'stein.region' then 'ind.region', as
+        filter_subject_to_region uses
+    x_coord_column: str
+        Column with the x coordinate of each contact. Negative values are left hemisphere
+
+    Returns
+    -------
+    numpy.ndarray
+        int32 array of shape (len(KINDS), n_rois, len(HEMISPHERES))
+    """
+    classifier = RoiClassifier(SUBJECT_FILTER_ROI_DICT if roi_dict is None else roi_dict)
+    region_columns = ['stein.region', 'ind.region'] if region_columns is None else region_columns
+    counts = np.zeros((len(KINDS), len(classifier.rois), len(HEMISPHERES)), dtype=np.int32)
+
+    elec_info = load_elec_info(subject, montage=montage, bipolar=False)
+    if elec_info is None or not len(elec_info):
+        return counts
+    elec_info = elec_info.reset_index(drop=True)
+    roi_mask = classifier.roi_mask(coalesce_regions(elec_info, region_columns))
+    hemi = np.asarray(hemisphere(elec_info, x_coord_column))
+    counts[0] = _roi_counts(classifier, roi_mask, hemi)
+
+    # stim sites: each anode-cathode pair once, at its anode contact
+    events = load_subj_events(task, subject, montage)
+    if ('stim_params' not in events) or ('type' not in events):
+        return counts
+    stim_events = events[events['type'].isin(STIM_TYPES['BOTH'])]
+    params = expand_stim_params(stim_events['stim_params'])
+    if not len(params) or ('anode_label' not in params):
+        return counts
+    sites = params[['anode_label', 'cathode_label']].astype(str).drop_duplicates()
+
+    # row of each label (the first, if a label is repeated), -1 if it isn't in the contacts table
+    labels = elec_info['label'].astype(str)
+    first = np.flatnonzero(~labels.duplicated().to_numpy())
+    lookup = pd.Index(labels.to_numpy()[first])
+
+    def rows_of(site_labels):
+        pos = lookup.get_indexer(site_labels)
+        return np.where(pos >= 0, first[pos], -1)
+
+    anode = rows_of(sites['anode_label'])
+    cathode = rows_of(sites['cathode_label'])
+    use_cathode = (anode < 0) | (roi_mask[np.maximum(anode, 0)] == 0)
+    rows = np.where(use_cathode & (cathode >= 0), cathode, anode)
+    rows = rows[rows >= 0]
+    counts[1] = _roi_counts(classifier, roi_mask[rows], hemi[rows])
+    return counts
+
+
+def _subject_job(task, subject, montage, roi_dict, region_columns, x_coord_column):
+    return subject_inventory(task, subject, montage, roi_dict, region_columns, x_coord_column)
+
+
+class ElectrodeInventory:
+    """
+    Contact and stim site counts per subject / montage, ROI and hemisphere for one task, saved to disk.
+
+    Contacts count in every ROI their region label is in (see RoiClassifier.roi_mask). A stim site is an anode-cathode
+    pair from the task's stim events, located at its anode contact (or its cathode, if the anode has no region).
+    update() only loads subjects that are new or whose contacts file changed.
+
+    Parameters
+    ----------
+    task: str
+        The experiment name (ex: FR1, RAM_PS3)
+    inventory_dir: str
+        Where the inventory is saved, as <inventory_dir>/<task>.pkl. Set to False to keep it in memory only. Default:
+        ~/.cache/neuro/inventory
+    roi_dict: dict
+        Mapping of ROI names to region labels. Default: roi.SUBJECT_FILTER_ROI_DICT. A saved inventory built with
+        different ROIs is rebuilt
+    region_columns: list
+        Localization columns, most trusted first. Default: 'stein.region' then 'ind.region'
+    x_coord_column: str
+        Column with the x coordinate of each contact
+    """
+    def __init__(self, task, inventory_dir=None, roi_dict=None, region_columns=None, x_coord_column='ind.x'):
+        self.task = task
+        self.inventory_dir = DEFAULT_INVENTORY_DIR if inventory_dir is None else inventory_dir
+        self.roi_dict = SUBJECT_FILTER_ROI_DICT if roi_dict is None else roi_dict
+        self.region_columns = ['stein.region', 'ind.region'] if region_columns is None else list(region_columns)
+        self.x_coord_column = x_coord_column
+        self.rois = list(self.roi_dict.keys())
+
+        # (subject, montage) -> counts array / source file fingerprint / error message
+        self._counts = {}
+        self._fingerprints = {}
+        self.errors = {}
+        self._table = None
+        self._load()
+
+    # -- Persistence --
+
+    @property
+    def path(self):
+        if not self.inventory_dir:
+            return None
+        return os.path.join(self.inventory_dir, self.task.replace('RAM_', '') + '.pkl')
+
+    @property
+    def settings_key(self):
+        """
+        Hash of everything the counts depend on besides the subjects' files.
+        """
+        settings = [self.roi_dict, self.region_columns, self.x_coord_column]
+        return hashlib.sha1(json.dumps(settings, sort_keys=True).encode()).hexdigest()
+
+    def _load(self):
+        if (self.path is None) or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'rb') as f:
+                saved = pickle.load(f)
+        except Exception:
+            return
+        if saved.get('settings_key') != self.settings_key:
+            return
+        self._counts = saved['counts']
+        self._fingerprints = saved['fingerprints']
+        self.errors = saved.get('errors', {})
+
+    def save(self):
+        """
+        Writes the inventory to self.path (atomically, so readers never see a partial file).
+        """
+        if self.path is None:
+            return self
+        os.makedirs(self.inventory_dir, exist_ok=True)
+        tmp = self.path + '.' + uuid.uuid4().hex + '.tmp'
+        saved = {'settings_key': self.settings_key, 'counts': self._counts, 'fingerprints': self._fingerprints,
+                 'errors': self.errors}
+        with open(tmp, 'wb') as f:
+            pickle.dump(saved, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, self.path)
+        return self
+
+    # -- Building --
+
+    @staticmethod
+    def _source_fingerprint(subject, montage):
+        return _fingerprint(r1_source_files('contacts', subject, montage))
+
+    def stale(self, subjs=None):
+        """
+        Returns the (subject, montage) pairs that are not in the inventory or whose contacts file has changed.
+
+        Parameters
+        ----------
+        subjs: pandas.DataFrame
+            Subjects to check, with 'subject' and 'montage' columns. Default: every subject of the task
+        """
+        subjs = get_subjs_and_montages(self.task) if subjs is None else subjs
+        out = []
+        for subject, montage in zip(subjs['subject'], subjs['montage']):
+            key = (str(subject), int(montage))
+            if (key not in self._counts) or (self._fingerprints.get(key) != self._source_fingerprint(*key)):
+                out.append(key)
+        return out
+
+    def update(self, subjs=None, force=False, n_workers=1, progress=True):
+        """
+        Counts the subjects that are missing or out of date and saves the inventory.
+
+        Parameters
+        ----------
+        subjs: pandas.DataFrame
+            Subjects to include, with 'subject' and 'montage' columns. Default: every subject of the task
+        force: bool
+            Recount every subject
+        n_workers: int
+            Number of processes to load subjects with (see group.run_group)
+        progress: bool
+            Show a progress bar
+
+        Returns
+        -------
+        ElectrodeInventory
+            self
+        """
+        subjs = get_subjs_and_montages(self.task) if subjs is None else subjs
+        if force:
+            todo = [(str(s), int(m)) for s, m in zip(subjs['subject'], subjs['montage'])]
+        else:
+            todo = self.stale(subjs)
+        if not todo:
+            return self
+
+        jobs = [((subject, montage), (self.task, subject, montage, self.roi_dict, self.region_columns,
+                                      self.x_coord_column)) for subject, montage in todo]
+        for result in run_group(_subject_job, jobs, n_workers=n_workers, progress=progress):
+            if result.error is not None:
+                print('Error {}: {}'.format(result.key[0], result.error.message))
+                self.errors[result.key] = result.error.message
+                continue
+            self._counts[result.key] = result.value
+            self._fingerprints[result.key] = self._source_fingerprint(*result.key)
+            self.errors.pop(result.key, None)
+        self._table = None
+        return self.save()
+
+    def remove(self, subject, montage=0):
+        """
+        Drops a subject / montage from the inventory (it is counted again on the next update).
+        """
+        key = (str(subject), int(montage))
+        self._counts.pop(key, None)
+        self._fingerprints.pop(key, None)
+        self._table = None
+        return self
+
+    # -- Queries --
+
+    @property
+    def table(self):
+        """
+        The counts as a DataFrame, one row per (subject, montage) and one column per (kind, roi, hemi).
+        """
+        if self._table is None:
+            columns = pd.MultiIndex.from_product([KINDS, self.rois, HEMISPHERES], names=['kind', 'roi', 'hemi'])
+            keys = sorted(self._counts)
+            index = pd.MultiIndex.from_tuples(keys, names=['subject', 'montage'])
+            data = np.stack([self._counts[key].reshape(-1) for key in keys]) if keys else \
+                np.zeros((0, len(columns)), dtype=np.int32)
+            self._table = pd.DataFrame(data, index=index, columns=columns)
+        return self._table
+
+    @property
+    def subjects(self):
+        """
+        The (subject, montage) pairs in the inventory, as a DataFrame like get_subjs_and_montages() returns.
+        """
+        return self.table.index.to_frame(index=False)
+
+    def count(self, kind, roi, hemi=None):
+        """
+        Returns the number of contacts (kind='contacts') or stim sites (kind='stim') of every subject in an ROI.
+
+        Parameters
+        ----------
+        kind: str
+            'contacts' or 'stim'
+        roi: str or list
+            ROI name(s). With a list, the counts of each ROI are added
+        hemi: str
+            'left' or 'right'. Default: both
+
+        Returns
+        -------
+        pandas.Series
+            Indexed by (subject, montage)
+        """
+        if kind not in KINDS:
+            raise ValueError('kind must be one of {}'.format(KINDS))
+        rois = [roi] if isinstance(roi, str) else list(roi)
+        unknown = [r for r in rois if r not in self.rois]
+        if unknown:
+            raise KeyError('Unknown ROIs {}'.format(unknown))
+        hemis = HEMISPHERES if hemi is None else [hemi]
+        table = self.table[kind]
+        return sum(table[(r, h)] for r in rois for h in hemis)
+
+    def _conditions_mask(self, kind, conditions):
+        """
+        conditions: dict of roi or (roi, hemi) -> minimum count. An ROI or list of ROIs means a minimum of 1.
+        """
+        mask = pd.Series(True, index=self.table.index)
+        if conditions is None:
+            return mask
+        if isinstance(conditions, (str, tuple, list)):
+            conditions = {conditions if not isinstance(conditions, list) else tuple(conditions): 1}
+        for roi, min_count in conditions.items():
+            roi, hemi = roi if (isinstance(roi, tuple) and len(roi) == 2 and roi[1] in HEMISPHERES) else (roi, None)
+            roi = list(roi) if isinstance(roi, tuple) else roi
+            mask &= self.count(kind, roi, hemi) >= min_count
+        return mask
+
+    def select(self, contacts=None, stim=None):
+        """
+        Returns the subjects meeting every condition.
+
+        Parameters
+        ----------
+        contacts: dict
+            Minimum number of contacts per ROI, as {roi: n} or {(roi, hemi): n} (ex: {'Hipp': 2})
+        stim: dict, str or tuple
+            Minimum number of stim sites per ROI, in the same form (ex: {('MTL', 'left'): 1}). An ROI name or an
+            (roi, hemi) tuple means at least one stim site there
+
+        Returns
+        -------
+        pandas.DataFrame
+            'subject' and 'montage' columns, like get_subjs_and_montages()
+        """
+        mask = self._conditions_mask('contacts', contacts) & self._conditions_mask('stim', stim)
+        return self.table.index[mask.to_numpy()].to_frame(index=False)
+
+    def mask(self, subjs, contacts=None, stim=None):
+        """
+        Returns a boolean mask over the rows of subjs (ex: from get_subjs_and_montages()), True for subjects meeting
+        every condition (see select()). Subjects not in the inventory are False.
+        """
+        selected = set(self.select(contacts, stim).itertuples(index=False, name=None))
+        return np.array([(str(s), int(m)) in selected for s, m in zip(subjs['subject'], subjs['montage'])],
+                        dtype=bool)
@@ -0,0 +1,324 @@
+"""
+Electrode localization for subjects outside the r1 protocol, from the old matlab / text files (legacy_loc).
+"""
+
+import os
+import pickle
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+from scipy.io import loadmat
+
+DEFAULT_EEG_ROOT = '/data/eeg'
+DEFAULT_MASTER_FILE = '/data/eeg/tal/allTalLocs_GM.mat'
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'neuro', 'legacy_loc')
+
+# older montage names that are depth electrodes
+DEPTH_MONTAGES = ['hipp', 'inf']
+
+
+def subject_montage(subject, montage=0):
+    """
+    The legacy name of a subject / montage (ex: 'TJ001' for montage 0, 'TJ001_1' for montage 1).
+    """
+    return subject if int(montage) == 0 else subject + '_' + str(montage)
+
+
+def unpack_structs(structs, prefix=''):
+    """
+    Returns a DataFrame with one row per struct and one column per field, from an object array of matlab structs (as
+    loadmat(squeeze_me=True) gives for a struct field, ex: 'avgSurf').
+
+    When every struct has the same fields (the usual case) they are concatenated into one record array and converted in
+    one go. Otherwise each field is gathered across structs, with NaN where a struct doesn't have it.
+
+    Parameters
+    ----------
+    structs: numpy.ndarray
+        Object array of 0-d structured arrays
+    prefix: str
+        Prefix for the column names (ex: 'avg' gives 'avg.x', 'avg.y', ...)
+    """
+    records = [np.atleast_1d(s) for s in np.atleast_1d(structs)]
+    names = list(dict.fromkeys(name for r in records if r.dtype.names for name in r.dtype.names))
+    if records and all(r.dtype == records[0].dtype for r in records) and records[0].dtype.names:
+        df = pd.DataFrame.from_records(np.concatenate(records))
+    else:
+        df = pd.DataFrame({name: [r[name][0] if (r.dtype.names and name in r.dtype.names) else np.nan for r in records]
+                           for name in names}, index=pd.RangeIndex(len(records)))
+    if prefix:
+        df.columns = ['{}.{}'.format(prefix, name) for name in df.columns]
+    return df
+
+
+def load_subject_tal_file(tal_path, bipolar=False):
+    """
+    Loads a subject's own talairach matlab file (<subject>/tal/<subject>_talLocs_database_(bipol|monopol).mat).
+    """
+    elec_raw = loadmat(tal_path, squeeze_me=True)
+    elec_raw = elec_raw[np.setdiff1d(list(elec_raw.keys()), ['__header__', '__version__', '__globals__'])[0]]
+
+    # some of the data is in sub-structs, flatten those into prefixed columns
+    surf_data = []
+    exclude = []
+    for field, prefix in [('avgSurf', 'avg'), ('indivSurf', 'ind')]:
+        if field in elec_raw.dtype.names:
+            surf_data.append(unpack_structs(elec_raw[field], prefix))
+            exclude.append(field)
+
+    elec_df = pd.DataFrame.from_records(elec_raw, exclude=exclude)
+    elec_df = pd.concat([elec_df] + surf_data, axis='columns')
+
+    # add new columns for contacts, named the same as the json version
+    if bipolar:
+        elec_df['contact_1'], elec_df['contact_2'] = np.stack(elec_df['channel'], -1)
+    return elec_df
+
+
+def read_jacksheet(path):
+    """
+    Reads a jacksheet.txt (channel number and label per line). Returns None if there isn't one.
+    """
+    if not os.path.exists(path):
+        return None
+    jacksheet_df = pd.read_table(path, header=None, names=['channel', 'label'], sep=' ')
+    jacksheet_df['channel'] = jacksheet_df['channel'].astype(object)
+    return jacksheet_df
+
+
+def read_depth_info(path):
+    """
+    Reads a depth_el_info.txt into channel / locs columns. Returns None if there isn't one.
+
+    Columns are separated by spaces, which also appear inside the locations, so every line is split on whitespace and
+    lines that have more than two entries and start with an integer are kept, the location being everything after the
+    second entry.
+    """
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as f:
+        lines = pd.Series(f.read().splitlines(), dtype=object)
+    parts = lines.str.split()
+    keep = (parts.str.len() > 2) & parts.str[0].str.fullmatch(r'[+-]?\d+').fillna(False).astype(bool)
+    parts = parts[keep]
+    return pd.DataFrame({'channel': parts.str[0].astype(int).astype(object).to_numpy(),
+                         'locs': parts.str[2:].str.join(' ').to_numpy(dtype=object)})
+
+
+class LegacyLocalization:
+    """
+    Loader for non-r1 electrode localizations. The master file is read once, on first use.
+
+    Parameters
+    ----------
+    master_file: str
+        The multi-subject talairach file. Default: /data/eeg/tal/allTalLocs_GM.mat
+    eeg_root: str
+        Root of the per-subject directories (<eeg_root>/<subject>/tal, <eeg_root>/<subject>/docs)
+    cache_dir: str
+        Where to keep the pickled master table. Set to False to disable the disk copy
+    """
+    def __init__(self, master_file=DEFAULT_MASTER_FILE, eeg_root=DEFAULT_EEG_ROOT, cache_dir=None):
+        self.master_file = master_file
+        self.eeg_root = eeg_root
+        self.cache_dir = DEFAULT_CACHE_DIR if cache_dir is None else cache_dir
+
+        # Built on first use
+        self._master = None
+        self._by_subject = None
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # workers rebuild from the disk copy rather than receiving the whole table
+        return {'master_file': self.master_file, 'eeg_root': self.eeg_root, 'cache_dir': self.cache_dir}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    # -- Master file --
+
+    def _source_fingerprint(self):
+        try:
+            st = os.stat(self.master_file)
+            return st.st_mtime_ns, st.st_size
+        except OSError:
+            return None
+
+    @property
+    def master(self):
+        """
+        The master file as one DataFrame, sorted by subject.
+        """
+        if self._master is None:
+            with self._lock:
+                if self._master is None:
+                    self._load_master()
+        return self._master
+
+    def _load_master(self):
+        fingerprint = self._source_fingerprint()
+        cache_path = os.path.join(self.cache_dir, os.path.basename(self.master_file) + '.pkl') if self.cache_dir \
+            else None
+
+        master = None
+        if (cache_path is not None) and (fingerprint is not None) and os.path.exists(cache_path):
+            try:
+                with open(cache_path, 'rb') as f:
+                    cached = pickle.load(f)
+                if cached['fingerprint'] == fingerprint:
+                    master = cached['data']
+            except Exception:
+                master = None
+
+        if master is None:
+            if fingerprint is None:
+                master = pd.DataFrame(columns=['subject', 'channel'])
+            else:
+                master = pd.DataFrame(loadmat(self.master_file, squeeze_me=True)['events'])
+                master = master.sort_values('subject', kind='stable').reset_index(drop=True)
+                if cache_path is not None:
+                    self._save(cache_path, fingerprint, master)
+
+        # subject -> slice of rows
+        subjects = master['subject'].astype(str).to_numpy()
+        starts = np.flatnonzero(np.r_[True, subjects[1:] != subjects[:-1]]) if len(subjects) else np.array([], int)
+        stops = np.r_[starts[1:], len(subjects)]
+        self._by_subject = {subjects[start]: slice(start, stop) for start, stop in zip(starts, stops)}
+        self._master = master
+
+    @staticmethod
+    def _save(cache_path, fingerprint, data):
+        try:
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            tmp = cache_path + '.' + uuid.uuid4().hex + '.tmp'
+            with open(tmp, 'wb') as f:
+                pickle.dump({'fingerprint': fingerprint, 'data': data}, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, cache_path)
+        except OSError:
+            pass
+
+    def refresh(self):
+        """
+        Forces the master file to be read again on next use.
+        """
+        self._master = None
+
+    def master_subject(self, subj_mont):
+        """
+        Returns the master file rows of one subject (ex: 'TJ001' or 'TJ001_1').
+        """
+        master = self.master
+        return master.iloc[self._by_subject.get(subj_mont, slice(0, 0))].reset_index(drop=True)
+
+    # -- Per subject files --
+
+    def tal_path(self, subj_mont, bipolar=False):
+        file_str = '_bipol' if bipolar else '_monopol'
+        return os.path.join(self.eeg_root, subj_mont, 'tal', subj_mont + '_talLocs_database' + file_str + '.mat')
+
+    def jacksheet(self, subj_mont):
+        return read_jacksheet(os.path.join(self.eeg_root, subj_mont, 'docs', 'jacksheet.txt'))
+
+    def depth_info(self, subj_mont):
+        return read_depth_info(os.path.join(self.eeg_root, subj_mont, 'docs', 'depth_el_info.txt'))
+
+    def load(self, subject, montage=0, bipolar=False):
+        """
+        Loads the electrode info of a non-r1 subject, the same table load_electrode_info always returned for them.
+
+        There are two possible sources:
+            1. the subject's own talLocs_database file in its 'tal' directory
+            2. the subject's rows of the master file, with labels from its jacksheet and depth localizations from
+               depth_el_info.txt. Monopolar only
+
+        Parameters
+        ----------
+        subject: str
+            subject code
+        montage: int
+            montage number
+        bipolar: bool
+            whether to return electrode info for bipolar or monopolar electrode configuration
+
+        Returns
+        -------
+        pandas.DataFrame
+            None if bipolar is asked for and there is only the master file
+        """
+        subj_mont = subject_montage(subject, montage)
+        tal_path = self.tal_path(subj_mont, bipolar)
+
+        # Option 1: the subject has a talLoc.mat file within their own 'tal' directory
+        if os.path.exists(tal_path):
+            elec_df = load_subject_tal_file(tal_path, bipolar)
+
+        # Option 2: there is no subject specific file, use the master file
+        else:
+            if bipolar:
+                print('Bipolar not supported for {}.'.format(subject))
+                return
+
+            elec_df = self.master_subject(subj_mont)
+
+            # add electrode type column
+            elec_df['type'] = np.where(np.isin(elec_df['montage'], DEPTH_MONTAGES), 'D', 'S')
+
+            # add labels from jacksheet
+            jacksheet_df = self.jacksheet(subj_mont)
+            if jacksheet_df is not None:
+                elec_df = pd.merge(elec_df, jacksheet_df, on='channel', how='inner')
+
+            # add depth_el_info (depth electrode localization)
+            depth_df = self.depth_info(subj_mont)
+            if depth_df is not None:
+                elec_df = pd.merge(elec_df, depth_df, on='channel', how='outer')
+
+        # relabel some more columns to be consistent
+        elec_df = elec_df.rename(columns={'channel': 'contact', 'tagName': 'label', 'eType': 'type'})
+        if 'label' not in elec_df:
+            elec_df['label'] = ['elec_' + str(x) for x in elec_df['contact']]
+        return elec_df
+
+    def load_many(self, subjects, bipolar=False, n_workers=8):
+        """
+        Loads several subjects, reading the master file once and the per-subject files with a thread pool.
+
+        Parameters
+        ----------
+        subjects: list or pandas.DataFrame
+            (subject, montage) pairs, or a DataFrame with 'subject' and 'montage' columns
+        bipolar: bool
+            whether to return bipolar or monopolar electrode info
+        n_workers: int
+            Number of threads
+
+        Returns
+        -------
+        dict
+            (subject, montage) -> DataFrame (or None, see load())
+        """
+        if isinstance(subjects, pd.DataFrame):
+            subjects = list(zip(subjects['subject'], subjects['montage']))
+        subjects = [(str(subject), int(montage)) for subject, montage in subjects]
+
+        # read the master file here, not once per thread
+        if not bipolar:
+            self.master
+        with ThreadPoolExecutor(max_workers=max(1, n_workers)) as pool:
+            loaded = pool.map(lambda key: self.load(key[0], key[1], bipolar), subjects)
+            return dict(zip(subjects, loaded))
+
+    def has_subject(self, subject, montage=0):
+        """
+        True if this subject / montage has a localization file of its own or rows in the master file.
+        """
+        subj_mont = subject_montage(subject, montage)
+        self.master
+        return os.path.exists(self.tal_path(subj_mont)) or (subj_mont in self._by_subject)
+
+
+# one shared instance for every module
+legacy_loc = LegacyLocalization()
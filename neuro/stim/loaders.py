@@ -3,31 +3,35 @@ Wrappers around cmlreaders and PTSA to load events, electrode information, eeg d
 This is a bit more high level and more geared towards helping users do some commonly performed tasks with the data.
 """
 
+import functools
 import numexpr
 import os
 import warnings
 import numpy as np
 import pandas as pd
 import xarray as xr
-import bottleneck as bn
 import h5py
 
-from ptsa.data.filters import ButterworthFilter
 from ptsa.data.filters import MorletWaveletFilter
-from ptsa.data.filters import ResampleFilter
 from ptsa.data.timeseries import TimeSeries
 
-from cmlreaders import CMLReader, get_data_index
-from scipy.stats.mstats import zscore
+from cmlreaders import CMLReader
 from scipy.io import loadmat
 from tqdm import tqdm
 from glob import glob
 
-# get the r1 dataframe on import so we don't have to keep doing it
-try:
-    r1_data = get_data_index("r1")
-except KeyError:
-    print('r1 protocol file not found')
+from neuro.stim.eeg_filters import butterworth_filter, line_noise_filter, resample_timeseries
+from neuro.stim.eeg_stream import iter_session_eeg_blocks
+from neuro.stim.events import expand_events, filter_events, load_task_events
+from neuro.stim.legacy_loc import legacy_loc
+from neuro.stim.normalize import SessionStats
+from neuro.stim.power import bin_indices, bin_means, morlet_power
+from neuro.stim.profiling import call_collecting, enabled, merge, profiled, span
+from neuro.stim.r1_index import r1_index
+from neuro.stim.precision import get_policy
+from neuro.stim.read_planner import load_planned_eeg
+from neuro.stim.reref import monopolar_scheme, rereference
+from neuro.stim.roi import SUBJECT_FILTER_ROI_DICT, RoiClassifier, coalesce_regions
 
 
 def get_subjs_and_montages(task):
@@ -46,8 +50,8 @@ def get_subjs_and_montages(task):
 
     # if this is RAM task, load the subject/montage directly from the r1 database
     task = task.replace('RAM_', '')
-    if task in r1_data.experiment.unique():
-        df = r1_data[r1_data['experiment'] == task][['subject', 'montage']].drop_duplicates().reset_index(drop=True)
+    if r1_index.has_experiment(task):
+        df = r1_index.subjects_and_montages(task)
 
     # otherwise, need to look for *events.mat files in '/data/events/task
     else:
@@ -69,7 +73,8 @@ def get_subjs_and_montages(task):
     return df
 
 
-def load_subj_events(task, subject, montage, as_df=True, remove_no_eeg=False):
+def load_subj_events(task, subject, montage, as_df=True, remove_no_eeg=False, columns=None, event_types=None,
+                     n_workers=None):
     """Returns a DataFrame of the events.
 
     Parameters
@@ -84,6 +89,12 @@ def load_subj_events(task, subject, montage, as_df=True, remove_no_eeg=False):
         If true, the events will returned as a pandas.DataFrame, otherwise a numpy.recarray
     remove_no_eeg: bool
         If true, an events with missing 'eegfile' info will be removed. Recommended when you are doing EEG analyses
+    columns: list
+        Columns to keep. Default: all
+    event_types: list
+        Keep only events of these types (ex: ['WORD'] or ['STIM_ON', 'STIM_OFF'])
+    n_workers: int
+        Number of sessions read at once (see neuro.stim.events.load_task_events)
 
     Returns
     -------
@@ -93,20 +104,10 @@ def load_subj_events(task, subject, montage, as_df=True, remove_no_eeg=False):
     task = task.replace('RAM_', '')
 
     # if a RAM task, get info from r1 database and load as df using cmlreader
-    if task in r1_data.experiment.unique():
-        # get list of sessions for this subject, experiment, montage
-        inds = (r1_data['subject'] == subject) & (r1_data['experiment'] == task) & (r1_data['montage'] == int(montage))
-        sessions = r1_data[inds]['session'].unique()
-
-        # load all and concat
-        events = pd.concat([CMLReader(subject=subject,
-                                      experiment=task,
-                                      session=session).load('events')
-                            for session in sessions])
-
-        # also remove events without eegfiles
-        if remove_no_eeg:
-            events = events[events.eegfile.apply(len) > 0]
+    if r1_index.has_experiment(task):
+        # load every session at once, filtered and projected as they are read
+        events = load_task_events(subject, task, montage, columns=columns, event_types=event_types,
+                                  remove_no_eeg=remove_no_eeg, n_workers=n_workers)
 
         if not as_df:
             events = events.to_records(index=False)
@@ -125,9 +126,8 @@ def load_subj_events(task, subject, montage, as_df=True, remove_no_eeg=False):
             if 'experiment' not in events:
                 events['experiment'] = task
 
-            # also remove events without eegfiles
-            if remove_no_eeg:
-                events = events[events.eegfile.apply(len) > 0]
+            # keep the requested events and columns
+            events = filter_events(events, columns=columns, event_types=event_types, remove_no_eeg=remove_no_eeg)
 
     return events
 
@@ -151,168 +151,28 @@ def load_elec_info(subject, montage=0, bipolar=True):
 
     """
 
-    ############################################################
-    # custom loading functions for different types of old data #
-    # this code used to be so much nicer before this :(        #
-    ############################################################
-    def load_loc_from_subject_tal_file(tal_path):
-        """
-        Load a subject's talaraich matlab file.
-        """
-        elec_raw = loadmat(tal_path, squeeze_me=True)
-        elec_raw = elec_raw[np.setdiff1d(list(elec_raw.keys()), ['__header__', '__version__', '__globals__'])[0]]
-
-        # sume of the data is in subarrays, flatten it, and make dataframe. Eeessh
-        # also rename some of the fields/columns
-        # make average surface dataframe
-        surf_data = []
-        exclude = []
-        if 'avgSurf' in elec_raw.dtype.names:
-            avg_surf = pd.concat([pd.DataFrame(index=[i], data=e) for (i, e) in enumerate(elec_raw['avgSurf'])],
-                                 sort=False)
-            avg_surf = avg_surf.rename(columns={x: 'avg.{}'.format(x) for x in avg_surf.columns})
-            surf_data.append(avg_surf)
-            exclude.append('avgSurf')
-
-        # make indiv surface dataframe
-        if 'indivSurf' in elec_raw.dtype.names:
-            ind_surf = pd.concat([pd.DataFrame(index=[i], data=e) for (i, e) in enumerate(elec_raw['indivSurf'])],
-                                 sort=False)
-            ind_surf = ind_surf.rename(columns={x: 'ind.{}'.format(x) for x in ind_surf.columns})
-            surf_data.append(ind_surf)
-            exclude.append('indivSurf')
-
-        # concat them, excluding the original subarrays
-        elec_df = pd.DataFrame.from_records(elec_raw, exclude=exclude)
-        elec_df = pd.concat([elec_df] + surf_data, axis='columns')
-
-        # add new columns for contacts, named the same as the json version
-        if bipolar:
-            elec_df['contact_1'], elec_df['contact_2'] = np.stack(elec_df['channel'], -1)
-            elec_df.drop(columns='channel')
-        return elec_df
-
-    def load_loc_from_tal_GM_file(subj_mont):
-        """
-        Load master data file of older subject talairach info and return just this subject
-        """
-        tal_master_data = loadmat('/data/eeg/tal/allTalLocs_GM.mat', squeeze_me=True)['events']
-        subj_tal = tal_master_data[tal_master_data['subject'] == subj_mont]
-        return pd.DataFrame(subj_tal)
-
-    def add_jacksheet_label(subj_mont):
-        """
-        Load the subject jacksheet in order to get the electrode labels
-        """
-        jacksheet_df = []
-        f = os.path.join('/data/eeg', subj_mont, 'docs', 'jacksheet.txt')
-        if os.path.exists(f):
-            jacksheet_df = pd.read_table(f, header=None, names=['channel', 'label'], sep=' ')
-            jacksheet_df['channel'] = jacksheet_df['channel'].astype(object)
-        return jacksheet_df
-
-    def add_depth_info(subj_mont):
-        """
-        Load the 'depth_el_info.txt' file in order to get depth elec localizations
-        """
-        depth_df = []
-        f = os.path.join('/data/eeg', subj_mont, 'docs', 'depth_el_info.txt')
-        if os.path.exists(f):
-            contacts = []
-            locs = []
-
-            # can't just read it in with pandas bc they use spaces as a column sep as well as in values wtf
-            with open(f, 'r') as depth_info:
-                for line in depth_info:
-                    line_split = line.split()
-
-                    # formatting of these files is not very consistent
-                    if len(line_split) > 2:
-
-                        # this is a weak check, but make sure we can cast the first entry to an int
-                        try:
-                            contact = int(line_split[0])
-                            contacts.append(contact)
-                            locs.append(' '.join(line_split[2:]))
-                        except ValueError:
-                            pass
-            depth_df = pd.DataFrame(data=[contacts, locs]).T
-            depth_df.columns = ['channel', 'locs']
-        return depth_df
-
-    def add_neuroad_info(subj_mont):
-        return
-
-    #######################################
-    # electrode loading logic begins here #
-    #######################################
-
     # check if this subject/montage is in r1. If it is, use cmlreaders to load it. Easy.
-    if np.any((r1_data['subject'] == subject) & (r1_data['montage'] == montage)):
+    if r1_index.has_montage(subject, montage):
         elec_df = CMLReader(subject=subject, montage=montage).load('pairs' if bipolar else 'contacts')
 
-    # if not in r1 protocol, annoying, there are multiple possible locations for matlab data
+    # if not in r1 protocol, annoying, there are multiple possible locations for matlab data. See legacy_loc
     else:
-
-        # Option 1: the subject as a talLoc.mat file within their own 'tal' directory
-        subj_mont = subject
-        if int(montage) != 0:
-            subj_mont = subject + '_' + str(montage)
-        file_str = '_bipol' if bipolar else '_monopol'
-        tal_path = os.path.join('/data/eeg', subj_mont, 'tal', subj_mont + '_talLocs_database' + file_str + '.mat')
-
-        if os.path.exists(tal_path):
-            elec_df = load_loc_from_subject_tal_file(tal_path)
-
-        # Option 2: there is no subject specific file, look in the older aggregate file. Lot's of steps.
-        else:
-            if bipolar:
-                print('Bipolar not supported for {}.'.format(subject))
-                return
-
-            # load subject specific data from master file
-            elec_df = load_loc_from_tal_GM_file(subj_mont)
-
-            # add electrode type column
-            e_type = np.array(['S'] * elec_df.shape[0])
-            e_type[np.in1d(elec_df.montage, ['hipp', 'inf'])] = 'D'
-            elec_df['type'] = e_type
-
-            # add labels from jacksheet
-            jacksheet_df = add_jacksheet_label(subj_mont)
-            if isinstance(jacksheet_df, pd.DataFrame):
-                elec_df = pd.merge(elec_df, jacksheet_df, on='channel', how='inner', left_index=False,
-                                   right_index=False)
-
-            # add depth_el_info (depth electrode localization)
-            depth_el_info_df = add_depth_info(subj_mont)
-            if isinstance(depth_el_info_df, pd.DataFrame):
-                elec_df = pd.merge(elec_df, depth_el_info_df, on='channel', how='outer', left_index=False,
-                                   right_index=False)
-
-                # to do
-                # also attempt to load additional information from the "neurorad_localization.txt" file, if exists
-
-        # relabel some more columns to be consistent
-        elec_df = elec_df.rename(columns={'channel': 'contact',
-                                          'tagName': 'label',
-                                          'eType': 'type'})
-
-        if 'label' not in elec_df:
-            elec_df['label'] = elec_df['contact'].apply(lambda x: 'elec_' + str(x))
+        elec_df = legacy_loc.load(subject, montage, bipolar)
 
     return elec_df
 
 
+@profiled()
 def load_eeg(events, rel_start_ms, rel_stop_ms, buf_ms=0, elec_scheme=None, noise_freq=[58., 62.],
-             resample_freq=None, pass_band=None, use_mirror_buf=False, demean=False, do_average_ref=False):
+             resample_freq=None, pass_band=None, use_mirror_buf=False, demean=False, do_average_ref=False,
+             chan_chunk=None, coalesce_gap_ms=None, reference=None, precision=None):
     """
     Returns an EEG TimeSeries object.
 
     Parameters
     ----------
     events: pandas.DataFrame
-        An events dataframe that contains eegoffset and eegfile fields
+        An events dataframe that contains eegoffset and eegfile fields. May be compact (see events.compact_events)
     rel_start_ms: int
         Initial time (in ms), relative to the onset of each event
     rel_stop_ms: int
@@ -340,6 +200,20 @@ def load_eeg(events, rel_start_ms, rel_stop_ms, buf_ms=0, elec_scheme=None, nois
         If True, will subject the mean voltage between rel_start_ms and rel_stop_ms from each channel
     do_average_ref: bool
         If True, will compute the average reference based on the mean voltage across channels
+    chan_chunk: int
+        If given, filtering and resampling are run on this many channels at a time instead of all at once. Only needed
+        to limit memory on very large loads
+    coalesce_gap_ms: float
+        If given, epochs are read with the read planner (see read_planner): epochs in the same eeg file that overlap
+        or are at most this many ms apart are read in one sequential read and sliced apart. Same result, far fewer
+        reads for dense events like stim sessions
+    reference: str
+        If given, each monopolar contact elec_scheme needs is read once and the channels are computed from them (see
+        reref): 'bipolar' (elec_scheme must be pairs; same channels as reading the pairs, for about half the channel
+        reads on depth leads), 'average' or 'laplacian' (channels are the contacts of elec_scheme)
+    precision: PrecisionPolicy
+        dtype the eeg is computed in (float32 by default) and where upcasts are recorded (see precision). Also sets
+        chan_chunk, if not given, to keep the filters' float64 working copy within the policy's work_bytes
 
     Returns
     -------
@@ -351,8 +225,14 @@ def load_eeg(events, rel_start_ms, rel_stop_ms, buf_ms=0, elec_scheme=None, nois
 
     """
 
+    # cmlreaders needs the usual events layout, not the compact one
+    events = expand_events(events)
+
+    # with a reference, the monopolar contacts are read and the channels computed from them
+    read_scheme = elec_scheme if reference is None else monopolar_scheme(elec_scheme)
+
     # check if monopolar is possible for this subject
-    if 'contact' in elec_scheme:
+    if 'contact' in read_scheme:
         eegfile = np.unique(events.eegfile)[0]
         if os.path.splitext(eegfile)[1] == '.h5':
             eegfile = f'/protocols/r1/subjects/{events.iloc[0].subject}/experiments/{events.iloc[0].experiment}/sessions/{events.iloc[0].session}/ephys/current_processed/noreref/{eegfile}'
@@ -370,34 +250,51 @@ def load_eeg(events, rel_start_ms, rel_stop_ms, buf_ms=0, elec_scheme=None, nois
         actual_stop = rel_stop_ms
 
     # load eeg
-    eeg = CMLReader(subject=events.iloc[0].subject).load_eeg(events, rel_start=actual_start, rel_stop=actual_stop,
-                                                             scheme=elec_scheme).to_ptsa()
-
-    # now auto cast to float32 to help with memory issues with high sample rate data
-    eeg.data = eeg.data.astype('float32')
+    policy = get_policy(precision)
+    with span('read', n_events=len(events), n_channels=None if read_scheme is None else len(read_scheme)) as s:
+        if coalesce_gap_ms is not None:
+            eeg = load_planned_eeg(events, actual_start, actual_stop, elec_scheme=read_scheme,
+                                   max_gap_ms=coalesce_gap_ms, dtype=policy.compute if reference is None else None)
+        else:
+            eeg = CMLReader(subject=events.iloc[0].subject).load_eeg(events, rel_start=actual_start,
+                                                                     rel_stop=actual_stop, scheme=read_scheme).to_ptsa()
+        s.array(eeg)
+
+    # bipolar / average / laplacian channels from the monopolar contacts, all at once. Done on the data as read, so
+    # bipolar channels are the same as reading the pairs
+    if reference is not None:
+        with span('reref', reference=reference) as s:
+            eeg = s.array(rereference(eeg, elec_scheme, reference))
+
+    # now convert to the compute dtype (float32) to help with memory issues with high sample rate data. After each
+    # step below, anything that came back wider is cast back and recorded by the policy
+    with span('astype') as s:
+        eeg = s.array(policy.convert(eeg))
+    chan_chunk = policy.chan_chunk(eeg, chan_chunk)
 
     # baseline correct subracting the mean within the baseline time range
     if demean:
-        eeg = eeg.baseline_corrected([rel_start_ms, rel_stop_ms])
+        with span('demean'):
+            eeg = policy.cast(eeg.baseline_corrected([rel_start_ms, rel_stop_ms]), 'demean')
 
     # compute average reference by subracting the mean across channels
     if do_average_ref:
-        eeg = eeg - eeg.mean(dim='channel')
+        with span('average_ref'):
+            eeg = policy.cast(eeg - eeg.mean(dim='channel'), 'average_ref')
 
     # add mirror buffer if using. PTSA is expecting this to be in seconds.
     if use_mirror_buf:
-        eeg = eeg.add_mirror_buffer(buf_ms / 1000.)
+        with span('mirror_buffer'):
+            eeg = policy.cast(eeg.add_mirror_buffer(buf_ms / 1000.), 'mirror_buffer')
 
     # filter line noise
     if noise_freq is not None:
         #if isinstance(noise_freq[0], float):
         #    noise_freq = [noise_freq]
 
-        b_filter = ButterworthFilter(freq_range = noise_freq, filt_type ='stop', order = 4)
-        for this_chan in range(eeg.shape[1]):
-            this_eeg = eeg[:, this_chan:this_chan+1]
-            filtered_eeg = b_filter.filter(timeseries = this_eeg)
-            eeg[:, this_chan:this_chan+1] = filtered_eeg
+        # all channels and events at once, in place
+        with span('line_noise'):
+            eeg = policy.cast(line_noise_filter(eeg, noise_freq, order=4, chan_chunk=chan_chunk), 'line_noise')
 
         ## cmh220928 below is deprecated 
         # for this_noise_freq in noise_freq:
@@ -413,21 +310,15 @@ def load_eeg(events, rel_start_ms, rel_stop_ms, buf_ms=0, elec_scheme=None, nois
     #         r_filter = ResampleFilter(eeg[:, this_chan:this_chan+1], resample_freq)
     #         eeg[:, this_chan:this_chan + 1] = r_filter.filter()
 
+    # resample if desired, all channels in one pass
     if resample_freq is not None:
-        eeg_resamp = []
-        for this_chan in range(eeg.shape[1]):
-            r_filter = ResampleFilter(eeg[:, this_chan:this_chan + 1], resample_freq)
-            eeg_resamp.append(r_filter.filter())
-        coords = {x: eeg[x] for x in eeg.coords.keys()}
-        coords['time'] = eeg_resamp[0]['time']
-        coords['samplerate'] = resample_freq
-        dims = eeg.dims
-        eeg = TimeSeries.create(np.concatenate(eeg_resamp, axis=1), resample_freq, coords=coords,
-                                dims=dims)
+        with span('resample', resample_freq=resample_freq) as s:
+            eeg = s.array(policy.cast(resample_timeseries(eeg, resample_freq, chan_chunk=chan_chunk), 'resample'))
 
     # do band pass if desired.
     if pass_band is not None:
-        eeg = band_pass_eeg(eeg, pass_band)
+        with span('band_pass'):
+            eeg = policy.cast(band_pass_eeg(eeg, pass_band, chan_chunk=chan_chunk, inplace=True), 'band_pass')
 
     # reorder dims to make events first
     eeg = make_events_first_dim(eeg)
@@ -435,7 +326,7 @@ def load_eeg(events, rel_start_ms, rel_stop_ms, buf_ms=0, elec_scheme=None, nois
 
 
 def load_eeg_full_timeseries(task, subject, session,  elec_scheme=None, noise_freq=[58., 62.],
-                             resample_freq=None, pass_band=None):
+                             resample_freq=None, pass_band=None, block_s=None, pad_s=2., max_bytes=None):
     """
     Function for loading continuous EEG data from a full session, not based on event times.
     Returns a list of timeseries object.
@@ -453,34 +344,44 @@ def load_eeg_full_timeseries(task, subject, session,  elec_scheme=None, noise_fr
 
         If you do not enter an elec_scheme, all monopolar channels will be loaded (but they will not be labeled with
         correct channel tags). LOADING ALL ELECTRODES AND FOR AN ENTIRE SESSION AT ONCE IS NOT REALLY RECOMMENDED.
+        Use block_s or max_bytes to stream it instead.
     noise_freq: list
         Stop filter will be applied to the given range. Default=(58. 62)
     resample_freq: float
         Sampling rate to resample to after loading eeg
     pass_band: list
         If given, the eeg will be band pass filtered in the given range
+    block_s: float
+        If given (or if max_bytes is given), don't load the whole session. Instead return a generator that yields
+        consecutive blocks of this many seconds, filtered seamlessly across block boundaries.
+        See neuro.stim.eeg_stream.iter_session_eeg_blocks
+    pad_s: float
+        When streaming, the extra data read and discarded on each side of a block
+    max_bytes: int
+        When streaming, a hard cap on the memory used by one block
 
     Returns
     -------
     list
-        A TimeSeries object.
+        A TimeSeries object, or a generator of channels x time TimeSeries blocks if streaming.
     """
 
+    # stream in blocks if asked
+    if (block_s is not None) or (max_bytes is not None):
+        return iter_session_eeg_blocks(task, subject, session, elec_scheme=elec_scheme, block_s=block_s, pad_s=pad_s,
+                                       max_bytes=max_bytes, noise_freq=noise_freq, resample_freq=resample_freq,
+                                       pass_band=pass_band)
+
     # load eeg
     eeg = CMLReader(subject=subject, experiment=task, session=session).load_eeg(scheme=elec_scheme).to_ptsa()
 
     # filter line noise
     if noise_freq is not None:
-        if isinstance(noise_freq[0], float):
-            noise_freq = [noise_freq]
-        for this_noise_freq in noise_freq:
-            b_filter = ButterworthFilter(eeg, this_noise_freq, filt_type='stop', order=4)
-            eeg = b_filter.filter()
+        eeg = line_noise_filter(eeg, noise_freq, order=4)
 
-    # resample if desired. Note: can be a bit slow especially if have a lot of eeg data
+    # resample if desired
     if resample_freq is not None:
-        r_filter = ResampleFilter(eeg, resample_freq)
-        eeg = r_filter.filter()
+        eeg = resample_timeseries(eeg, resample_freq)
 
     # do band pass if desired.
     if pass_band is not None:
@@ -489,7 +390,7 @@ def load_eeg_full_timeseries(task, subject, session,  elec_scheme=None, noise_fr
     return eeg
 
 
-def band_pass_eeg(eeg, freq_range, order=4):
+def band_pass_eeg(eeg, freq_range, order=4, chan_chunk=None, inplace=False):
     """
     Runs a butterworth band pass filter on an eeg time seriesX object.
 
@@ -501,18 +402,24 @@ def band_pass_eeg(eeg, freq_range, order=4):
         List of two floats defining the range to filter in
     order: int
         Order of butterworth filter
+    chan_chunk: int
+        If given, filter this many channels at a time to limit memory
+    inplace: bool
+        If True, overwrite the data of eeg instead of returning a filtered copy
 
     Returns
     -------
     timeseries
         Filtered EEG object
     """
-    return ButterworthFilter(eeg, freq_range, filt_type='pass', order=order).filter()
+    return butterworth_filter(eeg, freq_range, filt_type='pass', order=order, chan_chunk=chan_chunk, inplace=inplace)
 
 
+@profiled()
 def compute_power(events, freqs, wave_num, rel_start_ms, rel_stop_ms, buf_ms=1000, elec_scheme=None,
                   noise_freq=[58., 62.], resample_freq=None, mean_over_time=True, log_power=True, loop_over_chans=True,
-                  cluster_pool=None, use_mirror_buf=False, time_bins=None, do_average_ref=False):
+                  cluster_pool=None, use_mirror_buf=False, time_bins=None, do_average_ref=False, engine='ptsa',
+                  max_bytes=int(1e9), reference=None, precision=None):
     """
     Returns a TimeSeries object of power values with dimensions 'events' x 'frequency' x 'bipolar_pairs/channels' x
     'time', unless mean_over_time is True, then no 'time' dimenstion.
@@ -555,10 +462,24 @@ def compute_power(events, freqs, wave_num, rel_start_ms, rel_stop_ms, buf_ms=100
     use_mirror_buf: bool
         If True, a mirror buffer will be (used see load_eeg) instead of a normal buffer
     time_bins: list or array
-        pairs of start and stop times in which to bin the data
+        pairs of start and stop times in which to bin the data. Bins may overlap or have different widths
     do_average_ref: bool
         If true, will load eeg and then compute an average reference before computing power. Note: This will load eeg
         for all channels at once, regardless of loop_over_chans or cluster_pool. Will still loop for power computation.
+    engine: str
+        'ptsa' (default) runs PTSA's MorletWaveletFilter as before. 'fft' loads the eeg for all channels once and
+        computes every frequency, channel and event with batched FFT convolutions (see power.morlet_power), which is
+        much faster. loop_over_chans and cluster_pool are ignored with 'fft'
+    max_bytes: int
+        Memory budget for the 'fft' engine's working arrays, and for time binning with either engine. Controls how
+        many events x channels are done at once
+    reference: str
+        If given ('bipolar', 'average' or 'laplacian'), the eeg for all channels is loaded once up front from one read
+        of the monopolar contacts (see load_eeg), instead of loading each channel (and so re-reading shared contacts)
+        in the loop
+    precision: PrecisionPolicy
+        dtype the eeg and power are computed in (see load_eeg). The power is returned in the policy's storage dtype,
+        and values it can't hold are recorded in the policy
     Returns
     -------
     timeseries object of power values
@@ -574,16 +495,29 @@ def compute_power(events, freqs, wave_num, rel_start_ms, rel_stop_ms, buf_ms=100
     if isinstance(freqs, list):
         freqs = np.array(freqs)
 
-    # if doing an average reference, load eeg first
-    if do_average_ref:
+    policy = get_policy(precision)
+
+    # if doing an average reference or re-referencing, load eeg first
+    if do_average_ref or (reference is not None):
         eeg_all_chans = load_eeg(events, rel_start_ms, rel_stop_ms, buf_ms=buf_ms, elec_scheme=elec_scheme,
                                  noise_freq=noise_freq, resample_freq=resample_freq, use_mirror_buf=use_mirror_buf,
-                                 do_average_ref=do_average_ref)
+                                 do_average_ref=do_average_ref, reference=reference, precision=precision)
     else:
         eeg_all_chans = None
 
+    # load once and do everything in batched FFTs
+    if engine == 'fft':
+        if eeg_all_chans is None:
+            eeg_all_chans = load_eeg(events, rel_start_ms, rel_stop_ms, buf_ms=buf_ms, elec_scheme=elec_scheme,
+                                     noise_freq=noise_freq, resample_freq=resample_freq, use_mirror_buf=use_mirror_buf,
+                                     precision=precision)
+        with span('wavelet', engine=engine, n_freqs=len(freqs)) as s:
+            wave_pow = s.array(morlet_power(eeg_all_chans, freqs, width=wave_num, buf_ms=buf_ms, log_power=log_power,
+                                            mean_over_time=mean_over_time, time_bins=time_bins, max_bytes=max_bytes))
+            wave_pow = policy.cast(wave_pow, 'wavelet')
+
     # We will loop over channels if desired or if we are are using a pool to parallelize
-    if cluster_pool or loop_over_chans:
+    elif cluster_pool or loop_over_chans:
 
         # must enter an elec scheme if we want to loop over channels
         if elec_scheme is None:
@@ -592,13 +526,22 @@ def compute_power(events, freqs, wave_num, rel_start_ms, rel_stop_ms, buf_ms=100
 
         # put all the inputs into one list. This is so because it is easier to parallize this way. Parallel functions
         # accept one input. The pool iterates over this list.
+        # (an average or laplacian reference of pairs has a channel per contact, not per row of elec_scheme)
+        n_chans = elec_scheme.shape[0] if eeg_all_chans is None else eeg_all_chans.sizes['channel']
         arg_list = [(events, freqs, wave_num, elec_scheme.iloc[r:r + 1], rel_start_ms, rel_stop_ms,
                      buf_ms, noise_freq, resample_freq, mean_over_time, log_power, use_mirror_buf, time_bins,
-                     eeg_all_chans[:, r:r + 1] if eeg_all_chans is not None else None)
-                    for r in range(elec_scheme.shape[0])]
+                     eeg_all_chans[:, r:r + 1] if eeg_all_chans is not None else None, policy, max_bytes)
+                    for r in range(n_chans)]
 
         # if no pool, just use regular map
-        if cluster_pool is not None:
+        if (cluster_pool is not None) and enabled():
+            # the pool's workers send their span records back with the power
+            collected = cluster_pool.map(functools.partial(call_collecting, _parallel_compute_power), arg_list)
+            pow_list = []
+            for pow_chan, records in collected:
+                merge(records)
+                pow_list.append(pow_chan)
+        elif cluster_pool is not None:
             pow_list = cluster_pool.map(_parallel_compute_power, arg_list)
         else:
             pow_list = list(map(_parallel_compute_power, tqdm(arg_list, disable=True if len(arg_list) == 1 else False)))
@@ -607,7 +550,7 @@ def compute_power(events, freqs, wave_num, rel_start_ms, rel_stop_ms, buf_ms=100
         # concat(pow_list, dim='bipolar_pairs'), but for some reason it breaks. I don't know. So I'm creating a new
         # TimeSeries object
 
-        # concatenate data
+        # concatenate data. Upcasts recorded by pool workers stayed in their copies of the policy
         chan_dim = pow_list[0].get_axis_num('channel')
         elecs = np.concatenate([x[x.dims[chan_dim]].data for x in pow_list])
         pow_cat = np.concatenate([x.data for x in pow_list], axis=chan_dim)
@@ -619,9 +562,13 @@ def compute_power(events, freqs, wave_num, rel_start_ms, rel_stop_ms, buf_ms=100
     # if not looping, sending all the channels at once
     else:
         arg_list = [events, freqs, wave_num, elec_scheme, rel_start_ms, rel_stop_ms, buf_ms, noise_freq,
-                    resample_freq, mean_over_time, log_power, use_mirror_buf, time_bins, eeg_all_chans]
+                    resample_freq, mean_over_time, log_power, use_mirror_buf, time_bins, eeg_all_chans, policy,
+                    max_bytes]
         wave_pow = _parallel_compute_power(arg_list)
 
+    # keep the power in the storage dtype
+    wave_pow = policy.store(wave_pow, 'compute_power')
+
     # reorder dims to make events first
     wave_pow = make_events_first_dim(wave_pow)
 
@@ -635,46 +582,37 @@ def _parallel_compute_power(arg_list):
     """
 
     events, freqs, wave_num, elec_scheme, rel_start_ms, rel_stop_ms, buf_ms, noise_freq, resample_freq, mean_over_time, \
-    log_power, use_mirror_buf, time_bins, eeg = arg_list
+    log_power, use_mirror_buf, time_bins, eeg, policy, max_bytes = arg_list
 
     # first load eeg
     if eeg is None:
         eeg = load_eeg(events, rel_start_ms, rel_stop_ms, buf_ms=buf_ms, elec_scheme=elec_scheme,
-                       noise_freq=noise_freq, resample_freq=resample_freq, use_mirror_buf=use_mirror_buf)
+                       noise_freq=noise_freq, resample_freq=resample_freq, use_mirror_buf=use_mirror_buf,
+                       precision=policy)
 
-    # then compute power
-    wave_pow = MorletWaveletFilter(eeg, freqs, output='power', width=wave_num, cpus=12,
-                                   verbose=False).filter()
+    # then compute power. MorletWaveletFilter returns float64, cast back before the log and means
+    with span('wavelet', engine='ptsa', n_freqs=len(freqs)) as s:
+        wave_pow = MorletWaveletFilter(eeg, freqs, output='power', width=wave_num, cpus=12, verbose=False).filter()
+        wave_pow = s.array(policy.convert(wave_pow))
 
     # remove the buffer
     wave_pow = wave_pow.remove_buffer(buf_ms / 1000.)
 
     # are we taking the log?
     if log_power:
-        data = wave_pow.data
-        wave_pow.data = numexpr.evaluate('log10(data)')
+        with span('log'):
+            data = wave_pow.data
+            wave_pow.data = numexpr.evaluate('log10(data)')
 
     # mean over time if desired
     if mean_over_time:
-        wave_pow = wave_pow.mean(dim='time')
+        with span('mean_over_time'):
+            wave_pow = wave_pow.mean(dim='time')
 
     # or take the mean of each time bin, if given
     # create a new timeseries for each bin and the concat and add in new time dimension
     elif time_bins is not None:
-
-        # figure out window size based on sample rate
-        window_size_s = time_bins[0, 1] - time_bins[0, 0]
-        window_size = int(window_size_s * wave_pow.samplerate.data / 1000.)
-
-        # compute moving average with window size that we want to average over (in samples)
-        pow_move_mean = bn.move_mean(wave_pow.data, window=window_size, axis=3)
-
-        # reduce to just windows that are centered on the times we want
-        wave_pow.data = pow_move_mean
-        wave_pow = wave_pow[:, :, :, np.searchsorted(wave_pow.time.data, time_bins[:, 1]) - 1]
-
-        # set the times bins to be the new times bins (ie, the center of the bins)
-        wave_pow['time'] = time_bins.mean(axis=1)
+        wave_pow = _bin_power_over_time(wave_pow, time_bins, max_bytes)
 
         # ts_list = []
         # time_list = []
@@ -688,6 +626,24 @@ def _parallel_compute_power(arg_list):
     return wave_pow
 
 
+def _bin_power_over_time(wave_pow, time_bins, max_bytes=int(1e8)):
+    """
+    Returns wave_pow averaged within each time bin. Bins may overlap or have different widths. The new time coordinate
+    is the center of each bin. The binning's working arrays stay under max_bytes.
+    """
+    time_bins = np.asarray(time_bins, dtype=float).reshape(-1, 2)
+
+    # one cumulative sum over time, then a difference per bin, rather than a moving mean at every sample
+    starts, stops = bin_indices(wave_pow.time.data, time_bins)
+    time_axis = wave_pow.get_axis_num('time')
+    binned = wave_pow.isel(time=stops - 1)
+    binned.data = bin_means(wave_pow.data, starts, stops, axis=time_axis, max_bytes=max_bytes)
+
+    # set the times bins to be the new times bins (ie, the center of the bins)
+    binned['time'] = time_bins.mean(axis=1)
+    return binned
+
+
 def make_events_first_dim(ts, event_dim_str='event'):
     """
     Transposes a TimeSeries object to have the events dimension first. Returns transposed object.
@@ -716,23 +672,53 @@ def make_events_first_dim(ts, event_dim_str='event'):
     return ts
 
 
-def zscore_by_session(ts, event_dim_str='event'):
+def zscore_by_session(ts, event_dim_str='event', inplace=False, fit_events=None, chunk=1024, precision=None):
     """
     Returns a numpy array the same shape as the original timeseries, where all the elements have been zscored by
     session
 
+    Parameters
+    ----------
+    ts: TimeSeries
+        Timeseries with an event dimension whose events have a 'session' field
+    event_dim_str: str
+        the name of the event dimension
+    inplace: bool
+        If True, the data of ts is overwritten with the z-scores (and returned) instead of allocating a new array
+    fit_events: numpy.ndarray
+        Boolean mask or indices of the events to compute each session's mean and std from (ex: baseline events). The
+        result is still computed for every event. Default is all events
+    chunk: int
+        Number of events processed at a time
+    precision: PrecisionPolicy
+        If not inplace, the z-scores are returned in the policy's storage dtype (float32 by default)
+
     Returns
     -------
     numpy array
     """
+    sessions = _event_field(ts, 'session', event_dim_str)
+    axis = ts.get_axis_num(event_dim_str)
+
+    stats = SessionStats()
+    if fit_events is None:
+        stats.fit(ts.data, sessions, axis=axis, chunk=chunk)
+    else:
+        fit_inds = np.arange(len(sessions))[fit_events]
+        for start in range(0, len(fit_inds), chunk):
+            inds = fit_inds[start:start + chunk]
+            stats.partial_fit(np.take(ts.data, inds, axis=axis), sessions[inds], axis=axis)
+    return stats.transform(ts.data, sessions, axis=axis, chunk=chunk, inplace=inplace,
+                           dtype=get_policy(precision).storage.name)
+
 
-    sessions = ts[event_dim_str].data['session']
-    z_pow = np.empty(ts.shape, dtype='float32')
-    uniq_sessions = np.unique(sessions)
-    for sess in uniq_sessions:
-        sess_inds = sessions == sess
-        z_pow[sess_inds] = zscore(ts[sess_inds], axis=ts.get_axis_num('event'))
-    return z_pow
+def _event_field(ts, field, event_dim_str='event'):
+    """
+    Returns one field of the events of a timeseries, whether the events are a recarray or a MultiIndex.
+    """
+    if field in ts.coords:
+        return np.asarray(ts[field].data)
+    return np.asarray(ts[event_dim_str].data[field])
 
 
 
@@ -742,7 +728,7 @@ def zscore_by_session(ts, event_dim_str='event'):
 
 # ---- Filter subjects by region ----
 
-def filter_subject_to_region(subjs, roi='Hipp'):
+def filter_subject_to_region(subjs, roi='Hipp', roi_dict=None, inventory=None):
     """
     input 
         subjs : 2-d dataframe
@@ -751,6 +737,14 @@ def filter_subject_to_region(subjs, roi='Hipp'):
         roi : string or list of strings
             roi to extract ex 'Hipp'. Note that for a list OR logic is used for extraction
 
+        roi_dict : dict
+            Mapping of ROI names to region labels. Default: roi.SUBJECT_FILTER_ROI_DICT. With inventory, it must be
+            the inventory's (a ValueError is raised otherwise)
+
+        inventory : ElectrodeInventory
+            If given, the answer comes from its saved counts (any contact in the roi) and no electrode files are
+            loaded. See neuro.stim.inventory
+
     output: 
         subjs_to_use: 1d array
             binary mask to filter subjs dataframe based on specified ROIs
@@ -761,76 +755,26 @@ def filter_subject_to_region(subjs, roi='Hipp'):
         subjs = subjs[subjs_to_use]
 
     """
-    
+    rois = [roi] if isinstance(roi, str) else list(roi)
+    if inventory is not None:
+        if (roi_dict is not None) and (roi_dict != inventory.roi_dict):
+            raise ValueError('roi_dict differs from the ROIs the inventory was built with. Build an ElectrodeInventory '
+                             'with this roi_dict, or leave out inventory')
+        return inventory.mask(subjs, contacts={tuple(rois): 1})
+
+    classifier = RoiClassifier(SUBJECT_FILTER_ROI_DICT if roi_dict is None else roi_dict)
+
     keep_subjs = np.array([False]*subjs.shape[0])
-    for index, subj in subjs.iterrows():
-        
+    for i, subj in enumerate(subjs.itertuples(index=False)):
         try:
-            elec_info = load_elec_info(subject=subj.subject, montage=subj.montage)  ## CMH 21.02.10 added eh 
+            # the monopolar contacts, as the inventory counts
+            elec_info = load_elec_info(subject=subj.subject, montage=subj.montage, bipolar=False)
             region_key = 'stein.region' if 'stein.region' in elec_info else 'ind.region'
-            x_coord_column = 'ind.x'
-            if elec_info[x_coord_column].iloc[0] == 'NaN':
-                x_coord_column = 'tal.x'
 
             # smoosh the columns together, with the first column taking precedence
-            regions = elec_info[region_key].fillna(elec_info['ind.region']).fillna(value='')
-            
-            # Original ROI Dict
-            
-            roi_dict = {'Hipp': ['Left CA1', 'Left CA2', 'Left CA3', 'Left DG', 'Left Sub', 'Right CA1', 'Right CA2',
-                                 'Right CA3', 'Right DG', 'Right Sub'],
-                        'MTL': ['Left PRC', 'Right PRC', 'Right EC', 'Right PHC', 'Left EC', 'Left PHC'],
-                        'EC': ['Right EC', 'Left EC'],
-                        'Amy': ['Left Amy', 'Right Amy'],
-                        'Frontal': ['parsopercularis', 'parsorbitalis', 'parstriangularis', 'caudalmiddlefrontal',
-                                    'rostralmiddlefrontal', 'superiorfrontal', 'medialorbitofrontal'],
-                        'Temporal': ['superiortemporal', 'middletemporal', 'inferiortemporal'],
-                        'Parietal': ['inferiorparietal', 'supramarginal', 'superiorparietal', 'precuneus'],
-                        'Occipital': ['lateraloccipital', 'lingual', 'cuneus', 'pericalcarine']}
-            """
-
-            print('Using updated ROI dict')
-            roi_dict = {'Hipp': ['Left CA1', 'Left CA2', 'Left CA3', 'Right CA1', 'Right CA2',
-                                 'Right CA3'],
-                        'DG': ['Left DG', 'Right DG'],
-                        'Sub': ['Left Sub', 'Right Sub'],
-                        'EC': ['Right EC', 'Left EC'],
-                        'HippFormation': ['Left CA1', 'Left CA2', 'Left CA3', 'Right CA1', 'Right CA2',
-                                          'Right CA3', 'Left DG', 'Right DG', 'Left Sub', 'Right Sub'],
-                        'MTL': ['Left PRC', 'Right PRC', 'Right EC', 'Right PHC', 'Left EC', 'Left PHC'],
-                        'IFG': ['parsopercularis', 'parsorbitalis', 'parstriangularis'],  # This may contain Broca's Area
-                        'MFG': ['caudalmiddlefrontal', 'rostralmiddlefrontal'],  # This may contrain DLPFC
-                        'SFG': ['superiorfrontal'],
-                        'Frontal': ['parsopercularis', 'parsorbitalis', 'parstriangularis', 'caudalmiddlefrontal',
-                                    'rostralmiddlefrontal', 'superiorfrontal'],
-                        'Temporal': ['superiortemporal', 'middletemporal', 'inferiortemporal'],
-                        'Parietal': ['inferiorparietal', 'supramarginal', 'superiorparietal', 'precuneus'],
-                        'Occipital': ['lateraloccipital', 'lingual', 'cuneus', 'pericalcarine']}
-            """
-            
-            # get ROI for each electrode. THIS GETS THE FIRST, IF IT IS IN MULTIPLE SOMEHOW
-            elec_region_list = [''] * len(regions)
-            for e, elec_region in enumerate(regions):
-                for roi in roi_dict.keys():
-                    if elec_region in roi_dict[roi]:
-                        elec_region_list[e] = roi
-                        continue
-            
-            #print(elec_region_list) 
-             
-            
-            # get hemisphere
-            elec_hemi_list = np.array(['right'] * len(regions))
-            elec_hemi_list[elec_info[x_coord_column] < 0] = 'left'
-
-            # make new DF
-            region_df = elec_info[['label']].copy()
-            
-            #print(region_df)
-            
-            region_df['region'] = elec_region_list
-            region_df['hemi'] = elec_hemi_list
-            keep_subjs[index] = np.any(np.isin(region_df.region, [roi]))
-        except:
-              print('Error {}'.format(subj.subject))
+            regions = coalesce_regions(elec_info, [region_key, 'ind.region'])
+            # a contact counts for every roi its label is in, as in the inventory
+            keep_subjs[i] = np.any(classifier.in_roi(classifier.roi_mask(regions), rois))
+        except Exception:
+            print('Error {}'.format(subj.subject))
     return keep_subjs
\ No newline at end of file
@@ -0,0 +1,190 @@
+"""
+Per-session z-scoring with running (single pass) statistics.
+"""
+
+import numpy as np
+
+
+class SessionStats:
+    """
+    Running per-session mean and variance over the event axis of an array, merged one block of events at a time
+    (Chan et al.'s parallel form of Welford's algorithm).
+
+    Parameters
+    ----------
+    ddof: int
+        Delta degrees of freedom for the standard deviation. Default 0, the same as scipy's zscore
+    """
+    def __init__(self, ddof=0):
+        self.ddof = ddof
+
+        # session -> count, mean and sum of squared deviations (float64, one value per feature)
+        self.n = {}
+        self.mean = {}
+        self.m2 = {}
+
+    @property
+    def sessions(self):
+        return list(self.n.keys())
+
+    def _merge(self, session, n_b, mean_b, m2_b):
+        """
+        Merges the statistics of a new block into a session's running statistics (Chan et al.).
+        """
+        if session not in self.n:
+            self.n[session], self.mean[session], self.m2[session] = n_b, mean_b, m2_b
+            return
+        n_a, mean_a = self.n[session], self.mean[session]
+        n = n_a + n_b
+        delta = mean_b - mean_a
+        mean_a += delta * (n_b / n)
+        self.m2[session] += m2_b + delta ** 2 * (n_a * n_b / n)
+        self.n[session] = n
+
+    def partial_fit(self, data, sessions, axis=0):
+        """
+        Adds one block of events to the running statistics.
+
+        Parameters
+        ----------
+        data: numpy.ndarray
+            Block of data with events along axis
+        sessions: numpy.ndarray
+            Session of each event in the block
+        axis: int
+            The event axis
+
+        Returns
+        -------
+        SessionStats
+            self
+        """
+        data = np.moveaxis(np.asarray(data), axis, 0)
+        sessions = np.asarray(sessions)
+        for session in np.unique(sessions):
+            block = data[sessions == session].astype(np.float64)
+            mean_b = block.mean(axis=0)
+            block -= mean_b
+            self._merge(session, len(block), mean_b, np.einsum('i...,i...->...', block, block))
+        return self
+
+    def fit(self, data, sessions, axis=0, chunk=1024):
+        """
+        Fits the statistics of every session, chunk events at a time.
+
+        Parameters
+        ----------
+        data: numpy.ndarray, numpy.memmap, TimeSeries or iterable
+            The data, with events along axis. May also be an iterable of blocks (then sessions must be an iterable of
+            the matching session arrays)
+        sessions: numpy.ndarray or iterable
+            Session of each event
+        axis: int
+            The event axis
+        chunk: int
+            Number of events read at a time
+
+        Returns
+        -------
+        SessionStats
+            self
+        """
+        for block, block_sessions, _ in _iter_blocks(data, sessions, axis, chunk):
+            self.partial_fit(block, block_sessions, axis=axis)
+        return self
+
+    def std(self, session):
+        """
+        Returns the standard deviation of one session.
+        """
+        return np.sqrt(self.m2[session] / max(self.n[session] - self.ddof, 1))
+
+    def transform(self, data, sessions, axis=0, chunk=1024, inplace=False, out=None, dtype='float32'):
+        """
+        Z-scores data with the fitted statistics of each event's session.
+
+        Parameters
+        ----------
+        data: numpy.ndarray, numpy.memmap or iterable
+            The data, with events along axis, or an iterable of blocks of events
+        sessions: numpy.ndarray or iterable
+            Session of each event (for blocks, an iterable of the sessions of each block). Every session must have
+            been fit
+        axis: int
+            The event axis
+        chunk: int
+            Number of events normalized at a time
+        inplace: bool
+            If True, the result is written back into data (which must be a writable array)
+        out: numpy.ndarray
+            Array to write the result into, if not inplace. If None, one is allocated with the given dtype (for
+            blocks, when the first block is seen)
+        dtype: str
+            dtype of the allocated output
+
+        Returns
+        -------
+        numpy.ndarray
+        """
+        data = getattr(data, 'data', data) if not isinstance(data, np.ndarray) else data
+        if isinstance(data, np.ndarray):
+            all_sessions = np.asarray(sessions)
+            if inplace:
+                out = data
+            elif out is None:
+                out = np.empty(data.shape, dtype=dtype)
+        else:
+            if inplace:
+                raise ValueError('inplace needs data as an array, not an iterable of blocks')
+            # the session labels are small: keep them to know the number of events before the blocks are read
+            sessions = [np.asarray(block_sessions) for block_sessions in sessions]
+            all_sessions = np.concatenate(sessions) if sessions else np.array([])
+        missing = set(np.unique(all_sessions)) - set(self.n)
+        if missing:
+            raise KeyError('No statistics for sessions {}'.format(sorted(missing)))
+
+        out_view = None if out is None else np.moveaxis(out, axis, 0)
+        std = {session: self.std(session) for session in self.n}
+        for block, block_sessions, rows in _iter_blocks(data, sessions, axis, chunk):
+            block = np.moveaxis(np.asarray(block), axis, 0)
+            if out_view is None:
+                out_view = np.empty((len(all_sessions),) + block.shape[1:], dtype=dtype)
+                out = np.moveaxis(out_view, 0, axis)
+            for session in np.unique(block_sessions):
+                inds = np.flatnonzero(block_sessions == session)
+                out_view[rows.start + inds] = (block[inds] - self.mean[session]) / std[session]
+        if out is None:
+            raise ValueError('No blocks to transform')
+        return out
+
+    def fit_transform(self, data, sessions, axis=0, chunk=1024, inplace=False, out=None, dtype='float32'):
+        """
+        fit() then transform() on the same data. Reads the data twice but never holds more than one chunk extra, so
+        blocks must come from something that can be iterated again (a list, not a generator).
+        """
+        if any(iter(x) is x for x in (data, sessions)):
+            raise TypeError('fit_transform reads the blocks twice: pass a list of blocks, not an iterator')
+        return self.fit(data, sessions, axis=axis, chunk=chunk).transform(data, sessions, axis=axis, chunk=chunk,
+                                                                         inplace=inplace, out=out, dtype=dtype)
+
+
+def _iter_blocks(data, sessions, axis, chunk):
+    """
+    Yields (block, block_sessions, rows) from an array (in chunks of events) or from iterables of blocks.
+    """
+    data = getattr(data, 'data', data) if not isinstance(data, np.ndarray) else data
+    if isinstance(data, np.ndarray):
+        sessions = np.asarray(sessions)
+        n_events = data.shape[axis]
+        for start in range(0, n_events, chunk):
+            rows = slice(start, min(start + chunk, n_events))
+            idx = [slice(None)] * data.ndim
+            idx[axis] = rows
+            yield data[tuple(idx)], sessions[rows], rows
+    else:
+        start = 0
+        for block, block_sessions in zip(data, sessions):
+            block_sessions = np.asarray(block_sessions)
+            rows = slice(start, start + len(block_sessions))
+            start = rows.stop
+            yield block, block_sessions, rows
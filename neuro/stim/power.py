@@ -0,0 +1,282 @@
+"""
+Batched, FFT based Morlet wavelet power.
+"""
+
+import numpy as np
+from scipy import fft as sp_fft
+
+from ptsa.data.timeseries import TimeSeries
+
+from neuro.stim.design_cache import design_cache
+
+
+def morlet_wavelet(freq, samplerate, width=5, sampling_window=7):
+    """
+    Returns a complex morlet wavelet, as ptsa.wavelet.morlet_multi makes it: a complex sinusoid under a gaussian with
+    sigma_t = width / (2 pi f), cut at +/- sampling_window / 2 sigma_t and scaled by 1 / sqrt(sigma_t sqrt(pi)).
+
+    Parameters
+    ----------
+    freq: float
+        Centre frequency in Hz
+    samplerate: float
+        Sampling rate in Hz
+    width: float
+        Width of the wavelet in cycles
+    sampling_window: float
+        Length of the wavelet in standard deviations of its gaussian envelope
+
+    Returns
+    -------
+    numpy.ndarray
+        complex128 wavelet
+    """
+    st = 1. / (2. * np.pi * (float(freq) / width))
+    n_samples = wavelet_length(freq, samplerate, width, sampling_window)
+    t = (np.arange(n_samples) - (n_samples - 1) / 2.) / float(samplerate)
+    amp = 1. / np.sqrt(st * np.sqrt(np.pi))
+    return amp * np.exp(-t ** 2 / (2. * st ** 2)) * np.exp(2j * np.pi * freq * t)
+
+
+def wavelet_length(freq, samplerate, width=5, sampling_window=7):
+    """
+    Returns the number of samples in the morlet_wavelet() for these parameters.
+    """
+    st = 1. / (2. * np.pi * (float(freq) / width))
+    return int(np.fix(sampling_window * st * samplerate)) + 1
+
+
+def wavelet_spectrum(freq, samplerate, width, n_fft):
+    """
+    Returns the length n_fft complex64 FFT of a morlet wavelet. Kept in the shared design_cache per (freq, samplerate,
+    width, n_fft).
+    """
+    key = (float(freq), float(samplerate), float(width), int(n_fft))
+    return design_cache.get('morlet_fft', key,
+                            lambda: sp_fft.fft(morlet_wavelet(freq, samplerate, width), n_fft).astype(np.complex64))
+
+
+def fft_length(n_samples, freqs, samplerate, width=5):
+    """
+    Returns the FFT length needed to linearly convolve n_samples with the longest wavelet in freqs.
+    """
+    longest = wavelet_length(np.min(freqs), samplerate, width)
+    return sp_fft.next_fast_len(n_samples + longest - 1)
+
+
+def chunk_rows(n_rows, n_fft, max_bytes):
+    """
+    Returns the number of rows to transform at once so the working arrays stay under max_bytes. Per row, three
+    complex64 arrays of n_fft are alive at a time (the signal's transform, its product with one wavelet and the inverse
+    transform), plus the float32 power and, when binning, its float64 running sum.
+    """
+    return int(np.clip(max_bytes // ((3 * 8 + 4 + 8) * n_fft), 1, n_rows))
+
+
+def bin_indices(time, time_bins):
+    """
+    Converts (start, stop) time bins into sample ranges of a time coordinate. Each bin covers the samples with
+    start <= time < stop, the same samples the moving-average binning in compute_power used.
+
+    Parameters
+    ----------
+    time: numpy.ndarray
+        The time coordinate of the power, in ms
+    time_bins: numpy.ndarray
+        n_bins x 2 array of start and stop times, in ms. Bins may overlap and have different widths
+
+    Returns
+    -------
+    numpy.ndarray, numpy.ndarray
+        Start and (exclusive) stop sample of every bin. A bin that stops before it starts, or starts after the last
+        sample, raises a ValueError
+    """
+    time_bins = np.asarray(time_bins, dtype=float).reshape(-1, 2)
+    reversed_bins = time_bins[:, 1] < time_bins[:, 0]
+    if reversed_bins.any():
+        raise ValueError('Time bin {} stops before it starts'.format(time_bins[np.argmax(reversed_bins)].tolist()))
+    starts = np.searchsorted(time, time_bins[:, 0])
+    empty = starts >= len(time)
+    if empty.any():
+        raise ValueError('Time bin {} starts after the last sample ({} ms)'.format(
+            time_bins[np.argmax(empty)].tolist(), time[-1] if len(time) else None))
+    stops = np.maximum(np.searchsorted(time, time_bins[:, 1]), starts + 1)
+    return starts, np.minimum(stops, len(time))
+
+
+def bin_means(data, starts, stops, axis=-1, max_bytes=int(1e8), out=None):
+    """
+    Averages data within each [start, stop) sample range along axis, using a cumulative sum so the cost doesn't grow
+    with the width or overlap of the bins. The sum is taken over chunks of rows (along the first other axis) so its
+    float64 working copy stays under max_bytes.
+
+    Returns
+    -------
+    numpy.ndarray
+        float32 array with axis replaced by one entry per bin (out, if given)
+    """
+    starts, stops = np.asarray(starts), np.asarray(stops)
+    data = np.moveaxis(data, axis, -1)
+    if out is None:
+        out = np.moveaxis(np.empty(data.shape[:-1] + (len(starts),), dtype=np.float32), -1, axis)
+    out_view = np.moveaxis(out, axis, -1)
+    widths = stops - starts
+
+    if data.ndim == 1:
+        data, out_view = data[None], out_view[None]
+    n_time = data.shape[-1]
+    # per row: the float64 running sum and the cast copy the sum is taken from
+    row_bytes = (8 + data.dtype.itemsize) * (n_time + 1) * (data[0].size // max(n_time, 1))
+    step = int(np.clip(max_bytes // max(row_bytes, 1), 1, max(data.shape[0], 1)))
+    for first in range(0, data.shape[0], step):
+        block = data[first:first + step]
+        csum = np.zeros(block.shape[:-1] + (n_time + 1,), dtype=np.float64)
+        np.cumsum(block, axis=-1, dtype=np.float64, out=csum[..., 1:])
+        out_view[first:first + step] = (csum[..., stops] - csum[..., starts]) / widths
+    return out
+
+
+def morlet_power_array(data, freqs, samplerate, width=5, buf=0, log_power=True, mean_over_time=True, bins=None,
+                       max_bytes=int(1e9), workers=-1, out=None):
+    """
+    Computes morlet wavelet power of a rows x time array.
+
+    Each chunk of rows is Fourier transformed once, multiplied by every wavelet's spectrum (linear convolution, centred
+    like np.convolve(mode='same')) and reduced (buffer, log10, time mean or bins) before it is written to out.
+
+    Parameters
+    ----------
+    data: numpy.ndarray
+        rows x time (ex: events * channels flattened)
+    freqs: numpy.ndarray
+        Frequencies in Hz
+    samplerate: float
+        Sampling rate in Hz
+    width: float
+        Width of the wavelets in cycles
+    buf: int
+        Number of samples to drop from each end of the power (the buffer)
+    log_power: bool
+        If True, power is log10'd
+    mean_over_time: bool
+        If True, power is averaged over time (after the log, if log_power)
+    bins: tuple
+        (starts, stops) sample ranges from bin_indices(), relative to the power after the buffer is removed. If given
+        (and not mean_over_time), power is averaged within each bin as each chunk is produced
+    max_bytes: int
+        Memory budget for the working arrays of one chunk of rows
+    workers: int
+        Threads for scipy.fft. -1 uses all cores
+    out: numpy.ndarray
+        float32 array of shape freqs x rows (x time - 2 * buf, or x bins, unless mean_over_time) to write into
+
+    Returns
+    -------
+    numpy.ndarray
+        float32 power, freqs x rows (x time or x bins)
+    """
+    freqs = np.atleast_1d(np.asarray(freqs, dtype=float))
+    n_rows, n_samples = data.shape
+    n_out = n_samples - 2 * buf
+    if mean_over_time:
+        bins = None
+    if out is None:
+        if mean_over_time:
+            out_shape = (len(freqs), n_rows)
+        else:
+            out_shape = (len(freqs), n_rows, n_out if bins is None else len(bins[0]))
+        out = np.empty(out_shape, dtype=np.float32)
+
+    n_fft = fft_length(n_samples, freqs, samplerate, width)
+    step = chunk_rows(n_rows, n_fft, max_bytes)
+
+    for start in range(0, n_rows, step):
+        rows = slice(start, start + step)
+        x_hat = sp_fft.fft(np.asarray(data[rows], dtype=np.float32), n_fft, axis=-1, workers=workers)
+
+        for i, freq in enumerate(freqs):
+            kernel = wavelet_spectrum(freq, samplerate, width, n_fft)
+            n_kernel = wavelet_length(freq, samplerate, width)
+            conv = sp_fft.ifft(np.multiply(x_hat, kernel, out=np.empty_like(x_hat)), axis=-1, overwrite_x=True,
+                               workers=workers)
+
+            # 'same' alignment, minus the buffer
+            first = (n_kernel - 1) // 2 + buf
+            conv = conv[:, first:first + n_out]
+            power = np.abs(conv)
+            del conv
+            np.square(power, out=power)
+            if log_power:
+                np.log10(power, out=power)
+            if mean_over_time:
+                out[i, rows] = power.mean(axis=-1)
+            elif bins is not None:
+                out[i, rows] = bin_means(power, bins[0], bins[1])
+            else:
+                out[i, rows] = power
+    return out
+
+
+def morlet_power(eeg, freqs, width=5, buf_ms=0, log_power=True, mean_over_time=True, time_bins=None,
+                 max_bytes=int(1e9), workers=-1):
+    """
+    Returns a TimeSeries of morlet wavelet power with dimensions 'frequency' followed by the dims of eeg (without
+    'time' if mean_over_time), the same layout MorletWaveletFilter(output='power') gives.
+
+    Parameters
+    ----------
+    eeg: TimeSeries
+        A ptsa.timeseries object with 'time' and 'samplerate' coordinates, already loaded and filtered
+    freqs: numpy.ndarray or list
+        Frequencies at which to compute power
+    width: float
+        Width of the wavelet in cycles
+    buf_ms: float
+        Buffer (in ms) to remove from both ends after computing power
+    log_power: bool
+        Whether to log10 the power values
+    mean_over_time: bool
+        Whether to mean power over time, and return the power data with no time dimension
+    time_bins: list or array
+        Pairs of start and stop times (ms) to average power within, when mean_over_time is False. Bins may overlap or
+        have different widths. Each bin is reduced as its chunk of power is computed, so the full resolution power is
+        never kept. The time coordinate of the result is the center of each bin
+    max_bytes: int
+        Memory budget for the working arrays. Controls how many events x channels are transformed at once
+    workers: int
+        Threads for scipy.fft. -1 uses all cores
+
+    Returns
+    -------
+    TimeSeries
+    """
+    freqs = np.atleast_1d(np.asarray(freqs, dtype=float))
+    samplerate = float(eeg['samplerate'])
+    buf = int(buf_ms / 1000. * samplerate)
+
+    # time last, then everything else as rows
+    other_dims = [dim for dim in eeg.dims if dim != 'time']
+    eeg = eeg.transpose(*other_dims, 'time')
+    other_shape = eeg.shape[:-1]
+    data = eeg.data.reshape(-1, eeg.shape[-1])
+
+    time = eeg['time'].data[buf:eeg.shape[-1] - buf]
+    bins = None
+    if (time_bins is not None) and not mean_over_time:
+        time_bins = np.asarray(time_bins, dtype=float).reshape(-1, 2)
+        bins = bin_indices(time, time_bins)
+        time = time_bins.mean(axis=1)
+
+    power = morlet_power_array(data, freqs, samplerate, width=width, buf=buf, log_power=log_power,
+                               mean_over_time=mean_over_time, bins=bins, max_bytes=max_bytes, workers=workers)
+
+    coords = {dim: eeg.indexes[dim] if dim in eeg.indexes else eeg[dim].data for dim in other_dims if dim in eeg.coords}
+    coords['frequency'] = freqs
+    if mean_over_time:
+        dims = ['frequency'] + other_dims
+        power = power.reshape((len(freqs),) + other_shape)
+    else:
+        dims = ['frequency'] + other_dims + ['time']
+        power = power.reshape((len(freqs),) + other_shape + (power.shape[-1],))
+        coords['time'] = time
+    return TimeSeries.create(power, samplerate, coords=coords, dims=dims)
@@ -0,0 +1,152 @@
+"""
+The dtypes the EEG and power pipeline computes and stores in, and a record of where data left them.
+"""
+
+import threading
+
+import numpy as np
+import pandas as pd
+
+
+class PrecisionPolicy:
+    """
+    Dtypes used through the pipeline, and a record of where data left them.
+
+    Parameters
+    ----------
+    compute: str
+        dtype data is kept in between stages. Default float32
+    storage: str
+        dtype results are kept in (see store()). Default: the compute dtype
+    work_bytes: int
+        Budget for the float64 working copy of one filtering pass (see chan_chunk()). None for no limit. Default
+        100 MB, which keeps the filters' copies from setting the peak for a subject without slowing them down
+    strict: bool
+        If True, an upcast (see cast()) raises a TypeError instead of being recorded and cast back
+    """
+    def __init__(self, compute='float32', storage=None, work_bytes=int(1e8), strict=False):
+        self.compute = np.dtype(compute)
+        self.storage = self.compute if storage is None else np.dtype(storage)
+        self.work_bytes = work_bytes
+        self.strict = strict
+        # (stage, kind, from dtype, to dtype) -> [times, bytes, values lost]. Aggregated, so a long session that
+        # keeps hitting the same upcast doesn't grow it
+        self.upcasts = {}
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return 'PrecisionPolicy(compute={}, storage={}, work_bytes={}, strict={})'.format(
+            self.compute.name, self.storage.name, self.work_bytes, self.strict)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def _record(self, stage, kind, from_dtype, to_dtype, nbytes, count=0):
+        key = (stage, kind, str(from_dtype), str(to_dtype))
+        with self._lock:
+            entry = self.upcasts.setdefault(key, [0, 0, 0])
+            entry[0] += 1
+            entry[1] += int(nbytes)
+            entry[2] += int(count)
+
+    def convert(self, x):
+        """
+        Returns x (an array or TimeSeries) in the compute dtype. Nothing is recorded: for data whose source always
+        gives another dtype (ex: the reader's float64).
+        """
+        if np.dtype(x.dtype) == self.compute:
+            return x
+        return _astype(x, self.compute)
+
+    def cast(self, x, stage, source_dtype=None):
+        """
+        Returns x (an array or TimeSeries), the output of stage, in the compute dtype. If the stage was given compute
+        dtype data (source_dtype, default the compute dtype) and x is wider, the upcast is recorded under stage, or
+        raised if strict. Otherwise x is only converted.
+        """
+        dtype = np.dtype(x.dtype)
+        if dtype == self.compute:
+            return x
+        source_dtype = self.compute if source_dtype is None else np.dtype(source_dtype)
+        if (source_dtype == self.compute) and np.issubdtype(dtype, np.floating) and \
+                (dtype.itemsize > self.compute.itemsize):
+            if self.strict:
+                raise TypeError('{} upcast {} data to {}'.format(stage, self.compute.name, dtype.name))
+            self._record(stage, 'upcast', dtype, self.compute, x.nbytes)
+        return _astype(x, self.compute)
+
+    def store(self, x, stage):
+        """
+        Returns x in the storage dtype. Values that become inf, or nonzero values that become 0, are counted and
+        recorded under stage.
+        """
+        if np.dtype(x.dtype) == self.storage:
+            return x
+        # values that don't fit are counted below instead
+        with np.errstate(over='ignore', under='ignore'):
+            out = _astype(x, self.storage)
+        if self.storage.itemsize < np.dtype(x.dtype).itemsize:
+            before, after = np.asarray(getattr(x, 'data', x)), np.asarray(getattr(out, 'data', out))
+            lost = int(np.count_nonzero(np.isinf(after) & np.isfinite(before)) +
+                       np.count_nonzero((after == 0) & (before != 0)))
+            if lost:
+                self._record(stage, 'storage_loss', x.dtype, self.storage, x.nbytes, count=lost)
+        return out
+
+    def chan_chunk(self, eeg, chan_chunk=None):
+        """
+        Returns chan_chunk if given, otherwise the number of channels of eeg whose float64 filtering copy fits in
+        work_bytes (None if all of them do, or there's no budget).
+        """
+        if (chan_chunk is not None) or (self.work_bytes is None) or ('channel' not in eeg.dims):
+            return chan_chunk
+        n_channels = eeg.sizes['channel']
+        per_channel = 8 * (eeg.size // max(n_channels, 1))
+        if per_channel * n_channels <= self.work_bytes:
+            return None
+        return max(1, int(self.work_bytes // per_channel))
+
+    def report(self):
+        """
+        Returns a DataFrame with one row per stage and kind: how many times it happened, the bytes involved and, for
+        storage losses, the values lost.
+        """
+        index = pd.MultiIndex.from_tuples(list(self.upcasts), names=['stage', 'kind', 'from', 'to'])
+        return pd.DataFrame(list(self.upcasts.values()), index=index, columns=['times', 'nbytes', 'count'])
+
+    def clear(self):
+        with self._lock:
+            self.upcasts = {}
+
+
+def _astype(x, dtype):
+    """
+    Returns x (array or TimeSeries) as dtype, keeping a TimeSeries' coordinates and class. x isn't changed.
+    """
+    if hasattr(x, 'dims'):
+        # xarray's astype hands back a plain DataArray, so the data is swapped on a shallow copy instead
+        out = x.copy(deep=False)
+        out.data = x.data.astype(dtype, copy=False)
+        return out
+    return np.asarray(x).astype(dtype, copy=False)
+
+
+# used when no policy is given: float32 compute and storage, the dtypes the pipeline already aimed for
+DEFAULT_POLICY = PrecisionPolicy()
+
+
+def get_policy(precision=None):
+    """
+    Returns precision, or DEFAULT_POLICY if it's None. A dtype name (ex: 'float32') gives a policy computing in it.
+    """
+    if precision is None:
+        return DEFAULT_POLICY
+    if isinstance(precision, PrecisionPolicy):
+        return precision
+    return PrecisionPolicy(compute=precision)
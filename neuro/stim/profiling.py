@@ -0,0 +1,264 @@
+"""
+Named timing spans for the loading and analysis pipeline. Nothing is recorded unless profiling is on:
+
+    with profile() as prof:
+        group.load_subjects()
+    print(prof.summary())
+"""
+
+import functools
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import pandas as pd
+
+# the profiler spans are recorded into. None when profiling is off
+_profiler = None
+
+# open spans of each thread, for the nested names
+_local = threading.local()
+
+
+class Span:
+    """
+    One open span. Returned by span() while profiling is on.
+
+    Records wall time, cpu_s (process CPU time, so threads the stage starts are counted, as is anything else the
+    process runs meanwhile), thread_cpu_s (the calling thread's alone) and, when told, what the stage produced.
+    """
+    __slots__ = ('name', 'path', 'info', 'nbytes', 'shape', 'dtype', '_wall', '_cpu', '_thread_cpu')
+
+    def __init__(self, name, info):
+        self.name = name
+        self.info = info
+        self.nbytes = None
+        self.shape = None
+        self.dtype = None
+
+    def array(self, value):
+        """
+        Records the shape, dtype and bytes of value (an array or TimeSeries). Returns value.
+        """
+        self.shape = tuple(getattr(value, 'shape', ()))
+        self.dtype = str(getattr(value, 'dtype', ''))
+        self.add_bytes(getattr(value, 'nbytes', 0))
+        return value
+
+    def add_bytes(self, nbytes):
+        self.nbytes = (self.nbytes or 0) + int(nbytes)
+
+    def set(self, **info):
+        self.info.update(info)
+
+    def __enter__(self):
+        stack = getattr(_local, 'stack', None)
+        if stack is None:
+            stack = _local.stack = []
+        self.path = stack[-1].path + '/' + self.name if stack else self.name
+        stack.append(self)
+        self._cpu = time.process_time()
+        self._thread_cpu = time.thread_time()
+        self._wall = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        wall = time.perf_counter() - self._wall
+        cpu = time.process_time() - self._cpu
+        thread_cpu = time.thread_time() - self._thread_cpu
+        _local.stack.pop()
+        profiler = _profiler
+        if profiler is not None:
+            profiler.add({'path': self.path, 'name': self.name, 'pid': os.getpid(), 'start': self._wall,
+                          'wall_s': wall, 'cpu_s': cpu, 'thread_cpu_s': thread_cpu, 'nbytes': self.nbytes,
+                          'shape': self.shape, 'dtype': self.dtype,
+                          'error': None if exc_type is None else exc_type.__name__, 'info': self.info})
+        return False
+
+
+class _NoSpan:
+    """
+    What span() returns while profiling is off: does nothing.
+    """
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+    def array(self, value):
+        return value
+
+    def add_bytes(self, nbytes):
+        pass
+
+    def set(self, **info):
+        pass
+
+
+_NO_SPAN = _NoSpan()
+
+
+def span(name, **info):
+    """
+    Context manager timing one named stage. info is kept with the record (ex: span('wavelet', n_freqs=8)).
+    """
+    if _profiler is None:
+        return _NO_SPAN
+    return Span(name, info)
+
+
+def enabled():
+    return _profiler is not None
+
+
+def profiled(name=None):
+    """
+    Decorator opening a span (named name, default the function's name) around every call of the function.
+    """
+    def decorate(func):
+        span_name = name or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _profiler is None:
+                return func(*args, **kwargs)
+            with Span(span_name, {}):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+class Profiler:
+    """
+    Collects span records and reports them.
+    """
+    def __init__(self):
+        self.records = []
+        self._lock = threading.Lock()
+
+    def add(self, record):
+        with self._lock:
+            self.records.append(record)
+
+    def merge(self, records, prefix=None, **info):
+        """
+        Adds records from another profiler (ex: a worker's), with their paths under prefix and info added to each (ex:
+        job=key).
+        """
+        with self._lock:
+            for record in records:
+                if prefix or info:
+                    record = dict(record, info=dict(record['info'], **info))
+                    if prefix:
+                        record['path'] = prefix + '/' + record['path']
+                self.records.append(record)
+
+    def table(self):
+        """
+        Returns every record as a DataFrame, one row per span.
+        """
+        columns = ['path', 'name', 'pid', 'start', 'wall_s', 'cpu_s', 'thread_cpu_s', 'nbytes', 'shape', 'dtype',
+                   'error', 'info']
+        return pd.DataFrame(self.records, columns=columns)
+
+    def report(self):
+        """
+        Returns one row per span path: number of calls and processes, total / mean / max wall time, total process and
+        own-thread CPU time, total bytes, and the last shape and dtype recorded. Sorted by total wall time.
+        """
+        df = self.table()
+        if df.empty:
+            return pd.DataFrame(columns=['calls', 'processes', 'wall_s', 'wall_mean_s', 'wall_max_s', 'cpu_s',
+                                         'thread_cpu_s', 'nbytes', 'shape', 'dtype', 'errors'])
+        grouped = df.groupby('path', sort=False)
+        report = pd.DataFrame({
+            'calls': grouped.size(),
+            'processes': grouped['pid'].nunique(),
+            'wall_s': grouped['wall_s'].sum(),
+            'wall_mean_s': grouped['wall_s'].mean(),
+            'wall_max_s': grouped['wall_s'].max(),
+            'cpu_s': grouped['cpu_s'].sum(),
+            'thread_cpu_s': grouped['thread_cpu_s'].sum(),
+            'nbytes': grouped['nbytes'].sum(min_count=1),
+            'shape': grouped['shape'].last(),
+            'dtype': grouped['dtype'].last(),
+            'errors': grouped['error'].count(),
+        })
+        return report.sort_values('wall_s', ascending=False)
+
+    def summary(self):
+        """
+        Returns the report as text.
+        """
+        report = self.report()
+        report['MB'] = report.pop('nbytes') / 1e6
+        with pd.option_context('display.max_rows', None, 'display.width', 160, 'display.float_format', '{:.3f}'.format):
+            return report.to_string()
+
+    def save(self, path):
+        """
+        Writes every record to path as JSON.
+        """
+        with open(path, 'w') as f:
+            json.dump(self.records, f, indent=1, default=str)
+
+
+def start():
+    """
+    Turns profiling on, with a new profiler. Returns it.
+    """
+    global _profiler
+    _profiler = Profiler()
+    return _profiler
+
+
+def stop():
+    """
+    Turns profiling off. Returns the profiler that was collecting, or None.
+    """
+    global _profiler
+    profiler, _profiler = _profiler, None
+    return profiler
+
+
+@contextmanager
+def profile():
+    """
+    Context manager that profiles its block and yields the Profiler. Profiling is put back as it was on exit.
+    """
+    global _profiler
+    previous = _profiler
+    profiler = start()
+    try:
+        yield profiler
+    finally:
+        _profiler = previous
+        if previous is not None:
+            previous.merge(profiler.records)
+
+
+def call_collecting(func, *args):
+    """
+    Runs func(*args) with profiling on and returns (value, records). For worker processes: the caller merges the
+    records into its own profiler.
+    """
+    # a forked worker starts with a copy of its parent's open spans. The parent puts the records under its own
+    _local.stack = []
+    with profile() as profiler:
+        value = func(*args)
+    return value, profiler.records
+
+
+def merge(records, **info):
+    """
+    Adds records from another process to the current profiler, if profiling is on, under the span open in this thread.
+    """
+    profiler = _profiler
+    if profiler is not None:
+        stack = getattr(_local, 'stack', None)
+        profiler.merge(records, prefix=stack[-1].path if stack else None, **info)
@@ -0,0 +1,172 @@
+"""
+Lazily loaded r1 data index with hash lookups (r1_index).
+"""
+
+import os
+import pickle
+import uuid
+
+import numpy as np
+import pandas as pd
+
+DEFAULT_INDEX_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'neuro', 'index')
+
+
+class R1Index:
+    """
+    Lazily built index of a cmlreaders protocol (default 'r1').
+
+    Parameters
+    ----------
+    protocol: str
+        Protocol name passed to cmlreaders.get_data_index
+    rootdir: str
+        Root of the protocols filesystem. The index is read from rootdir/protocols/<protocol>.json
+    cache_dir: str
+        Where to keep the pickled index. Set to False to disable the disk copy
+    """
+    def __init__(self, protocol='r1', rootdir='/', cache_dir=None):
+        self.protocol = protocol
+        self.rootdir = rootdir
+        self.cache_dir = DEFAULT_INDEX_DIR if cache_dir is None else cache_dir
+
+        # Built on first use
+        self._data = None
+        self._by_experiment = None
+        self._by_subject_montage = None
+        self._by_subject_experiment_montage = None
+
+    def __getstate__(self):
+        # workers rebuild from the disk copy rather than receiving the whole table
+        return {'protocol': self.protocol, 'rootdir': self.rootdir, 'cache_dir': self.cache_dir}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    # -- Loading --
+
+    @property
+    def source_file(self):
+        return os.path.join(self.rootdir, 'protocols', self.protocol + '.json')
+
+    @property
+    def data(self):
+        """
+        The full index as a DataFrame. Empty (but with the usual columns) if the protocol file can't be found.
+        """
+        if self._data is None:
+            self._load()
+        return self._data
+
+    def _source_fingerprint(self):
+        try:
+            st = os.stat(self.source_file)
+            return st.st_mtime_ns, st.st_size
+        except OSError:
+            return None
+
+    def _load(self):
+        fingerprint = self._source_fingerprint()
+        cache_path = os.path.join(self.cache_dir, self.protocol + '.pkl') if self.cache_dir else None
+
+        # try the disk copy first
+        data = None
+        if (cache_path is not None) and (fingerprint is not None) and os.path.exists(cache_path):
+            try:
+                with open(cache_path, 'rb') as f:
+                    cached = pickle.load(f)
+                if cached['fingerprint'] == fingerprint:
+                    data = cached['data']
+            except Exception:
+                data = None
+
+        # otherwise go through cmlreaders
+        if data is None:
+            try:
+                from cmlreaders import get_data_index
+                data = get_data_index(self.protocol, rootdir=self.rootdir)
+            except (KeyError, FileNotFoundError):
+                print('{} protocol file not found'.format(self.protocol))
+                data = pd.DataFrame(columns=['subject', 'experiment', 'session', 'montage', 'localization'])
+            else:
+                if (cache_path is not None) and (fingerprint is not None):
+                    self._save(cache_path, fingerprint, data)
+
+        self._set_data(data)
+
+    @staticmethod
+    def _save(cache_path, fingerprint, data):
+        try:
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            tmp = cache_path + '.' + uuid.uuid4().hex + '.tmp'
+            with open(tmp, 'wb') as f:
+                pickle.dump({'fingerprint': fingerprint, 'data': data}, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, cache_path)
+        except OSError:
+            pass
+
+    def _set_data(self, data):
+        data = data.reset_index(drop=True)
+        if len(data):
+            data['montage'] = data['montage'].astype(int)
+        self._data = data
+
+        # hash indexes, key -> row positions
+        self._by_experiment = data.groupby('experiment', sort=False).indices if len(data) else {}
+        self._by_subject_montage = data.groupby(['subject', 'montage'], sort=False).indices if len(data) else {}
+        self._by_subject_experiment_montage = data.groupby(['subject', 'experiment', 'montage'],
+                                                           sort=False).indices if len(data) else {}
+
+    def refresh(self):
+        """
+        Forces the index to be reloaded from the protocol file on next use.
+        """
+        self._data = None
+
+    # -- Lookups --
+
+    @property
+    def experiments(self):
+        """
+        Set of experiment names in the index.
+        """
+        self.data
+        return set(self._by_experiment.keys())
+
+    def has_experiment(self, task):
+        self.data
+        return task.replace('RAM_', '') in self._by_experiment
+
+    def has_montage(self, subject, montage=0):
+        """
+        True if this subject/montage is in the index.
+        """
+        self.data
+        return (subject, int(montage)) in self._by_subject_montage
+
+    def subjects_and_montages(self, task):
+        """
+        Returns a DataFrame with columns 'subject' and 'montage' of everyone who performed task.
+        """
+        self.data
+        rows = self._by_experiment.get(task.replace('RAM_', ''), np.array([], dtype=int))
+        return self._data.iloc[rows][['subject', 'montage']].drop_duplicates().reset_index(drop=True)
+
+    def rows(self, subject, task, montage=0):
+        """
+        Returns the index rows for a subject, experiment and montage.
+        """
+        self.data
+        rows = self._by_subject_experiment_montage.get((subject, task.replace('RAM_', ''), int(montage)),
+                                                       np.array([], dtype=int))
+        return self._data.iloc[rows]
+
+    def sessions(self, subject, task, montage=0):
+        """
+        Returns the unique session numbers for a subject, experiment and montage.
+        """
+        return self.rows(subject, task, montage)['session'].unique()
+
+
+# one shared instance for every module
+r1_index = R1Index('r1')
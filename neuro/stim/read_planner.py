@@ -0,0 +1,223 @@
+"""
+Reading event-locked EEG in coalesced sequential reads.
+"""
+
+import warnings
+from collections import namedtuple
+
+import numpy as np
+
+from cmlreaders import CMLReader
+from ptsa.data.timeseries import TimeSeries
+
+from neuro.stim.profiling import span
+
+REQUIRED_COLUMNS = ['subject', 'eegfile', 'eegoffset']
+
+# samples of slack read before and after each epoch, so the epoch's first sample can be matched to the reader's
+SLACK = 1
+
+# One read: samples [start, stop) of eegfile, holding the epochs of events at positions (row numbers in the events)
+# which start at epoch_starts
+ReadBlock = namedtuple('ReadBlock', ['eegfile', 'start', 'stop', 'positions', 'epoch_starts'])
+
+
+def epoch_samples(rel_start_ms, rel_stop_ms, samplerate):
+    """
+    Returns (first, n): the first sample of an epoch relative to its event's eegoffset, and its number of samples,
+    rounded to the nearest sample. The reader may round differently; load_planned_eeg lines this up with it.
+    """
+    first = int(np.round(rel_start_ms * samplerate / 1000.))
+    n = int(np.round((rel_stop_ms - rel_start_ms) * samplerate / 1000.))
+    return first, n
+
+
+def _read_epochs(events, rel_start_ms, rel_stop_ms, elec_scheme):
+    """
+    Reads events the usual way, one epoch per event. Returns an events x channels x time TimeSeries.
+    """
+    reader = CMLReader(subject=events['subject'].iloc[0])
+    return reader.load_eeg(events, rel_start=rel_start_ms, rel_stop=rel_stop_ms, scheme=elec_scheme).to_ptsa()
+
+
+def reference_epochs(events, rel_start_ms, rel_stop_ms, elec_scheme=None):
+    """
+    Reads the earliest event of each eeg file of events the usual way. Returns {eegfile: (position, channel x time
+    TimeSeries)}, position being the event's row number in events.
+    """
+    eegoffset = events['eegoffset'].to_numpy(dtype=np.int64)
+    eegfile = events['eegfile'].astype(object).to_numpy()
+    out = {}
+    for f in dict.fromkeys(eegfile):
+        rows = np.flatnonzero(eegfile == f)
+        position = rows[np.argmin(eegoffset[rows])]
+        eeg = _read_epochs(events.iloc[[position]], rel_start_ms, rel_stop_ms, elec_scheme)
+        out[f] = (position, eeg.isel(event=0).transpose('channel', 'time'))
+    return out
+
+
+
+def plan_reads(events, n_epoch, first, samplerate, max_gap_ms=500., max_block_s=60.):
+    """
+    Merges the epochs of events into reads.
+
+    Parameters
+    ----------
+    events: pandas.DataFrame
+        Events with 'eegfile' and 'eegoffset'
+    n_epoch: int
+        Samples per epoch
+    first: int
+        First sample of each epoch relative to its eegoffset (see epoch_samples)
+    samplerate: float
+        Sample rate of the eeg files
+    max_gap_ms: float
+        Epochs at most this far apart are read together, gap included. 0 only merges overlapping or touching epochs
+    max_block_s: float
+        A read isn't extended past this length (an epoch longer than this is still read whole). None for no limit
+
+    Returns
+    -------
+    list
+        ReadBlocks, sorted by eegfile and start
+    """
+    eegfile = events['eegfile'].astype(object).to_numpy()
+    starts = events['eegoffset'].to_numpy(dtype=np.int64) + first
+    order = np.lexsort((starts, eegfile))
+    max_gap = int(np.round(max_gap_ms * samplerate / 1000.))
+    max_len = np.inf if max_block_s is None else int(max_block_s * samplerate)
+
+    blocks = []
+    block = None
+    for i in order:
+        start, stop = starts[i], starts[i] + n_epoch
+        if (block is not None) and (eegfile[i] == block[0]) and (start - block[2] <= max_gap) and \
+                (max(stop, block[2]) - block[1] <= max_len):
+            block[2] = max(block[2], stop)
+            block[3].append(i)
+        else:
+            block = [eegfile[i], start, stop, [i]]
+            blocks.append(block)
+    return [ReadBlock(f, int(start), int(stop), np.array(positions), starts[positions] - start)
+            for f, start, stop, positions in blocks]
+
+
+def plan_summary(blocks, n_epoch):
+    """
+    Returns counts describing a plan: reads and samples, against reading every epoch on its own.
+    """
+    n_events = sum(len(b.positions) for b in blocks)
+    return {'n_events': n_events, 'n_reads': len(blocks),
+            'samples_read': int(sum(b.stop - b.start for b in blocks)), 'samples_epochs': n_events * n_epoch}
+
+
+def _read_block(block, event, samplerate, elec_scheme):
+    """
+    Reads samples [block.start, block.stop) of block's eeg file. Returns a channel x time TimeSeries.
+    """
+    event = event.copy()
+    event['eegoffset'] = block.start
+    n = block.stop - block.start
+    # half a sample extra, so rounding in the reader never leaves the read one sample short
+    reader = CMLReader(subject=event['subject'].iloc[0])
+    eeg = reader.load_eeg(event, rel_start=0, rel_stop=(n + .5) * 1000. / samplerate, scheme=elec_scheme).to_ptsa()
+    eeg = eeg.isel(event=0).transpose('channel', 'time')
+    if eeg.sizes['time'] < n:
+        raise IOError('Read {} samples of {} at {}, expected {}'.format(eeg.sizes['time'], block.eegfile, block.start,
+                                                                        n))
+    return eeg
+
+
+def load_planned_eeg(events, rel_start_ms, rel_stop_ms, elec_scheme=None, max_gap_ms=500., max_block_s=60.,
+                     dtype=None):
+    """
+    Returns event-locked EEG read in coalesced blocks (see plan_reads), as CMLReader(...).load_eeg(...).to_ptsa()
+    would return it.
+
+    The earliest event of each eeg file is read the usual way and matched against its block, which gives the sample
+    rate, epoch length, time coordinate and channels, and where the reader's epochs start. If it can't be matched,
+    that file's events are read per epoch instead.
+
+    Parameters
+    ----------
+    events: pandas.DataFrame
+        Events with 'subject', 'eegfile' and 'eegoffset'
+    rel_start_ms: int
+        Initial time (in ms), relative to the onset of each event
+    rel_stop_ms: int
+        End time (in ms), relative to the onset of each event
+    elec_scheme: pandas.DataFrame
+        Channels to read, as for CMLReader.load_eeg
+    max_gap_ms: float
+        Epochs at most this far apart are read together
+    max_block_s: float
+        Longest read, in seconds
+    dtype: str
+        dtype of the returned data, if not the reader's. The epochs are copied into it block by block, so the reader's
+        (float64) data is never held for more than one block
+
+    Returns
+    -------
+    TimeSeries
+        events x channels x time, events in their original order
+    """
+    if len(events) == 0:
+        raise ValueError('No events to load eeg for')
+    missing = [col for col in REQUIRED_COLUMNS if col not in events]
+    if missing:
+        raise ValueError('Reading planned eeg needs the event columns {}, missing {}'.format(REQUIRED_COLUMNS, missing))
+
+    # one epoch per eeg file read the usual way: the reader's own sample rate, epoch length and times
+    references = reference_epochs(events, rel_start_ms, rel_stop_ms, elec_scheme)
+    rates = {f: float(eeg['samplerate']) for f, (_, eeg) in references.items()}
+    lengths = {f: eeg.sizes['time'] for f, (_, eeg) in references.items()}
+    if (len(set(rates.values())) != 1) or (len(set(lengths.values())) != 1):
+        raise ValueError('Events come from eeg files with different sample rates or epoch lengths: {} {}'.format(
+            rates, lengths))
+    _, template = next(iter(references.values()))
+    samplerate = rates[next(iter(rates))]
+    n_epoch = template.sizes['time']
+
+    # each epoch is read with SLACK samples either side, and where it starts in that is found from the reference epoch
+    first, _ = epoch_samples(rel_start_ms, rel_stop_ms, samplerate)
+    first -= SLACK
+    with span('plan') as s:
+        blocks = plan_reads(events, n_epoch + 2 * SLACK, first, samplerate, max_gap_ms, max_block_s)
+        s.set(**plan_summary(blocks, n_epoch + 2 * SLACK))
+
+    data = np.empty((len(events), template.sizes['channel'], n_epoch), dtype=template.dtype if dtype is None else dtype)
+    shift = {}
+    for block in blocks:
+        block_data = _read_block(block, events.iloc[[block.positions[0]]], samplerate, elec_scheme).values
+        if block.eegfile not in shift:
+            # the file's earliest event is in its first block
+            position, reference = references[block.eegfile]
+            start = block.epoch_starts[np.flatnonzero(block.positions == position)[0]]
+            shift[block.eegfile] = _match_epoch(block_data, start, reference.values)
+            if shift[block.eegfile] is None:
+                warnings.warn('Planned reads of {} did not line up with the reader, reading per epoch'.format(
+                    block.eegfile))
+                eeg = _read_epochs(events, rel_start_ms, rel_stop_ms, elec_scheme)
+                if dtype is not None:
+                    eeg.data = eeg.data.astype(dtype)
+                return eeg
+        for position, start in zip(block.positions, block.epoch_starts + shift[block.eegfile]):
+            data[position] = block_data[:, start:start + n_epoch]
+
+    coords = {name: ('channel', template[name].values) for name in template.coords
+              if template[name].dims == ('channel',)}
+    coords['event'] = events.to_records(index=False)
+    coords['time'] = template['time'].values
+    return TimeSeries.create(data, samplerate, coords=coords, dims=('event', 'channel', 'time'))
+
+
+def _match_epoch(block_data, start, reference):
+    """
+    Returns the shift (0 to 2 * SLACK) from start at which reference (channel x time) is found in block_data, or None.
+    """
+    n = reference.shape[-1]
+    for shift in range(2 * SLACK + 1):
+        candidate = block_data[:, start + shift:start + shift + n]
+        if (candidate.shape == reference.shape) and np.array_equal(candidate, reference):
+            return shift
+    return None
@@ -0,0 +1,184 @@
+"""
+Bipolar, average and laplacian re-referencing of EEG read once from the monopolar contacts.
+"""
+
+import re
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from ptsa.data.timeseries import TimeSeries
+
+REFERENCES = ['bipolar', 'average', 'laplacian']
+
+# label of a contact on a lead: lead name then contact number (ex: 'LA3')
+LEAD_LABEL = re.compile(r'^(.*?)(\d+)$')
+
+
+def is_bipolar(elec_scheme):
+    return (elec_scheme is not None) and ('contact_1' in elec_scheme) and ('contact_2' in elec_scheme)
+
+
+def pair_contact_labels(labels):
+    """
+    Splits bipolar labels ('LA1-LA2') into the two contact labels. Labels that don't split into two give None for both.
+    """
+    parts = pd.Series(labels, dtype=object).str.split('-')
+    ok = parts.str.len() == 2
+    first = np.where(ok, parts.str[0], None)
+    second = np.where(ok, parts.str[-1], None)
+    return first, second
+
+
+def monopolar_scheme(elec_scheme):
+    """
+    Returns the monopolar contacts (columns 'contact' and 'label', sorted by contact) needed to compute elec_scheme.
+    For bipolar pairs, contact labels come from splitting the pair labels, or are the contact number where they can't
+    be split. A monopolar scheme is returned as it is.
+    """
+    if elec_scheme is None:
+        raise ValueError('Re-referencing needs an elec_scheme')
+    if not is_bipolar(elec_scheme):
+        return elec_scheme
+    first, second = pair_contact_labels(elec_scheme['label'] if 'label' in elec_scheme else [None] * len(elec_scheme))
+    contacts = pd.DataFrame({
+        'contact': np.concatenate([elec_scheme['contact_1'].to_numpy(), elec_scheme['contact_2'].to_numpy()]),
+        'label': np.concatenate([first, second]),
+    })
+    contacts = contacts.drop_duplicates('contact').sort_values('contact', kind='stable').reset_index(drop=True)
+    missing = contacts['label'].isna()
+    contacts.loc[missing, 'label'] = contacts.loc[missing, 'contact'].astype(str)
+    if 'type' in elec_scheme:
+        contacts['type'] = elec_scheme['type'].iloc[0]
+    return contacts
+
+
+def _contact_positions(contacts, numbers):
+    """
+    Returns the row of each contact number in contacts.
+    """
+    lookup = pd.Index(contacts['contact'].to_numpy())
+    positions = lookup.get_indexer(np.asarray(numbers))
+    if (positions < 0).any():
+        raise ValueError('Contacts {} were not read'.format(np.asarray(numbers)[positions < 0]))
+    return positions
+
+
+def bipolar_indices(pairs, contacts):
+    """
+    Returns (first, second): the rows of contacts holding each pair's contact_1 and contact_2.
+    """
+    return _contact_positions(contacts, pairs['contact_1']), _contact_positions(contacts, pairs['contact_2'])
+
+
+def bipolar_matrix(pairs, contacts):
+    """
+    Returns the sparse pairs x contacts matrix taking monopolar data to bipolar: +1 at contact_1, -1 at contact_2.
+    """
+    first, second = bipolar_indices(pairs, contacts)
+    rows = np.arange(len(pairs))
+    values = np.r_[np.ones(len(pairs)), -np.ones(len(pairs))]
+    return sparse.csr_matrix((values, (np.r_[rows, rows], np.r_[first, second])), shape=(len(pairs), len(contacts)))
+
+
+def neighbour_pairs(contacts):
+    """
+    Returns (contact_1, contact_2) arrays of neighbouring contacts: same lead name and consecutive numbers in the label.
+    """
+    parsed = contacts['label'].astype(str).str.extract(LEAD_LABEL)
+    df = pd.DataFrame({'contact': contacts['contact'].to_numpy(), 'lead': parsed[0].to_numpy(),
+                       'number': pd.to_numeric(parsed[1]).to_numpy()}).dropna()
+    nxt = df.assign(number=df['number'] - 1)
+    merged = df.merge(nxt, on=['lead', 'number'], suffixes=('_1', '_2'))
+    return merged['contact_1'].to_numpy(), merged['contact_2'].to_numpy()
+
+
+def laplacian_matrix(contacts, pairs=None):
+    """
+    Returns the sparse contacts x contacts matrix taking monopolar data to a local (Laplacian) reference: each contact
+    minus the mean of its neighbours. Neighbours are the contacts it's paired with in pairs if given, otherwise the
+    contacts before and after it on its lead (see neighbour_pairs). Only contacts in contacts count; one without
+    neighbours is left as it is.
+    """
+    if pairs is not None:
+        first, second = pairs['contact_1'].to_numpy(), pairs['contact_2'].to_numpy()
+        read = np.isin(first, contacts['contact']) & np.isin(second, contacts['contact'])
+        first, second = first[read], second[read]
+    else:
+        first, second = neighbour_pairs(contacts)
+    first, second = _contact_positions(contacts, first), _contact_positions(contacts, second)
+
+    n = len(contacts)
+    adjacency = sparse.csr_matrix((np.ones(2 * len(first)), (np.r_[first, second], np.r_[second, first])),
+                                  shape=(n, n))
+    # a pair listed twice is still one neighbour
+    adjacency.data[:] = 1.
+    n_neighbours = np.asarray(adjacency.sum(axis=1)).ravel()
+    scale = sparse.diags(np.divide(1., n_neighbours, out=np.zeros(n), where=n_neighbours > 0))
+    return (sparse.identity(n, format='csr') - scale @ adjacency).tocsr()
+
+
+def apply_channel_matrix(data, matrix, axis):
+    """
+    Returns matrix (out channels x channels, sparse or dense) applied along the channel axis of data.
+    """
+    moved = np.moveaxis(data, axis, 0)
+    out = matrix.astype(data.dtype) @ moved.reshape(moved.shape[0], -1)
+    out = np.asarray(out, dtype=data.dtype).reshape((matrix.shape[0],) + moved.shape[1:])
+    return np.moveaxis(out, 0, axis)
+
+
+def _with_channels(eeg, data, labels):
+    """
+    Returns a TimeSeries like eeg with new data and channel labels.
+    """
+    coords = {name: (eeg[name].dims, eeg[name].values) for name in eeg.coords
+              if ('channel' not in eeg[name].dims) and (name != 'samplerate')}
+    coords['channel'] = np.asarray(labels)
+    return TimeSeries.create(data, float(eeg['samplerate']), coords=coords, dims=eeg.dims, attrs=eeg.attrs)
+
+
+def rereference(eeg, elec_scheme, reference='bipolar', method='gather'):
+    """
+    Computes the channels of a reference from monopolar EEG read with monopolar_scheme(elec_scheme).
+
+    Parameters
+    ----------
+    eeg: TimeSeries
+        Monopolar EEG, channels in the order of monopolar_scheme(elec_scheme)
+    elec_scheme: pandas.DataFrame
+        The channels asked for. Bipolar pairs for 'bipolar'. For 'average' and 'laplacian', contacts, or pairs (then
+        the channels are their contacts and the pairs are the Laplacian's neighbours)
+    reference: str
+        'bipolar', 'average' or 'laplacian'
+    method: str
+        For 'bipolar': 'gather' (index and subtract) or 'sparse' (matrix product). Same result
+
+    Returns
+    -------
+    TimeSeries
+        Same dims as eeg. Channels are labeled with elec_scheme's labels for 'bipolar', the contacts' otherwise
+    """
+    if reference not in REFERENCES:
+        raise ValueError('reference must be one of {}, not {}'.format(REFERENCES, reference))
+    contacts = monopolar_scheme(elec_scheme)
+    axis = eeg.get_axis_num('channel')
+    data = eeg.values
+
+    if reference == 'bipolar':
+        if not is_bipolar(elec_scheme):
+            raise ValueError("A bipolar reference needs an elec_scheme with 'contact_1' and 'contact_2'")
+        if method == 'sparse':
+            out = apply_channel_matrix(data, bipolar_matrix(elec_scheme, contacts), axis)
+        else:
+            first, second = bipolar_indices(elec_scheme, contacts)
+            out = np.take(data, first, axis=axis) - np.take(data, second, axis=axis)
+        return _with_channels(eeg, out, elec_scheme['label'].to_numpy())
+
+    if reference == 'average':
+        out = data - data.mean(axis=axis, keepdims=True, dtype=np.float64).astype(data.dtype)
+    else:
+        matrix = laplacian_matrix(contacts, elec_scheme if is_bipolar(elec_scheme) else None)
+        out = apply_channel_matrix(data, matrix, axis)
+    return _with_channels(eeg, out, contacts['label'].to_numpy())
@@ -0,0 +1,171 @@
+"""
+Assigning electrodes to regions of interest (ROIs) and hemispheres.
+"""
+
+import numpy as np
+import pandas as pd
+
+# used by bin_electrodes_by_region
+DEFAULT_ROI_DICT = {
+    'Hipp': ['Left CA1', 'Left CA2', 'Left CA3', 'Left DG', 'Left Sub', 'Right CA1', 'Right CA2', 'Right CA3',
+             'Right DG', 'Right Sub'],
+    'MTL': ['Left PRC', 'Right PRC', 'Right EC', 'Right PHC', 'Left EC', 'Left PHC'],
+    'Frontal': ['parsopercularis', 'parsorbitalis', 'parstriangularis', 'caudalmiddlefrontal', 'rostralmiddlefrontal',
+                'superiorfrontal'],
+    'Temporal': ['superiortemporal', 'middletemporal', 'inferiortemporal'],
+    'Parietal': ['inferiorparietal', 'supramarginal', 'superiorparietal', 'precuneus'],
+    'Occipital': ['lateraloccipital', 'lingual', 'cuneus', 'pericalcarine'],
+}
+
+# used by clean_electrodes. Splits the hippocampus into subfields and the frontal lobe into gyri
+DETAILED_ROI_DICT = {
+    'Hipp': ['Left CA1', 'Left CA2', 'Left CA3', 'Right CA1', 'Right CA2', 'Right CA3'],
+    'DG': ['Left DG', 'Right DG'],
+    'Sub': ['Left Sub', 'Right Sub'],
+    'EC': ['Right EC', 'Left EC'],
+    'HippFormation': ['Left CA1', 'Left CA2', 'Left CA3', 'Right CA1', 'Right CA2', 'Right CA3', 'Left DG',
+                      'Right DG', 'Left Sub', 'Right Sub'],
+    'MTL': ['Left PRC', 'Right PRC', 'Right EC', 'Right PHC', 'Left EC', 'Left PHC'],
+    'IFG': ['parsopercularis', 'parsorbitalis', 'parstriangularis'],  # This may contain Broca's Area
+    'MFG': ['caudalmiddlefrontal', 'rostralmiddlefrontal'],  # This may contrain DLPFC
+    'SFG': ['superiorfrontal'],
+    'Frontal': ['parsopercularis', 'parsorbitalis', 'parstriangularis', 'caudalmiddlefrontal', 'rostralmiddlefrontal',
+                'superiorfrontal'],
+    'Temporal': ['superiortemporal', 'middletemporal', 'inferiortemporal'],
+    'Parietal': ['inferiorparietal', 'supramarginal', 'superiorparietal', 'precuneus'],
+    'Occipital': ['lateraloccipital', 'lingual', 'cuneus', 'pericalcarine'],
+}
+
+# used by filter_subject_to_region. Adds amygdala and medial orbitofrontal
+SUBJECT_FILTER_ROI_DICT = {
+    'Hipp': ['Left CA1', 'Left CA2', 'Left CA3', 'Left DG', 'Left Sub', 'Right CA1', 'Right CA2', 'Right CA3',
+             'Right DG', 'Right Sub'],
+    'MTL': ['Left PRC', 'Right PRC', 'Right EC', 'Right PHC', 'Left EC', 'Left PHC'],
+    'EC': ['Right EC', 'Left EC'],
+    'Amy': ['Left Amy', 'Right Amy'],
+    'Frontal': ['parsopercularis', 'parsorbitalis', 'parstriangularis', 'caudalmiddlefrontal', 'rostralmiddlefrontal',
+                'superiorfrontal', 'medialorbitofrontal'],
+    'Temporal': ['superiortemporal', 'middletemporal', 'inferiortemporal'],
+    'Parietal': ['inferiorparietal', 'supramarginal', 'superiorparietal', 'precuneus'],
+    'Occipital': ['lateraloccipital', 'lingual', 'cuneus', 'pericalcarine'],
+}
+
+# every localization column, most trusted first
+REGION_COLUMNS = ['stein.region', 'ind.region', 'avg.region', 'mni.region', 'tal.region', 'vox.region', 'wb.region',
+                  'das.region']
+
+
+def coalesce_regions(elec_info, region_columns=REGION_COLUMNS):
+    """
+    Returns one region label per electrode, taken from the first of region_columns that has one ('' if none do).
+    Columns not in elec_info are skipped.
+    """
+    regions = pd.Series(np.full(len(elec_info), np.nan, dtype=object), index=elec_info.index)
+    for col in region_columns:
+        if col in elec_info:
+            regions = regions.fillna(elec_info[col].astype(object))
+    return regions.fillna('')
+
+
+def hemisphere(elec_info, x_coord_column='ind.x'):
+    """
+    Returns a categorical of 'left' (x < 0) or 'right' (everything else, including missing coordinates).
+    """
+    x = pd.to_numeric(elec_info[x_coord_column], errors='coerce').to_numpy()
+    return pd.Categorical.from_codes((x < 0).astype(np.int8), categories=['right', 'left'])
+
+
+class RoiClassifier:
+    """
+    Vectorized region label -> ROI lookup compiled from a roi_dict.
+
+    A label can be in more than one ROI (ex: 'Left CA1' is in both 'Hipp' and 'HippFormation'). The 'roi' column gives
+    the last matching ROI in roi_dict order, and the 'roi_mask' column keeps every membership as a bitmask (bit i for
+    the i-th ROI), which in_roi() tests against.
+
+    Parameters
+    ----------
+    roi_dict: dict
+        Mapping of ROI name to the list of region labels in it. Default: DEFAULT_ROI_DICT
+    """
+    def __init__(self, roi_dict=None):
+        self.roi_dict = DEFAULT_ROI_DICT if roi_dict is None else roi_dict
+        self.rois = list(self.roi_dict.keys())
+        if len(self.rois) > 63:
+            raise ValueError('At most 63 ROIs are supported')
+
+        # label -> bitmask of every ROI it is in, and label -> code of the last one
+        masks = {}
+        codes = {}
+        for i, roi in enumerate(self.rois):
+            for label in self.roi_dict[roi]:
+                masks[label] = masks.get(label, 0) | (1 << i)
+                codes[label] = i
+        self.label_masks = pd.Series(masks, dtype=np.int64)
+        self.label_codes = pd.Series(codes, dtype=np.int64)
+
+        # unmatched electrodes get '', as they always have
+        self.categories = self.rois + ['']
+
+    def roi_codes(self, regions):
+        """
+        Returns the index into self.categories of each region label's ROI.
+        """
+        codes = pd.Series(regions).astype(object).map(self.label_codes)
+        return codes.fillna(len(self.rois)).to_numpy(dtype=np.int64)
+
+    def roi(self, regions):
+        """
+        Returns a categorical of the ROI of each region label ('' if it isn't in any).
+        """
+        return pd.Categorical.from_codes(self.roi_codes(regions), categories=self.categories)
+
+    def roi_mask(self, regions):
+        """
+        Returns the bitmask of every ROI each region label is in.
+        """
+        return pd.Series(regions).astype(object).map(self.label_masks).fillna(0).to_numpy(dtype=np.int64)
+
+    def bits(self, rois):
+        """
+        Returns the bitmask selecting one or more ROIs.
+        """
+        rois = [rois] if isinstance(rois, str) else list(rois)
+        return int(sum(1 << self.rois.index(roi) for roi in rois if roi in self.rois))
+
+    def in_roi(self, roi_mask, rois):
+        """
+        Returns a boolean array, True where a roi_mask (from roi_mask() or classify()) is in any of rois.
+        """
+        return (np.asarray(roi_mask, dtype=np.int64) & self.bits(rois)) != 0
+
+    def classify(self, elec_info, region_columns=REGION_COLUMNS, x_coord_column='ind.x', label_column='label',
+                 keep_columns=('subject', 'montage')):
+        """
+        Classifies every electrode of a table (one subject or many) in one pass.
+
+        Parameters
+        ----------
+        elec_info: pandas.DataFrame
+            Electrode table(s), from load_electrode_info() or a GroupTable
+        region_columns: list
+            Localization columns to take the region label from, most trusted first
+        x_coord_column: str
+            Column specifying the x-coordinate of each electrode. Positive values are right hemisphere
+        label_column: str
+            Electrode label column, copied to the output
+        keep_columns: list
+            Other columns copied to the output if present (ex: subject, montage)
+
+        Returns
+        -------
+        pandas.DataFrame
+            Columns label (and keep_columns), region (categorical ROI), hemi (categorical) and roi_mask
+        """
+        regions = coalesce_regions(elec_info, region_columns)
+        columns = [col for col in [label_column] + list(keep_columns) if col in elec_info]
+        region_df = elec_info[columns].copy()
+        region_df['region'] = self.roi(regions)
+        region_df['hemi'] = hemisphere(elec_info, x_coord_column)
+        region_df['roi_mask'] = self.roi_mask(regions)
+        return region_df
@@ -0,0 +1,177 @@
+"""
+Columnar construction of stimulation tables.
+"""
+
+import numpy as np
+import pandas as pd
+
+from neuro.stim.events import STIM_PREFIX, is_compact, unflatten_stim_params
+
+STIM_TYPES = {'OFF': ['STIM_OFF'], 'ON': ['STIM_ON'], 'BOTH': ['STIM_ON', 'STIM_OFF']}
+
+
+def expand_stim_params(stim_params, index=None):
+    """
+    Expands a column of stim_params (lists of dicts, as in cmlreaders events) into a DataFrame with one column per key.
+    Only the first dict of each list is used, as load_stimulation_info always has.
+
+    Parameters
+    ----------
+    stim_params: pandas.Series or list
+        The 'stim_params' column of an events DataFrame
+    index: pandas.Index
+        Index for the returned DataFrame. Defaults to the index of stim_params
+
+    Returns
+    -------
+    pandas.DataFrame
+    """
+    if index is None:
+        index = getattr(stim_params, 'index', None)
+    first = [p[0] if (p is not None and len(p)) else {} for p in stim_params]
+    return pd.DataFrame.from_records(first, index=index)
+
+
+def stim_params_frame(events):
+    """
+    Returns the stim parameters of events as a DataFrame with one column per key (the first dict of each event's
+    stim_params), from either events layout. For compact events (see events.compact_events) it is a column selection.
+    """
+    if not is_compact(events):
+        return expand_stim_params(events['stim_params'])
+    params = events[[col for col in events.columns if col.startswith(STIM_PREFIX)]]
+    if params[STIM_PREFIX + 'rest'].notna().any():
+        # some entries are only in 'rest', go through the lists of dicts
+        return expand_stim_params(unflatten_stim_params(params))
+    params = params.drop(columns=[STIM_PREFIX + 'n', STIM_PREFIX + 'rest'])
+    return params.rename(columns=lambda col: col[len(STIM_PREFIX):])
+
+
+def electrode_locations(electrodes_df, label_column='label', coord_prefix='avg'):
+    """
+    Returns one row per electrode label with the tuple of string regions from every '*region*' column, its x/y/z
+    coordinates and hemisphere. If a label appears more than once, the first row is used.
+
+    Parameters
+    ----------
+    electrodes_df: pandas.DataFrame
+        Electrode DataFrame, from load_electrode_info()
+    label_column: str
+        Column with the electrode labels
+    coord_prefix: str
+        Which set of coordinates to use (ex: 'avg' for 'avg.x', 'avg.y', 'avg.z')
+
+    Returns
+    -------
+    pandas.DataFrame
+        Columns: label, location, hemi, x, y, z. hemi is missing where x is
+    """
+    elecs = electrodes_df.drop_duplicates(subset=label_column)
+    region_cols = [col for col in elecs.columns if 'region' in col]
+
+    # keep only the string entries of each region column, in column order
+    regions = elecs[region_cols].to_numpy(dtype=object)
+    is_str = np.frompyfunc(lambda v: isinstance(v, str), 1, 1)(regions).astype(bool)
+    locations = [tuple(row[mask]) for row, mask in zip(regions, is_str)]
+
+    x = elecs[coord_prefix + '.x'].to_numpy(dtype=float)
+    return pd.DataFrame({
+        'label': elecs[label_column].to_numpy(),
+        'location': locations,
+        'hemi': np.where(np.isnan(x), None, np.where(x < 0, 'left', 'right')),
+        'x': x,
+        'y': elecs[coord_prefix + '.y'].to_numpy(dtype=float),
+        'z': elecs[coord_prefix + '.z'].to_numpy(dtype=float),
+    })
+
+
+def pair_stim_on_off(stim_df, stim_events, events_df):
+    """
+    Adds the matching STIM_ON to every STIM_OFF row of a stimulation table. For each STIM_OFF, the last STIM_ON at or
+    before it in the same session is used.
+
+    Parameters
+    ----------
+    stim_df: pandas.DataFrame
+        Stimulation table, one row per row of stim_events
+    stim_events: pandas.DataFrame
+        The events stim_df was built from
+    events_df: pandas.DataFrame
+        All events, to look for STIM_ON events in
+
+    Returns
+    -------
+    pandas.DataFrame
+        stim_df with columns 'on_event_index', 'on_mstime', 'on_eegoffset' and 'stim_duration_ms' added (NaN where
+        there is no ON)
+    """
+    session_col = 'session' if 'session' in events_df else 'eegfile'
+    on = events_df[events_df['type'] == 'STIM_ON']
+    on = pd.DataFrame({
+        '_session': on[session_col].to_numpy(),
+        'on_event_index': on.index.to_numpy(),
+        'on_mstime': on['mstime'].to_numpy(),
+        'on_eegoffset': on['eegoffset'].to_numpy(),
+    }).sort_values('on_mstime')
+
+    off = stim_df.assign(_session=stim_events[session_col].to_numpy(), _order=np.arange(len(stim_df)))
+    off = off.sort_values('mstime')
+    paired = pd.merge_asof(off, on, left_on='mstime', right_on='on_mstime', by='_session', direction='backward')
+    paired.loc[paired['event_name'] != 'STIM_OFF', ['on_event_index', 'on_mstime', 'on_eegoffset']] = np.nan
+    paired['stim_duration_ms'] = paired['mstime'] - paired['on_mstime']
+    return paired.sort_values('_order').drop(columns=['_session', '_order']).reset_index(drop=True)
+
+
+def build_stimulation_table(events_df, electrodes_df, on_off='OFF', pair_on_off=False):
+    """
+    Returns a DataFrame of stimulation events and metadata (time, location, stim_params, ...). Same output as the old
+    per-event load_stimulation_info, built with whole-table operations.
+
+    Parameters
+    ----------
+    events_df: pandas.DataFrame
+        Events DataFrame, from load_events_info(). May be compact (see events.compact_events)
+    electrodes_df: pandas.DataFrame
+        Bipolar electrode DataFrame, from load_electrode_info(bipolar=True)
+    on_off: str
+        Choose whether to filter by 'STIM_ON' or 'STIM_OFF'
+        Options: ['OFF', 'ON', 'BOTH']
+    pair_on_off: bool
+        If True, each STIM_OFF row also gets the time / offset of the STIM_ON that started it (see pair_stim_on_off)
+
+    Returns
+    -------
+    pandas.DataFrame
+        One row per stim event with columns electrode, location, hemi, x, y, z, event_index, event_name, mstime,
+        eegoffset and one column per stim_params key
+    """
+    stim_events = events_df[events_df['type'].isin(STIM_TYPES[on_off.upper()])]
+
+    # stim_params -> columns, and the bipolar label they stimulated
+    params = stim_params_frame(stim_events)
+    if len(params):
+        bilabel = (params['anode_label'].astype(str) + '-' + params['cathode_label'].astype(str)).to_numpy()
+    else:
+        bilabel = np.array([], dtype=object)
+
+    stim_df = pd.DataFrame({
+        'electrode': bilabel,
+        'event_index': stim_events.index.to_numpy(),
+        'event_name': stim_events['type'].to_numpy(),
+        'mstime': stim_events['mstime'].to_numpy(),
+        'eegoffset': stim_events['eegoffset'].to_numpy(),
+    })
+
+    # one merge against the per-electrode locations
+    locations = electrode_locations(electrodes_df).rename(columns={'label': 'electrode'})
+    # stim electrodes not in the electrode table have no location, coordinates or hemisphere: left missing
+    stim_df = stim_df.merge(locations, on='electrode', how='left')
+
+    columns = ['electrode', 'location', 'hemi', 'x', 'y', 'z', 'event_index', 'event_name', 'mstime', 'eegoffset']
+    stim_df = stim_df[columns]
+    params = params.reset_index(drop=True)
+    stim_df = pd.concat([stim_df, params.drop(columns=[c for c in params.columns if c in columns])], axis=1)
+
+    if pair_on_off:
+        stim_df = pair_stim_on_off(stim_df, stim_events, events_df)
+    return stim_df
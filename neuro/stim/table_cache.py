@@ -0,0 +1,283 @@
+"""
+Persistent on-disk cache for per-subject tables (events, electrodes, stimulation).
+"""
+
+import hashlib
+import json
+import os
+import uuid
+from glob import glob
+
+import pandas as pd
+
+try:
+    import pyarrow  # noqa: F401
+    HAS_PYARROW = True
+except ImportError:
+    HAS_PYARROW = False
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'neuro', 'tables')
+
+
+class TableCache:
+    """
+    Size capped, content addressed on-disk cache of pandas DataFrames.
+
+    Entries are keyed on the table's loader options and the mtime and size of its source files, so a changed source
+    invalidates them. Tables are stored as Parquet when pyarrow is installed, with object columns that aren't plain
+    strings pickled alongside, and pickled whole otherwise. Each entry has a json sidecar whose mtime orders eviction.
+
+    Parameters
+    ----------
+    cache_dir: str
+        Directory to keep the cache in. Created if it doesn't exist. Default: ~/.cache/neuro/tables
+    max_bytes: int
+        Once the cache is bigger than this, the least recently used entries are removed
+    """
+    def __init__(self, cache_dir=None, max_bytes=int(5e9)):
+        self.cache_dir = DEFAULT_CACHE_DIR if cache_dir is None else cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        # Stats, for this process
+        self.hits = 0
+        self.misses = 0
+
+    def __getstate__(self):
+        # only ship the location and options to worker processes, not this process' counters
+        return {'cache_dir': self.cache_dir, 'max_bytes': self.max_bytes}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    # -- Keys --
+
+    @staticmethod
+    def make_key(kind, task, subject, montage, session=None, options=None, source_files=None):
+        """
+        Returns the hex digest identifying a table. Source files are fingerprinted by (path, mtime, size), so a changed
+        file gives a new key.
+        """
+        fingerprints = []
+        for f in sorted(source_files or []):
+            try:
+                st = os.stat(f)
+                fingerprints.append([f, st.st_mtime_ns, st.st_size])
+            except OSError:
+                fingerprints.append([f, None, None])
+
+        key = {
+            'kind': kind,
+            'task': str(task).replace('RAM_', ''),
+            'subject': str(subject),
+            'montage': str(montage),
+            'session': None if session is None else str(session),
+            'options': {} if options is None else {k: str(v) for k, v in options.items()},
+            'sources': fingerprints,
+        }
+        return hashlib.sha1(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+    def _path(self, key, ext):
+        return os.path.join(self.cache_dir, key + ext)
+
+    # -- Reading and writing --
+
+    def get(self, key):
+        """
+        Returns the cached DataFrame for key, or None if there isn't one.
+        """
+        meta_path = self._path(key, '.json')
+        try:
+            with open(meta_path, 'r') as f:
+                meta = json.load(f)
+            if meta['format'] == 'parquet':
+                df = pd.read_parquet(self._path(key, '.parquet'))
+                if meta['object_columns']:
+                    obj = pd.read_pickle(self._path(key, '.obj.pkl'))
+                    for col in obj.columns:
+                        df[col] = obj[col].values
+                df = df[meta['columns']]
+            else:
+                df = pd.read_pickle(self._path(key, '.pkl'))
+        except (OSError, ValueError, KeyError):
+            self.misses += 1
+            return None
+
+        # mark as recently used
+        try:
+            os.utime(meta_path)
+        except OSError:
+            pass
+        self.hits += 1
+        return df
+
+    def put(self, key, df, subject=None, kind=None):
+        """
+        Stores df under key, then evicts old entries if the cache is over max_bytes.
+        """
+        tmp = '.' + uuid.uuid4().hex + '.tmp'
+        object_columns = [col for col in df.columns if (df[col].dtype == object) and not _is_str_column(df[col])]
+        use_parquet = HAS_PYARROW and all(isinstance(col, str) for col in df.columns)
+
+        files = []
+        if use_parquet:
+            try:
+                df.drop(columns=object_columns).to_parquet(self._path(key, '.parquet') + tmp)
+                files.append(self._path(key, '.parquet'))
+                if object_columns:
+                    df[object_columns].to_pickle(self._path(key, '.obj.pkl') + tmp)
+                    files.append(self._path(key, '.obj.pkl'))
+            except Exception:
+                # pyarrow can't encode some column, fall back to pickling the whole thing
+                for f in files:
+                    _remove(f + tmp)
+                files = []
+                use_parquet = False
+        if not use_parquet:
+            df.to_pickle(self._path(key, '.pkl') + tmp)
+            files.append(self._path(key, '.pkl'))
+
+        for f in files:
+            os.replace(f + tmp, f)
+
+        meta = {
+            'format': 'parquet' if use_parquet else 'pickle',
+            'subject': None if subject is None else str(subject),
+            'kind': kind,
+            'columns': list(df.columns),
+            'object_columns': object_columns if use_parquet else [],
+            'files': [os.path.basename(f) for f in files],
+            'nbytes': int(sum(os.path.getsize(f) for f in files)),
+        }
+        with open(self._path(key, '.json') + tmp, 'w') as f:
+            json.dump(meta, f)
+        os.replace(self._path(key, '.json') + tmp, self._path(key, '.json'))
+
+        self.evict()
+
+    def load(self, kind, loader, task, subject, montage, session=None, options=None, source_files=None):
+        """
+        Returns the cached table if there is one, otherwise calls loader(), caches and returns its result.
+
+        Parameters
+        ----------
+        kind: str
+            Type of table (ex: 'events', 'electrodes', 'stimulation')
+        loader: callable
+            Function with no arguments that returns the DataFrame
+        task, subject, montage, session:
+            Identify the table
+        options: dict
+            Any loader options that change the result (ex: {'bipolar': True})
+        source_files: list
+            Files the table is read from. Their mtime and size are part of the key
+
+        Returns
+        -------
+        pandas.DataFrame
+        """
+        key = self.make_key(kind, task, subject, montage, session, options, source_files)
+        df = self.get(key)
+        if df is None:
+            df = loader()
+            if isinstance(df, pd.DataFrame):
+                self.put(key, df, subject=subject, kind=kind)
+        return df
+
+    # -- Maintenance --
+
+    def _entries(self):
+        entries = []
+        for meta_path in glob(os.path.join(self.cache_dir, '*.json')):
+            try:
+                with open(meta_path, 'r') as f:
+                    meta = json.load(f)
+                entries.append((os.path.getmtime(meta_path), meta_path, meta))
+            except (OSError, ValueError):
+                continue
+        return entries
+
+    def _remove_entry(self, meta_path, meta):
+        for f in meta.get('files', []):
+            _remove(os.path.join(self.cache_dir, f))
+        _remove(meta_path)
+
+    def evict(self):
+        """
+        Removes least recently used entries until the cache is no bigger than max_bytes.
+        """
+        entries = sorted(self._entries(), key=lambda e: e[0])
+        total = sum(meta.get('nbytes', 0) for _, _, meta in entries)
+        for _, meta_path, meta in entries:
+            if total <= self.max_bytes:
+                break
+            self._remove_entry(meta_path, meta)
+            total -= meta.get('nbytes', 0)
+
+    def invalidate(self, subject, kind=None):
+        """
+        Removes every cached table for subject (optionally only tables of one kind). Returns the number removed.
+        """
+        n = 0
+        for _, meta_path, meta in self._entries():
+            if (meta.get('subject') == str(subject)) and (kind is None or meta.get('kind') == kind):
+                self._remove_entry(meta_path, meta)
+                n += 1
+        return n
+
+    def clear(self):
+        """
+        Removes every cached table.
+        """
+        for _, meta_path, meta in self._entries():
+            self._remove_entry(meta_path, meta)
+
+    def stats(self):
+        """
+        Returns a dict of hit/miss counts for this process and the current size of the cache.
+        """
+        entries = self._entries()
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.,
+            'n_entries': len(entries),
+            'nbytes': sum(meta.get('nbytes', 0) for _, _, meta in entries),
+            'max_bytes': self.max_bytes,
+        }
+
+
+def cached_table(cache, kind, loader, task, subject, montage, session=None, options=None, source_files=None):
+    """
+    Calls loader() directly if cache is None, otherwise goes through cache.load(). Lets the loading functions take an
+    optional cache without branching everywhere.
+    """
+    if cache is None:
+        return loader()
+    return cache.load(kind, loader, task, subject, montage, session=session, options=options,
+                      source_files=source_files)
+
+
+def r1_source_files(data_type, subject, montage=0, experiment=None, session=None):
+    """
+    Returns the list of protocol files cmlreaders would read for a data type (ex: 'task_events', 'pairs', 'contacts').
+    Returns an empty list if the files can't be found, in which case the cache key only depends on the identifiers.
+    """
+    try:
+        from cmlreaders import PathFinder
+        finder = PathFinder(subject=subject, experiment=experiment, session=session, montage=int(montage))
+        return [finder.find(data_type)]
+    except Exception:
+        return []
+
+
+def _is_str_column(col):
+    return all((v is None) or isinstance(v, str) for v in col)
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
@@ -0,0 +1,36 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip('cmlreaders')
+
+from neuro.stim.events import SCHEMA_ATTR, compact_events, expand_events, is_compact
+
+
+def make_events(session):
+    return pd.DataFrame({
+        'type': ['STIM_ON', 'WORD', 'WORD'],
+        'session': np.array([session] * 3, dtype=np.int64),
+        'eegoffset': np.array([10, 20, 30], dtype=np.int64),
+        'stim_params': [[{'anode_label': 'LA1', 'amplitude': 1.5}], [], []],
+    })
+
+
+@pytest.mark.parametrize('drop_attrs', [False, True])
+def test_expand_concatenated_compact_events(drop_attrs):
+    frames = [compact_events(make_events(s)) for s in (0, 1)]
+    if drop_attrs:
+        for frame in frames:
+            frame.attrs = {}
+    events = pd.concat(frames, ignore_index=True)
+    if drop_attrs:
+        assert SCHEMA_ATTR not in events.attrs
+    assert is_compact(events)
+
+    expanded = expand_events(events)
+    expected = pd.concat([make_events(s) for s in (0, 1)], ignore_index=True)
+    assert list(expanded.columns) == list(expected.columns)
+    assert expanded['stim_params'].tolist() == expected['stim_params'].tolist()
+    assert expanded['type'].tolist() == expected['type'].tolist()
+    assert not isinstance(expanded['type'].dtype, pd.CategoricalDtype)
+    np.testing.assert_array_equal(expanded['eegoffset'], expected['eegoffset'])
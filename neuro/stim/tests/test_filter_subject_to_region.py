@@ -0,0 +1,47 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip('cmlreaders')
+pytest.importorskip('ptsa')
+
+from neuro.stim import inventory, loaders
+from neuro.stim.inventory import ElectrodeInventory
+
+# R1001P has a hippocampal contact whose only pair is labelled with its neighbour's (non-hippocampal) region
+CONTACTS = {
+    'R1001P': pd.DataFrame({'label': ['LA1', 'LA2'], 'ind.region': ['Left CA1', 'Left PHC'], 'ind.x': [-20., -22.]}),
+    'R1002P': pd.DataFrame({'label': ['LB1', 'LB2'], 'ind.region': ['Left EC', 'Left EC'], 'ind.x': [-20., -22.]}),
+    'R1003P': pd.DataFrame({'label': ['RC1', 'RC2'], 'ind.region': ['Right MTG', 'Right ITG'], 'ind.x': [40., 42.]}),
+}
+PAIRS = {
+    'R1001P': pd.DataFrame({'label': ['LA1-LA2'], 'ind.region': ['Left PHC'], 'ind.x': [-21.]}),
+    'R1002P': pd.DataFrame({'label': ['LB1-LB2'], 'ind.region': ['Left EC'], 'ind.x': [-21.]}),
+    'R1003P': pd.DataFrame({'label': ['RC1-RC2'], 'ind.region': ['Right MTG'], 'ind.x': [41.]}),
+}
+
+
+def fake_load_elec_info(subject, montage=0, bipolar=True):
+    return (PAIRS if bipolar else CONTACTS)[subject].copy()
+
+
+@pytest.fixture
+def subjs(monkeypatch):
+    monkeypatch.setattr(loaders, 'load_elec_info', fake_load_elec_info)
+    monkeypatch.setattr(inventory, 'load_elec_info', fake_load_elec_info)
+    monkeypatch.setattr(inventory, 'load_subj_events', lambda task, subject, montage: pd.DataFrame())
+    return pd.DataFrame({'subject': list(CONTACTS), 'montage': [0] * len(CONTACTS)})
+
+
+@pytest.mark.parametrize('roi', ['Hipp', 'MTL', 'EC', ['Hipp', 'Temporal']])
+def test_direct_and_inventory_paths_agree(subjs, tmp_path, roi):
+    inv = ElectrodeInventory('FR5', inventory_dir=str(tmp_path)).update(subjs, progress=False)
+    direct = loaders.filter_subject_to_region(subjs, roi=roi)
+    from_inventory = loaders.filter_subject_to_region(subjs, roi=roi, inventory=inv)
+    np.testing.assert_array_equal(direct, from_inventory)
+
+
+def test_roi_dict_must_match_inventory(subjs, tmp_path):
+    inv = ElectrodeInventory('FR5', inventory_dir=str(tmp_path)).update(subjs, progress=False)
+    with pytest.raises(ValueError):
+        loaders.filter_subject_to_region(subjs, roi='Hipp', roi_dict={'Hipp': ['Left CA1']}, inventory=inv)
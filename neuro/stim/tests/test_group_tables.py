@@ -0,0 +1,22 @@
+import pandas as pd
+
+from neuro.stim.group_tables import GroupTable
+
+
+def test_append_legacy_table():
+    # legacy electrode tables already have 'subject' and an electrode montage name in 'montage'
+    df = pd.DataFrame({'subject': ['TJ001', 'TJ001'], 'montage': ['hipp', 'inf'], 'label': ['LA1', 'LA2'],
+                       'avg.x': [-10., 12.]})
+    table = GroupTable().append('TJ001', 0, df).table
+    assert list(table.columns[:2]) == ['subject', 'montage']
+    assert list(table['subject'].astype(str)) == ['TJ001', 'TJ001']
+    assert list(table['montage']) == [0, 0]
+    assert list(table['elec_montage'].astype(str)) == ['hipp', 'inf']
+    assert list(table['hemi'].astype(str)) == ['left', 'right']
+
+
+def test_append_replaces_subject():
+    df = pd.DataFrame({'label': ['LA1'], 'avg.x': [1.]})
+    table = GroupTable().append('R1001P', 0, df).append('R1002P', 0, df).append('R1001P', 0, df)
+    assert sorted(table.subjects) == [('R1001P', 0), ('R1002P', 0)]
+    assert len(table) == 2